@@ -1,5 +1,6 @@
 from .chat_stream import ChatStream
 from .chat_prompt import AbstractChatPrompt
+from .model_registry import ModelRegistry
 from .request_handler.request_handler import AbstractRequestHandler
 
 # util
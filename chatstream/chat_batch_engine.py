@@ -0,0 +1,492 @@
+import asyncio
+import collections
+
+import torch
+
+from .chat_core import create_generation_config, encode_prompt, truncate_input_ids, sample_next_token, \
+    sample_next_tokens, create_token_counts, ChatOutputBuilder
+from .kv_block_manager import KVBlockTable
+from .util_kv_cache import to_legacy_kv, from_legacy_kv, kv_seq_len, left_pad_kv, concat_kv, select_kv, \
+    trim_kv_left
+
+
+class BatchSequence:
+    """
+    ChatBatchEngine で生成中の1リクエストぶんの状態
+    """
+
+    def __init__(self, config, input_ids, prefill_ids, output_builder, session_key=None):
+        self.config = config
+        self.prefill_ids = prefill_ids  # prefill でモデルに入力するトークンID(コンテクストサイズで切り詰め済)
+        self.session_key = session_key  # SessionKVCache のキー
+        self.cached_token_ids = []  # KVキャッシュに格納済の(モデルに入力済の)トークンID
+        self.prefix_node = None  # PrefixKVCache で参照しているノード
+        self.kv_table = None  # KVBlockManager 使用時、このシーケンスのKVキャッシュのブロックテーブル
+        self.prefill_kv = None  # prefill 中のシーケンスの、prefill 済の部分のKVキャッシュ(バッチサイズ1)
+        self.num_prefilled = 0  # prefill_ids のうち prefill 済(KVキャッシュに格納済)のトークン数
+        self.token_counts = create_token_counts(input_ids, config)  # プロンプト＋生成済トークンIDの出現回数
+        self.output_builder = output_builder  # 生成されたトークンを逐次デコードし、停止条件を判定する
+        self.num_positions = 0  # KVキャッシュに格納済の(パディングを除く)トークン数。次トークンの position_id となる
+        self.last_token_id = None  # 次の decode ステップでモデルに入力するトークンID
+        self.queue = asyncio.Queue()  # 生成された出力を generate 側に渡すためのキュー
+        self.finished = False
+        self.cancelled = False
+
+
+class ChatBatchEngine:
+    """
+    複数リクエストの逐次トークン生成を1つのバッチにまとめて実行する continuous batching エンジン
+
+    process_chat はリクエストごとにバッチサイズ1の forward を実行するため、N人が同時に生成中だと
+    1トークンあたり N 回の forward が必要になる。
+    本エンジンは生成中のシーケンス群を1つのバッチとして保持し、1ステップごとに全シーケンスぶんの decode を
+    1回の forward で実行する。
+
+    - 新しいリクエストはステップ間でバッチに参加する(個別に prefill したあと、左パディングしてKVキャッシュを連結する)
+    - prefill_chunk_size を指定すると、長いプロンプトの prefill を複数のステップに分割し、
+      他のシーケンスの decode と交互に実行する(1ステップで処理するトークン数は max_tokens_per_step までとする)
+    - 生成が終了したシーケンスはステップ間でバッチから取り除かれる
+    - 各シーケンスの出力は、シーケンスごとのキューを通じて process_chat と同じ形式で yield される
+    """
+
+    def __init__(self, model, tokenizer, device, max_batch_size=2, executor=None, session_kv_cache=None,
+                 prefix_kv_cache=None, kv_block_manager=None, prefill_chunk_size=None, max_tokens_per_step=None,
+                 compiled_decoder=None):
+        """
+        :param model: 事前学習済言語モデル
+        :param tokenizer: トークナイザ
+        :param device: 実行デバイス
+        :param max_batch_size: 同時にバッチに含めるシーケンスの最大数
+        :param executor: InferenceExecutor が指定された場合は、各ステップを推論スレッドで実行する
+        :param session_kv_cache: SessionKVCache が指定された場合は、セッションごとに前回のターンのKVキャッシュを再利用する
+        :param prefix_kv_cache: PrefixKVCache が指定された場合は、他のリクエストと共通のプレフィックスのKVキャッシュを再利用する
+        :param kv_block_manager: KVBlockManager が指定された場合は、ステップ間のKVキャッシュをブロックのプールに保持し、
+                                 最後まで生成できるだけのブロックを確保できるシーケンスだけをバッチに参加させる
+        :param prefill_chunk_size: 1ステップで1シーケンスあたりに prefill する最大トークン数。 None の場合は一度に prefill する
+        :param max_tokens_per_step: 1ステップでモデルに入力する最大トークン数(decode のトークンを含む)。
+                                    decode で使った残りを prefill に割り当てる。 None の場合は制限しない
+        :param compiled_decoder: CompiledDecoder が指定された場合は、バッチサイズがバケットに収まる decode ステップを
+                                 静的なKVキャッシュとコンパイル済のグラフで実行する(kv_block_manager を使う場合は使用しない)
+        """
+        if max_tokens_per_step is not None and max_tokens_per_step < max_batch_size:
+            raise ValueError(
+                f"max_tokens_per_step ({max_tokens_per_step}) must be at least max_batch_size ({max_batch_size})")
+
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.executor = executor
+        self.session_kv_cache = session_kv_cache
+        self.prefix_kv_cache = prefix_kv_cache
+        self.kv_block_manager = kv_block_manager
+        self.prefill_chunk_size = prefill_chunk_size
+        self.max_tokens_per_step = max_tokens_per_step
+        self.compiled_decoder = compiled_decoder
+
+        self.waiting_sequences = collections.deque()  # バッチへの参加待ちのシーケンス
+        self.prefilling_sequences = []  # バッチへの参加が決まり、prefill 中のシーケンス(参加した順)
+        self.running_sequences = []  # バッチで生成中のシーケンス(KVキャッシュの行と同じ順序)
+
+        self.past_key_values = None  # バッチ全体の KVキャッシュ ((key, value), ...) [batch, heads, seq_len, head_dim]
+        self.attention_mask = None  # バッチ全体の attention mask [batch, seq_len] (左パディング部分は0)
+        self.kv_like = None  # モデルが返した past_key_values の型を覚えておく
+
+        self.static_cache = None  # compiled_decoder で decode するときの StaticCache
+        self.static_kv_views = None  # static_cache 上の、バッチ全体のKVキャッシュのビュー
+
+        # ステップ中に生成された (シーケンス, 出力) 。推論スレッドから asyncio.Queue を直接操作しないよう、
+        # ステップ終了後にイベントループ側でシーケンスごとのキューに入れる
+        self.pending_outputs = []
+
+        self.loop_task = None
+        self.has_work = None
+
+    def get_num_running(self):
+        return len(self.running_sequences) + len(self.prefilling_sequences)
+
+    def get_num_waiting(self):
+        return len(self.waiting_sequences)
+
+    async def generate(self, params, prompt, session_key=None):
+        """
+        process_chat と同じ形式で、生成された文章を逐次 yield する非同期ジェネレータ
+
+        :param params: 生成パラメータ(process_chat と同じ)
+        :param prompt: プロンプト文字列、またはトークンIDのリスト
+        :param session_key: セッションを識別するキー(session_kv_cache のキー)
+        """
+        config = create_generation_config(params, self.tokenizer)
+        input_ids = encode_prompt(self.tokenizer, prompt, config)
+        seq = BatchSequence(config, input_ids, truncate_input_ids(input_ids, config),
+                            ChatOutputBuilder(self.tokenizer, input_ids, config), session_key=session_key)
+
+        self.waiting_sequences.append(seq)
+        self._ensure_loop()
+        self.has_work.set()
+
+        try:
+            while True:
+                output = await seq.queue.get()
+                if output is None:
+                    break
+                if isinstance(output, Exception):
+                    raise output
+                yield output
+        finally:
+            if not seq.finished:
+                # クライアントからの切断などで途中で終了した場合は次のステップでバッチから取り除く
+                seq.cancelled = True
+
+    def _ensure_loop(self):
+        if self.has_work is None:
+            self.has_work = asyncio.Event()
+        if self.loop_task is None or self.loop_task.done():
+            self.loop_task = asyncio.create_task(self._run_loop())
+
+    async def _run_loop(self):
+        """
+        生成中または参加待ちのシーケンスが存在するかぎり、1ステップずつバッチ生成を進める
+        """
+        while True:
+            if not self.waiting_sequences and not self.running_sequences and not self.prefilling_sequences:
+                self.has_work.clear()
+                await self.has_work.wait()
+
+            try:
+                if self.executor is not None:
+                    await self.executor.run(self.step)
+                else:
+                    self.step()
+            except Exception as e:
+                self._abort_all(e)
+
+            self._flush_outputs()
+
+            # ステップごとに他のタスクに制御を移す
+            await asyncio.sleep(0)
+
+    def step(self):
+        """
+        バッチ生成を1ステップ進める
+
+        1. キャンセルされたシーケンスをバッチから取り除く
+        2. 空きがあれば参加待ちのシーケンスをバッチに参加させ、prefill 中のシーケンスに割り当てる
+        3. トークン数の上限の範囲で prefill を進め、prefill し終えたシーケンスは最初のトークンを生成して decode に加える
+        4. バッチ全体で1トークンぶんの decode を実行する
+        """
+        with torch.no_grad():
+            self._remove_sequences([seq for seq in self.running_sequences if seq.cancelled])
+            for seq in [seq for seq in self.prefilling_sequences if seq.cancelled]:
+                self.prefilling_sequences.remove(seq)
+                self._release_prefix(seq)
+
+            while self.waiting_sequences and self.get_num_running() < self.max_batch_size:
+                if self.get_num_running() > 0 and not self._can_admit(self.waiting_sequences[0]):
+                    # ブロックが空くまで参加を待たせる
+                    break
+                seq = self.waiting_sequences.popleft()
+                if seq.cancelled:
+                    continue
+                self._admit(seq)
+
+            # decode で入力するトークン数を除いた残りを prefill に割り当てる
+            prefill_budget = None
+            if self.max_tokens_per_step is not None:
+                prefill_budget = self.max_tokens_per_step - len(self.running_sequences)
+
+            for seq in list(self.prefilling_sequences):
+                num_tokens = len(seq.prefill_ids) - seq.num_prefilled
+                if self.prefill_chunk_size is not None:
+                    num_tokens = min(num_tokens, self.prefill_chunk_size)
+                if prefill_budget is not None:
+                    num_tokens = min(num_tokens, prefill_budget)
+                    prefill_budget -= num_tokens
+                if num_tokens <= 0:
+                    break
+                self._prefill_chunk(seq, num_tokens)
+
+            if self.running_sequences:
+                self._decode()
+
+    def _admit(self, seq):
+        """
+        シーケンスをバッチに参加させ、再利用できるKVキャッシュがあれば prefill 済の部分とする
+        """
+        # 前回のターンのKVキャッシュを再利用できる場合は、まだ計算していない部分だけを prefill する
+        reuse_len, cached_kv = 0, None
+        if self.session_kv_cache is not None and seq.session_key is not None:
+            reuse_len, cached_kv = self.session_kv_cache.take(seq.session_key, seq.prefill_ids)
+
+        # セッションのKVキャッシュが無い場合は、システムプロンプトなど他のリクエストと共通のプレフィックスを再利用する
+        if self.prefix_kv_cache is not None and reuse_len == 0:
+            reuse_len, cached_kv, seq.prefix_node = self.prefix_kv_cache.match(seq.prefill_ids)
+
+        seq.num_prefilled = reuse_len
+        seq.prefill_kv = cached_kv
+        self.prefilling_sequences.append(seq)
+
+    def _prefill_chunk(self, seq, num_tokens):
+        """
+        シーケンスのプロンプトのうち、まだ prefill していない部分の先頭から num_tokens トークンを単独で prefill する
+
+        プロンプトの最後まで prefill し終えた場合は、最初のトークンを生成したうえで decode のバッチに参加させる
+        """
+        start = seq.num_prefilled
+        out = self.model(input_ids=torch.as_tensor([seq.prefill_ids[start:start + num_tokens]], device=self.device),
+                         past_key_values=from_legacy_kv(seq.prefill_kv, like=self.kv_like),
+                         use_cache=True)
+        self.kv_like = out.past_key_values
+        seq.prefill_kv = to_legacy_kv(out.past_key_values)
+        seq.num_prefilled += num_tokens
+
+        if seq.num_prefilled < len(seq.prefill_ids):
+            return
+
+        self.prefilling_sequences.remove(seq)
+        seq_kv, seq.prefill_kv = seq.prefill_kv, None
+        seq.num_positions = len(seq.prefill_ids)
+        seq.cached_token_ids = list(seq.prefill_ids)
+
+        if self.prefix_kv_cache is not None:
+            # prefill したプロンプトのKVキャッシュを、他のリクエストでも再利用できるように格納する
+            self.prefix_kv_cache.insert(seq.prefill_ids, seq_kv)
+
+        if self.kv_block_manager is not None:
+            seq.kv_table = KVBlockTable()
+            self.kv_block_manager.write(seq.kv_table, seq_kv)
+
+        self._append_token(seq, sample_next_token(out.logits[0][-1], seq.config, seq.token_counts, self.device))
+        if seq.finished:
+            self._save_session_kv(seq, seq_kv)
+            self._release_prefix(seq)
+            self._free_blocks(seq)
+            return
+
+        if self.kv_block_manager is not None:
+            # KVキャッシュはブロックのプールに保持しているので、バッチのKVキャッシュには連結しない
+            self.running_sequences.append(seq)
+            return
+
+        seq_len = kv_seq_len(seq_kv)
+        seq_mask = torch.ones((1, seq_len), dtype=torch.long, device=seq_kv[0][0].device)
+
+        if self.past_key_values is None:
+            self.past_key_values = seq_kv
+            self.attention_mask = seq_mask
+        else:
+            # シーケンス長を揃えるため、短いほうを左パディングしてからバッチ方向に連結する
+            batch_len = kv_seq_len(self.past_key_values)
+            max_len = max(batch_len, seq_len)
+            self.past_key_values = concat_kv([left_pad_kv(self.past_key_values, max_len - batch_len),
+                                              left_pad_kv(seq_kv, max_len - seq_len)])
+            self.attention_mask = torch.cat([
+                torch.nn.functional.pad(self.attention_mask, (max_len - batch_len, 0)),
+                torch.nn.functional.pad(seq_mask, (max_len - seq_len, 0))], dim=0)
+
+        self.running_sequences.append(seq)
+
+    def _decode(self):
+        """
+        バッチ全体で1トークンぶんの decode を1回の forward で実行する
+        """
+        sequences = self.running_sequences
+
+        if self.kv_block_manager is not None:
+            # ステップ間のKVキャッシュはブロックのプールにのみ保持しているので、forward の直前に集める
+            self.past_key_values, self.attention_mask = self.kv_block_manager.gather(
+                [seq.kv_table for seq in sequences])
+
+        mask_device = self.attention_mask.device
+
+        input_ids = torch.as_tensor([[seq.last_token_id] for seq in sequences], device=self.device)
+        position_ids = torch.as_tensor([[seq.num_positions] for seq in sequences], device=self.device)
+        attention_mask = torch.cat(
+            [self.attention_mask, torch.ones((len(sequences), 1), dtype=torch.long, device=mask_device)], dim=1)
+
+        if (self.compiled_decoder is not None and self.kv_block_manager is None
+                and self.compiled_decoder.can_decode(len(sequences), attention_mask.shape[1])):
+            last_token_logits = self._decode_compiled(sequences, attention_mask)
+        else:
+            out = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=from_legacy_kv(self.past_key_values, like=self.kv_like),
+                use_cache=True,
+            )
+            self.past_key_values = to_legacy_kv(out.past_key_values)
+            last_token_logits = out.logits[:, -1, :]
+
+        self.attention_mask = attention_mask
+
+        if self.kv_block_manager is not None:
+            # 新たに入力したトークンぶんのKVキャッシュだけをブロックに書き込む
+            for row, seq in enumerate(sequences):
+                self.kv_block_manager.write(seq.kv_table, tuple(
+                    (key[row:row + 1, :, -1:, :], value[row:row + 1, :, -1:, :]) for key, value in self.past_key_values))
+            self.past_key_values = None
+            self.attention_mask = None
+
+        # バッチ全体の次トークンを1回でサンプリングする
+        token_ids = sample_next_tokens(last_token_logits, [seq.config for seq in sequences],
+                                       [seq.token_counts for seq in sequences], self.device)
+
+        for seq, token_id in zip(sequences, token_ids):
+            seq.num_positions += 1
+            seq.cached_token_ids.append(seq.last_token_id)
+            self._append_token(seq, token_id)
+
+        self._remove_sequences([seq for seq in sequences if seq.finished])
+
+    def _decode_compiled(self, sequences, attention_mask):
+        """
+        静的なKVキャッシュ(StaticCache)とコンパイル済のグラフで、バッチ全体の decode を実行する
+
+        バッチへの参加・離脱で past_key_values が作り直された場合だけ、StaticCache に書き込み直す。
+        それ以外のステップでは past_key_values は StaticCache 上のビューのままとなるため、コピーは発生しない
+
+        :return: 次トークンの logits [batch, vocab_size]
+        """
+        batch_size = len(sequences)
+        seq_len = kv_seq_len(self.past_key_values)
+        decoder = self.compiled_decoder
+
+        if self.past_key_values is not self.static_kv_views:
+            if self.static_cache is not None and \
+                    self.static_cache.layers[0].keys.shape[0] != decoder.get_bucket(batch_size):
+                decoder.release_cache(self.static_cache)
+                self.static_cache = None
+            if self.static_cache is None:
+                self.static_cache = decoder.acquire_cache(batch_size)
+            decoder.load(self.static_cache, self.past_key_values)
+
+        logits = decoder.decode(self.static_cache, [seq.last_token_id for seq in sequences],
+                                [seq.num_positions for seq in sequences], attention_mask)
+
+        self.past_key_values = self.static_kv_views = decoder.get_views(self.static_cache, batch_size, seq_len + 1)
+        return logits
+
+    def _append_token(self, seq, token_id):
+        """
+        選んだ次トークンをシーケンスに追加し、process_chat と同じ形式の出力をシーケンスのキューに入れる
+        """
+        if seq.token_counts is not None:
+            seq.token_counts.add(token_id)
+        seq.last_token_id = token_id
+
+        finished = seq.output_builder.append(token_id)
+        self.pending_outputs.append((seq, seq.output_builder.text))
+
+        if finished:
+            seq.finished = True
+            self.pending_outputs.append((seq, None))
+
+    def _flush_outputs(self):
+        """
+        ステップ中に生成された出力を、シーケンスごとのキューに入れる
+        """
+        pending_outputs, self.pending_outputs = self.pending_outputs, []
+        for seq, output in pending_outputs:
+            seq.queue.put_nowait(output)
+
+    def _remove_sequences(self, sequences_to_remove):
+        """
+        指定したシーケンスをバッチから取り除き、KVキャッシュと attention mask を詰める
+        """
+        if not sequences_to_remove:
+            return
+
+        for seq in sequences_to_remove:
+            self._release_prefix(seq)
+
+        if self.kv_block_manager is not None:
+            for seq in sequences_to_remove:
+                if self.session_kv_cache is not None and seq.session_key is not None:
+                    # 取り除くシーケンスのKVキャッシュは、次のターンで再利用できるように保存する
+                    self._save_session_kv(seq, self.kv_block_manager.gather([seq.kv_table])[0])
+                self._free_blocks(seq)
+            self.running_sequences = [seq for seq in self.running_sequences if seq not in sequences_to_remove]
+            return
+
+        if self.session_kv_cache is not None:
+            # 取り除くシーケンスのKVキャッシュは、次のターンで再利用できるように保存する
+            for row, seq in enumerate(self.running_sequences):
+                if seq in sequences_to_remove and seq.session_key is not None:
+                    num_pads = int((self.attention_mask[row] == 0).sum())
+                    self._save_session_kv(seq, trim_kv_left(select_kv(self.past_key_values, [row]), num_pads))
+
+        keep_rows = [row for row, seq in enumerate(self.running_sequences) if seq not in sequences_to_remove]
+        self.running_sequences = [self.running_sequences[row] for row in keep_rows]
+
+        if not keep_rows:
+            self.past_key_values = None
+            self.attention_mask = None
+            return
+
+        self.past_key_values = select_kv(self.past_key_values, keep_rows)
+        self.attention_mask = self.attention_mask.index_select(
+            0, torch.as_tensor(keep_rows, dtype=torch.long, device=self.attention_mask.device))
+
+        # 残ったすべての行で左パディングになっている列は不要なので取り除く
+        num_leading_pads = int((self.attention_mask.cumsum(dim=1) == 0).sum(dim=1).min())
+        if num_leading_pads > 0:
+            self.past_key_values = trim_kv_left(self.past_key_values, num_leading_pads)
+            self.attention_mask = self.attention_mask[:, num_leading_pads:]
+
+    def _save_session_kv(self, seq, seq_kv):
+        """
+        シーケンスのKVキャッシュ(バッチサイズ1、パディングなし)を SessionKVCache に保存する
+        """
+        if self.session_kv_cache is None or seq.session_key is None:
+            return
+        self.session_kv_cache.put(seq.session_key, seq.cached_token_ids, seq_kv)
+
+    def _release_prefix(self, seq):
+        """
+        シーケンスが参照している PrefixKVCache のノードを解放する
+        """
+        if self.prefix_kv_cache is not None and seq.prefix_node is not None:
+            self.prefix_kv_cache.release(seq.prefix_node)
+            seq.prefix_node = None
+
+    def _free_blocks(self, seq):
+        """
+        シーケンスの KVBlockManager のブロックを解放する
+        """
+        if self.kv_block_manager is not None and seq.kv_table is not None:
+            self.kv_block_manager.free(seq.kv_table)
+            seq.kv_table = None
+
+    def _can_admit(self, seq):
+        """
+        生成中のシーケンスが最後まで生成するぶんのブロックを残したうえで、
+        シーケンスが最後まで生成するぶんのブロックを確保できるかどうか
+        """
+        if self.kv_block_manager is None:
+            return True
+
+        manager = self.kv_block_manager
+
+        def get_num_blocks_to_finish(s):
+            num_allocated = len(s.kv_table.block_ids) if s.kv_table is not None else 0
+            return max(0, manager.get_num_blocks_for(len(s.prefill_ids) + s.config["max_new_tokens"]) - num_allocated)
+
+        num_reserved = sum(get_num_blocks_to_finish(s) for s in self.running_sequences + self.prefilling_sequences)
+        return get_num_blocks_to_finish(seq) + num_reserved <= manager.get_num_free_blocks()
+
+    def _abort_all(self, error):
+        """
+        生成中にエラーが発生した場合、生成中・参加待ちの全シーケンスにエラーを通知してバッチを破棄する
+        """
+        for seq in list(self.running_sequences) + self.prefilling_sequences + list(self.waiting_sequences):
+            seq.finished = True
+            seq.prefill_kv = None
+            self._release_prefix(seq)
+            self._free_blocks(seq)
+            self.pending_outputs.append((seq, error))
+        self.running_sequences = []
+        self.prefilling_sequences = []
+        self.waiting_sequences.clear()
+        self.past_key_values = None
+        self.attention_mask = None
@@ -2,80 +2,27 @@ import asyncio
 
 import torch
 
-from .sampling_utils import sampling
+from .incremental_detokenizer import IncrementalDetokenizer
+from .kv_block_manager import KVBlockTable
+from .logits_processor import RepetitionPenaltyProcessor, TokenCounts
+from .sampling_utils import batched_sampling
+from .stop_condition_matcher import StopConditionMatcher
+from .util_kv_cache import from_legacy_kv, to_legacy_kv
 
 
-async def process_chat(model, tokenizer, device, params, prompt):
+def create_generation_config(params, tokenizer):
     """
-    指定された生成条件によって、文章生成を行う。
-    
-    事前学習済言語モデルによる並行トークン生成（非同期タスク）に対応。
-
-    【文章生成について】
-    文章生成は条件(params)によってモデルによる逐次文章生成をコントロールする
-    また、停止ワードや停止トークンを監視し、必要なタイミングで文章生成を停止させる
-
-    【複数のリクエストの並行処理について】
-    FastAPIは非同期I/Oをサポートしており、これは複数のリクエストを並行に処理する能力がある。
-    FastAPI（というかPythonの）非同期I/Oは、コルーチンと呼ばれる特殊な関数を使用して並行性を実現している。
-    この場合の並行性とは、一度に一つのタスクだけが進行するが、I/O操作（HTTPリクエスト、モデルからのトークンの生成など）を待つ間に他のタスクを進行させることができる
-    ということ。この形式を"協調的マルチタスク"を呼ぶ。
-    それぞれのリクエストは別の「非同期タスク」として処理され、これらのタスクは同じスレッド上で切り替えられる。
-    「非同期タスク」においては複数のリクエストに対するモデルへのアクセスが並行しているように見えるが
-    実際にはある瞬間に一つのリクエストだけがモデルを利用している。
-    そのため、それぞれのリクエストが　モデルによるトークン生成のためにブロックする期間は限られており、
-    逐次出力トークンの生成について言えば、１つ新トークンを生成した後で他のリクエストに制御を戻すことができる。
-    そのために、本メソッド内のforループ内で１つトークンを生成する毎に await asyncio.sleep(0) を呼び出し、
-    他のタスクが進行できる（制御を移す）チャンスを与えるようにしている。
-    そのため、一つのリクエストによる文章生成の際、停止トークン、停止文字列が現れるまでの間、
-    他の全てのリクエストがブロックされることはなく、各リクエストはモデルからのトークンを逐次生成しながら、
-    他のリクエストも進行させることができる。
+    生成パラメータ(params)を解釈し、文章生成ループで使用する設定値の辞書を作成する
 
+    process_chat と ChatBatchEngine の双方で同じ解釈となるよう、ここに集約している
 
-     :param model: 
-     :param tokenizer: 
-     :param device: 
-     :param params: 
-        paramsの例
-             {
-    "temperature": 0.7,  # Temperatureの値
-                             "max_new_tokens": 256,  # 新たに生成する最大トークンサイズ（何トークン分か。)
-                             "context_len": 1024,  # コンテクストのサイズ（何トークン分か。)
-                             "use_top_k_sampling": True,  # True: top K サンプリングを有効にする
-                             "top_k_value": 50,  # top K サンプリングの値。
-                             "use_top_p_sampling": True,  # True: top P サンプリングを有効にする
-                             "top_p_value": 0.7,  # top P サンプリングの値
-                             "use_repetition_penalty": False,  # True:繰り返し同じトークンを生成したときのペナルティを有効する
-                             "repetition_penalty": 1,  # ペナルティの値
-                             "repetition_penalty_method": "multiplicative"  # ペナルティの計算方法
-             },     
-     :param prompt: 
-
+    :param params: 生成パラメータ。 process_chat の params と同じ形式
+    :param tokenizer: HuggingFace style tokenizer
+    :return: 生成設定の辞書
     """
-    stream_interval = 1
-
-    temperature = float(params.get("temperature", 1.0))
-    max_new_tokens = int(params.get("max_new_tokens", 256))
-    context_len = int(params.get("context_len", 1024))
-    stop_strs = params.get("stop_strs", None)
     force_set_bos_token_id = params.get("force_set_bos_token_id", None)
     force_set_eos_token_id = params.get("force_set_eos_token_id", None)
 
-    add_special_tokens = params.get("add_special_tokens", None)
-
-    use_top_k_sampling = params.get("use_top_k_sampling", True)
-    top_k_value = params.get("top_k_value", 50)
-
-    use_top_p_sampling = params.get("use_top_p_sampling", True)
-    top_p_value = params.get("top_p_value", 1.0)
-
-    use_repetition_penalty = params.get("use_repetition_penalty", False)
-
-    repetition_penalty = params.get("repetition_penalty", 1)
-
-    repetition_penalty_method = params.get("repetition_penalty_method", "multiplicative")
-    use_bos_for_input = params.get("use_bos_for_input", False)
-
     if force_set_bos_token_id:
         # patch for open_llama_7b_preview_300bt
         tokenizer.bos_token_id = force_set_bos_token_id
@@ -86,13 +33,45 @@ async def process_chat(model, tokenizer, device, params, prompt):
     else:
         stop_token_ids = params.get("stop_ids", [tokenizer.eos_token_id])
 
-    len_prompt = len(prompt)
+    use_repetition_penalty = params.get("use_repetition_penalty", False)
+
+    return {
+        "temperature": float(params.get("temperature", 1.0)),
+        "max_new_tokens": int(params.get("max_new_tokens", 256)),
+        "context_len": int(params.get("context_len", 1024)),
+        "stop_strs": params.get("stop_strs", None),
+        "stop_token_ids": stop_token_ids,
+        "add_special_tokens": params.get("add_special_tokens", None),
+        "top_k": params.get("top_k_value", 50) if params.get("use_top_k_sampling", True) else None,
+        "top_p": params.get("top_p_value", 1.0) if params.get("use_top_p_sampling", True) else None,
+        "repetition_penalty": params.get("repetition_penalty", 1) if use_repetition_penalty else None,
+        "repetition_penalty_method": params.get("repetition_penalty_method", "multiplicative"),
+        "use_bos_for_input": params.get("use_bos_for_input", False),
+        "use_prompt_lookup": params.get("use_prompt_lookup", False),
+    }
+
+
+def encode_prompt(tokenizer, prompt, config):
+    """
+    プロンプト文字列をトークンIDのリストに変換する
+
+    プロンプトがトークンIDのリスト(AbstractChatPrompt.create_prompt_input_ids で組み立てたもの)の場合は
+    トークン化せず、特殊トークンだけを文字列の場合と同じように付与する
 
-    if use_bos_for_input:
+    :return: 入力トークンIDのリスト
+    """
+    if isinstance(prompt, list):
+        if config["use_bos_for_input"]:
+            return [tokenizer.bos_token_id] + prompt
+        if config["add_special_tokens"] is False or not hasattr(tokenizer, "build_inputs_with_special_tokens"):
+            return list(prompt)
+        return tokenizer.build_inputs_with_special_tokens(prompt)
+
+    if config["use_bos_for_input"]:
         # force add bos
         input_ids = [tokenizer.bos_token_id] + tokenizer(prompt).input_ids
-        len_prompt -= len(tokenizer.decode([tokenizer.bos_token_id]))
     else:
+        add_special_tokens = config["add_special_tokens"]
         if add_special_tokens is None:
             # tokenizer __call__ だと自動的に特殊トークンを入れてしまう模様.
             input_ids = tokenizer(prompt).input_ids
@@ -100,77 +79,479 @@ async def process_chat(model, tokenizer, device, params, prompt):
             # 特殊トークンを自動でいれさせないために add_special_token を明示的にマネージする
             input_ids = tokenizer.encode(prompt, add_special_tokens=add_special_tokens)
 
-    output_token_ids = list(input_ids)
+    return input_ids
 
-    max_src_len = context_len - max_new_tokens - 8
-    input_ids = input_ids[-max_src_len:]
 
-    with torch.no_grad():
-        for idx in range(max_new_tokens):
+def get_max_input_len(params):
+    """
+    コンテクストサイズから、生成するトークン数ぶんを除いた入力トークン数の上限を求める
 
-            # Insert asyncio.sleep(0) here to yield control after each token is generated
-            await asyncio.sleep(0)
+    :param params: 生成パラメータ、または create_generation_config で作成した生成設定
+    """
+    return int(params.get("context_len", 1024)) - int(params.get("max_new_tokens", 256)) - 8
 
+
+def truncate_input_ids(input_ids, config):
+    """
+    コンテクストサイズに収まるように入力トークンIDの先頭を切り詰める
+    """
+    return input_ids[-get_max_input_len(config):]
+
+
+def create_token_counts(input_ids, config):
+    """
+    繰り返しペナルティを使う場合は、入力トークンIDの出現回数を数えた TokenCounts を作る
+
+    :return: TokenCounts 。繰り返しペナルティを使わない場合は None
+    """
+    if config["repetition_penalty"] is None:
+        return None
+    return TokenCounts(input_ids)
+
+
+def sample_next_token(last_token_logits, config, token_counts, device):
+    """
+    最終位置の logits から次トークンを1つ選ぶ
+
+    :param last_token_logits: 語彙サイズの1次元 logits
+    :param config: create_generation_config で作成した生成設定
+    :param token_counts: これまでのトークンIDの出現回数(繰り返しペナルティ用)。 create_token_counts で作成する
+    :param device: 実行デバイス
+    :return: トークンID
+    """
+    return sample_next_tokens(last_token_logits.unsqueeze(0), [config], [token_counts], device)[0]
+
+
+def sample_next_tokens(last_token_logits, configs, token_counts_list, device):
+    """
+    バッチの最終位置の logits から、シーケンスごとに次トークンを1つずつ選ぶ
+
+    繰り返しペナルティはペナルティの計算方法ごとにまとめて適用し、
+    temperature, top-k, top-p はシーケンスごとの値で batched_sampling によりまとめてサンプリングする
+
+    :param last_token_logits: logits [batch, vocab_size]
+    :param configs: シーケンスごとの生成設定(create_generation_config で作成したもの)のリスト
+    :param token_counts_list: シーケンスごとの TokenCounts (繰り返しペナルティを使わない場合は None) のリスト
+    :param device: 実行デバイス
+    :return: トークンIDのリスト
+    """
+    if device == "mps":
+        last_token_logits = last_token_logits.float().to("cpu")
+
+    logits = last_token_logits
+    vocab_size = logits.shape[-1]
+
+    # greedy の場合は繰り返しペナルティを適用しない
+    is_greedy = [config["temperature"] < 1e-4 for config in configs]
+
+    for method in ("multiplicative", "subtractive"):
+        rows = [row for row, config in enumerate(configs) if not is_greedy[row]
+                and config["repetition_penalty"] is not None and config["repetition_penalty_method"] == method]
+        if not rows:
+            continue
+        if logits is last_token_logits:
+            logits = logits.clone()
+        row_index = torch.as_tensor(rows, dtype=torch.long, device=logits.device)
+        token_counts = torch.stack([token_counts_list[row].get(vocab_size, logits.device) for row in rows])
+        penalties = torch.as_tensor([float(configs[row]["repetition_penalty"]) for row in rows])
+        logits[row_index] = RepetitionPenaltyProcessor(penalties, method)(logits[row_index], token_counts)
+
+    token_ids = batched_sampling(
+        logits,
+        temperature=torch.as_tensor([config["temperature"] for config in configs]),
+        k=torch.as_tensor([config["top_k"] or 0 for config in configs]),
+        p=torch.as_tensor([config["top_p"] if config["top_p"] is not None else 1.0 for config in configs]),
+    )
+    return token_ids.tolist()
+
+
+class ChatOutputBuilder:
+    """
+    1リクエストぶんの生成トークンを受け取り、クライアントに返す文字列を組み立てる
+
+    生成されたトークンは IncrementalDetokenizer で差分だけデコードし、
+    StopConditionMatcher で停止トークン・停止文字列を判定する。
+    process_chat と ChatBatchEngine の双方で使用する
+    """
+
+    def __init__(self, tokenizer, input_ids, config):
+        self.config = config
+        self.detokenizer = IncrementalDetokenizer(tokenizer, input_ids)
+        self.stop_condition = StopConditionMatcher(config["stop_strs"], config["stop_token_ids"])
+        self.text = ""  # クライアントに返す生成済の文字列(停止文字列の途中かもしれない部分は含まない)
+        self.num_generated = 0
+        self.finished = False
+
+    def append(self, token_id):
+        """
+        生成されたトークンを1つ追加する
+
+        :param token_id: 生成されたトークンID
+        :return: 文章生成を終了すべき場合は True
+        """
+        self.num_generated += 1
+
+        stopped = self.stop_condition.is_stop_token(token_id)
+        is_last_token = stopped or self.num_generated >= self.config["max_new_tokens"]
+
+        delta = self.detokenizer.put(token_id)
+        if is_last_token:
+            delta += self.detokenizer.flush()
+
+        safe_text, is_stop_str_found = self.stop_condition.put(delta)
+        self.text += safe_text
+
+        if not is_stop_str_found and is_last_token:
+            # 停止文字列の途中として保留していた文字列も出力する
+            self.text += self.stop_condition.flush()
+
+        self.finished = is_last_token or is_stop_str_found
+        return self.finished
+
+
+@torch.no_grad()
+def generate_chat(model, tokenizer, device, params, prompt, session_kv_cache=None, session_key=None,
+                  prefix_kv_cache=None, kv_block_manager=None, speculative_decoder=None, prompt_lookup_decoder=None,
+                  compiled_decoder=None):
+    """
+    process_chat の文章生成ループ本体となる同期ジェネレータ
+
+    1トークン生成するごとに、生成済の文章(プロンプトは含まない)を yield する。
+    await を含まないため、イベントループのスレッドでも推論スレッドでも実行できる。
+    パラメータは process_chat と同じ
+    """
+    stream_interval = 1
+
+    config = create_generation_config(params, tokenizer)
+    max_new_tokens = config["max_new_tokens"]
+
+    input_ids = encode_prompt(tokenizer, prompt, config)
+
+    token_counts = create_token_counts(input_ids, config)
+
+    # 生成されたトークンのみを逐次デコードし、停止条件を判定する(プロンプトを含むトークン列全体はデコードしない)
+    output_builder = ChatOutputBuilder(tokenizer, input_ids, config)
+
+    input_ids = truncate_input_ids(input_ids, config)
+
+    uses_kv_caches = session_kv_cache is not None or prefix_kv_cache is not None or kv_block_manager is not None
+    if config["use_prompt_lookup"] and prompt_lookup_decoder is not None and not uses_kv_caches:
+        # 会話履歴の n-gram から先読みする(ドラフトモデルより優先する)
+        # KVキャッシュの再利用・ブロック管理を使う場合は、リクエストごとの指定を無視して通常どおり生成する
+        speculative_decoder = prompt_lookup_decoder
+
+    if speculative_decoder is not None:
+        # ドラフトモデルで先読みしたトークンをまとめて検証しながら生成する(KVキャッシュの再利用・ブロック管理は行わない)
+        yield from speculative_decoder.generate(model, device, config, input_ids, token_counts, output_builder)
+        return
+
+    if (compiled_decoder is not None and session_kv_cache is None and prefix_kv_cache is None
+            and kv_block_manager is None and compiled_decoder.can_decode(1, len(input_ids) + max_new_tokens)):
+        # 静的なKVキャッシュとコンパイル済の decode で生成する(KVキャッシュの再利用・ブロック管理を使う場合は使用しない)
+        yield from compiled_decoder.generate(model, device, config, input_ids, token_counts, output_builder)
+        return
+
+    use_session_kv_cache = session_kv_cache is not None and session_key is not None
+
+    # 前回のターンのKVキャッシュを再利用できる場合は、まだ計算していない部分だけを prefill する
+    reuse_len, past_key_values = 0, None
+    if use_session_kv_cache:
+        reuse_len, past_key_values = session_kv_cache.take(session_key, input_ids)
+
+    # セッションのKVキャッシュが無い場合は、システムプロンプトなど他のリクエストと共通のプレフィックスを再利用する
+    prefix_node = None
+    if prefix_kv_cache is not None and reuse_len == 0:
+        reuse_len, past_key_values, prefix_node = prefix_kv_cache.match(input_ids)
+
+    cached_token_ids = list(input_ids)  # KVキャッシュに含まれる(モデルに入力済の)トークンID
+
+    # KVBlockManager を使う場合は、ステップ間のKVキャッシュをブロックのプールにのみ保持する
+    kv_table = KVBlockTable() if kv_block_manager is not None else None
+
+    try:
+        for idx in range(max_new_tokens):
             if idx == 0:
                 # モデルにテンソルを入力して出力を得る
 
-                out = model(input_ids=torch.as_tensor([input_ids], device=device), use_cache=True)
+                out = model(input_ids=torch.as_tensor([input_ids[reuse_len:]], device=device),
+                            past_key_values=from_legacy_kv(past_key_values),
+                            use_cache=True)
                 logits = out.logits
                 past_key_values = out.past_key_values
+
+                if prefix_kv_cache is not None:
+                    # prefill したプロンプトのKVキャッシュを、他のリクエストでも再利用できるように格納する
+                    prefix_kv_cache.insert(input_ids, to_legacy_kv(past_key_values))
             else:
+                if kv_table is not None:
+                    # forward の直前にブロックからKVキャッシュを集める
+                    past_key_values = from_legacy_kv(kv_block_manager.gather([kv_table])[0])
+
                 # モデルにテンソルを入力して出力を得る
                 out = model(
                     input_ids=torch.as_tensor([[token_id]], device=device),
                     use_cache=True,
                     past_key_values=past_key_values,
                 )
+                cached_token_ids.append(token_id)
                 logits = out.logits
                 past_key_values = out.past_key_values
 
+            if kv_table is not None:
+                # 新たに入力したトークンぶんのKVキャッシュをブロックに書き込み、モデルが返したKVキャッシュは手放す
+                kv_block_manager.write(kv_table, to_legacy_kv(past_key_values), start=kv_table.num_tokens)
+                past_key_values = None
+
             last_token_logits = logits[0][-1]
 
-            if device == "mps":
-                last_token_logits = last_token_logits.float().to("cpu")
+            token_id = sample_next_token(last_token_logits, config, token_counts, device)
 
-            if temperature < 1e-4:
-                token_id = int(torch.argmax(last_token_logits))
-            else:
-                if not use_repetition_penalty:
-                    repetition_penalty = None
-
-                token_id = sampling(
-                    logits=last_token_logits,
-                    k=top_k_value if use_top_k_sampling else None,
-                    p=top_p_value if use_top_p_sampling else None,
-                    temperature=temperature,
-                    past_tokens=output_token_ids,
-                    penalty=repetition_penalty,
-                    penalty_method=repetition_penalty_method
-                )
+            if token_counts is not None:
+                token_counts.add(token_id)
 
-            output_token_ids.append(token_id)
-
-            if token_id in stop_token_ids:
-                stopped = True
-            else:
-                stopped = False
+            stopped = output_builder.append(token_id)
 
             if idx % stream_interval == 0 or idx == max_new_tokens - 1 or stopped:
-                output = tokenizer.decode(output_token_ids, skip_special_tokens=True)
+                yield output_builder.text
+
+            if stopped:
+                break
+    finally:
+        # 途中で終了した場合も含め、次のターンで再利用できるようにKVキャッシュを保存する
+        if kv_table is not None:
+            if use_session_kv_cache and kv_table.num_tokens > reuse_len:
+                session_kv_cache.put(session_key, cached_token_ids[:kv_table.num_tokens],
+                                     kv_block_manager.gather([kv_table])[0])
+            kv_block_manager.free(kv_table)
+        elif use_session_kv_cache and past_key_values is not None and len(cached_token_ids) > reuse_len:
+            session_kv_cache.put(session_key, cached_token_ids, to_legacy_kv(past_key_values))
 
-                if stop_strs:
-                    for stop_str in stop_strs:
-                        if stop_str:
-                            pos = output.rfind(stop_str, len_prompt)
-                            # print(f"output:'{output}' prompt:{prompt} len_prompt:{len_prompt} stop_str:{stop_str} pos:{pos}")
-                            is_stop_str_found = (pos != -1)
-                            if is_stop_str_found:
-                                output = output[:pos]
-                                stopped = True
+        if prefix_kv_cache is not None:
+            prefix_kv_cache.release(prefix_node)
 
-                yield output
+        del past_key_values
 
-            if stopped:
+
+@torch.no_grad()
+def generate_chat_n_best(model, tokenizer, device, params, prompt, n, session_kv_cache=None, session_key=None,
+                         prefix_kv_cache=None, kv_block_manager=None):
+    """
+    プロンプトを1回だけ prefill し、そのKVキャッシュを n 本に複製して、n 個の回答を1つのバッチで decode する同期ジェネレータ
+
+    再生成やオフラインの評価で同じプロンプトに対する複数の回答が欲しい場合に、
+    回答ごとに会話履歴全体を prefill し直さずに済む。
+    すべての回答はプロンプトの長さが同じため、パディングと attention mask は不要で、
+    生成を終えた回答はKVキャッシュごとバッチから取り除く。
+
+    1ステップごとに、 n 個の生成済の文章(プロンプトは含まない)のリストを yield する。パラメータは process_chat と同じ
+
+    prefill では session_kv_cache, prefix_kv_cache を generate_chat と同様に再利用する。
+    どの回答が選ばれるかはまだ分からないため、セッションのKVキャッシュにはプロンプトぶんのみを保存する。
+    kv_block_manager を指定した場合は、プロンプトのKVキャッシュをブロックに1回だけ書き込み、そのブロックテーブルを n 本に fork する。
+    プロンプトのブロックは n 個の回答で共有し、途中まで埋まった最後のブロックだけが書き込み時にコピーされる(copy-on-write)
+
+    :param n: 生成する回答の数
+    """
+    config = create_generation_config(params, tokenizer)
+
+    input_ids = encode_prompt(tokenizer, prompt, config)
+
+    token_counts_list = [create_token_counts(input_ids, config) for _ in range(n)]
+    output_builders = [ChatOutputBuilder(tokenizer, input_ids, config) for _ in range(n)]
+
+    input_ids = truncate_input_ids(input_ids, config)
+
+    use_session_kv_cache = session_kv_cache is not None and session_key is not None
+
+    reuse_len, past_key_values = 0, None
+    if use_session_kv_cache:
+        reuse_len, past_key_values = session_kv_cache.take(session_key, input_ids)
+
+    prefix_node = None
+    if prefix_kv_cache is not None and reuse_len == 0:
+        reuse_len, past_key_values, prefix_node = prefix_kv_cache.match(input_ids)
+
+    # prefill は1回だけ行い、最終位置の logits とKVキャッシュを n 本に複製する
+    try:
+        out = model(input_ids=torch.as_tensor([input_ids[reuse_len:]], device=device),
+                    past_key_values=from_legacy_kv(past_key_values), use_cache=True)
+        prompt_key_values = to_legacy_kv(out.past_key_values)
+
+        if prefix_kv_cache is not None:
+            prefix_kv_cache.insert(input_ids, prompt_key_values)
+        if use_session_kv_cache:
+            session_kv_cache.put(session_key, list(input_ids), prompt_key_values)
+    finally:
+        if prefix_kv_cache is not None:
+            prefix_kv_cache.release(prefix_node)
+
+    last_token_logits = out.logits[:, -1].repeat(n, 1)
+
+    kv_tables = None  # KVBlockManager を使う場合の、回答ごとのブロックテーブル
+    if kv_block_manager is not None:
+        prompt_table = KVBlockTable()
+        try:
+            kv_block_manager.write(prompt_table, prompt_key_values)
+            kv_tables = [kv_block_manager.fork(prompt_table) for _ in range(n)]
+        finally:
+            kv_block_manager.free(prompt_table)
+        past_key_values = None
+    else:
+        past_key_values = tuple((key.repeat(n, 1, 1, 1), value.repeat(n, 1, 1, 1))
+                                for key, value in prompt_key_values)
+    del out, prompt_key_values
+
+    active = list(range(n))  # まだ生成中の回答の番号(バッチの行の順)
+    try:
+        while True:
+            token_ids = sample_next_tokens(last_token_logits, [config] * len(active),
+                                           [token_counts_list[index] for index in active], device)
+
+            remaining_rows = []
+            for row, (index, token_id) in enumerate(zip(active, token_ids)):
+                if token_counts_list[index] is not None:
+                    token_counts_list[index].add(token_id)
+                if not output_builders[index].append(token_id):
+                    remaining_rows.append(row)
+
+            yield [output_builder.text for output_builder in output_builders]
+
+            if not remaining_rows:
                 break
 
-    del past_key_values
+            if len(remaining_rows) < len(active):
+                # 生成を終えた回答をKVキャッシュごとバッチから取り除く
+                if kv_tables is not None:
+                    for row in set(range(len(active))) - set(remaining_rows):
+                        kv_block_manager.free(kv_tables[active[row]])
+                else:
+                    row_index = torch.as_tensor(remaining_rows, dtype=torch.long, device=past_key_values[0][0].device)
+                    past_key_values = tuple((key.index_select(0, row_index), value.index_select(0, row_index))
+                                            for key, value in past_key_values)
+                active = [active[row] for row in remaining_rows]
+                token_ids = [token_ids[row] for row in remaining_rows]
+
+            if kv_tables is not None:
+                # すべての回答は同じ長さなので、集めたKVキャッシュにパディングは入らない
+                past_key_values = kv_block_manager.gather([kv_tables[index] for index in active])[0]
+
+            out = model(input_ids=torch.as_tensor([[token_id] for token_id in token_ids], device=device),
+                        past_key_values=from_legacy_kv(past_key_values), use_cache=True)
+            last_token_logits = out.logits[:, -1]
+            past_key_values = to_legacy_kv(out.past_key_values)
+
+            if kv_tables is not None:
+                # 新たに入力したトークンぶんのKVキャッシュだけを、回答ごとのブロックに書き込む
+                for row, index in enumerate(active):
+                    kv_block_manager.write(kv_tables[index], tuple(
+                        (key[row:row + 1, :, -1:, :], value[row:row + 1, :, -1:, :]) for key, value in past_key_values))
+                past_key_values = None
+    finally:
+        if kv_tables is not None:
+            for kv_table in kv_tables:
+                kv_block_manager.free(kv_table)
+        del past_key_values
+
+
+async def process_chat_n_best(model, tokenizer, device, params, prompt, n, executor=None, session_kv_cache=None,
+                              session_key=None, prefix_kv_cache=None, kv_block_manager=None):
+    """
+    generate_chat_n_best を非同期ジェネレータとして実行する。 1ステップごとに n 個の生成済の文章のリストを yield する
+
+    :param executor: InferenceExecutor が指定された場合は、 forward とサンプリングを推論スレッドで実行する
+    """
+    generator = generate_chat_n_best(model, tokenizer, device, params, prompt, n, session_kv_cache=session_kv_cache,
+                                     session_key=session_key, prefix_kv_cache=prefix_kv_cache,
+                                     kv_block_manager=kv_block_manager)
+
+    if executor is not None:
+        async for outputs in executor.iterate(generator):
+            yield outputs
+        return
+
+    await asyncio.sleep(0)
+    for outputs in generator:
+        yield outputs
+        await asyncio.sleep(0)
+
+
+async def process_chat(model, tokenizer, device, params, prompt, executor=None, session_kv_cache=None,
+                       session_key=None, prefix_kv_cache=None, kv_block_manager=None, speculative_decoder=None,
+                       prompt_lookup_decoder=None, compiled_decoder=None):
+    """
+    指定された生成条件によって、文章生成を行う。
+    
+    事前学習済言語モデルによる並行トークン生成（非同期タスク）に対応。
+
+    【文章生成について】
+    文章生成は条件(params)によってモデルによる逐次文章生成をコントロールする
+    また、停止ワードや停止トークンを監視し、必要なタイミングで文章生成を停止させる
+
+    【複数のリクエストの並行処理について】
+    FastAPIは非同期I/Oをサポートしており、これは複数のリクエストを並行に処理する能力がある。
+    FastAPI（というかPythonの）非同期I/Oは、コルーチンと呼ばれる特殊な関数を使用して並行性を実現している。
+    この場合の並行性とは、一度に一つのタスクだけが進行するが、I/O操作（HTTPリクエスト、モデルからのトークンの生成など）を待つ間に他のタスクを進行させることができる
+    ということ。この形式を"協調的マルチタスク"を呼ぶ。
+    それぞれのリクエストは別の「非同期タスク」として処理され、これらのタスクは同じスレッド上で切り替えられる。
+    「非同期タスク」においては複数のリクエストに対するモデルへのアクセスが並行しているように見えるが
+    実際にはある瞬間に一つのリクエストだけがモデルを利用している。
+    そのため、それぞれのリクエストが　モデルによるトークン生成のためにブロックする期間は限られており、
+    逐次出力トークンの生成について言えば、１つ新トークンを生成した後で他のリクエストに制御を戻すことができる。
+    そのために、本メソッド内のforループ内で１つトークンを生成する毎に await asyncio.sleep(0) を呼び出し、
+    他のタスクが進行できる（制御を移す）チャンスを与えるようにしている。
+    そのため、一つのリクエストによる文章生成の際、停止トークン、停止文字列が現れるまでの間、
+    他の全てのリクエストがブロックされることはなく、各リクエストはモデルからのトークンを逐次生成しながら、
+    他のリクエストも進行させることができる。
+
+    【推論スレッドについて】
+    ただし上記の方式では、 forward を実行している間(特に長いプロンプトの prefill 中)はイベントループ自体がブロックされる。
+    executor(InferenceExecutor) を指定すると、 forward とサンプリングは推論スレッドで実行され、
+    イベントループ側は生成された文章を受け取るだけとなるため、他の Web API やストリームの送出が止まらない。
+
+
+     :param model: 
+     :param tokenizer: 
+     :param device: 
+     :param params: 
+        paramsの例
+             {
+    "temperature": 0.7,  # Temperatureの値
+                             "max_new_tokens": 256,  # 新たに生成する最大トークンサイズ（何トークン分か。)
+                             "context_len": 1024,  # コンテクストのサイズ（何トークン分か。)
+                             "use_top_k_sampling": True,  # True: top K サンプリングを有効にする
+                             "top_k_value": 50,  # top K サンプリングの値。
+                             "use_top_p_sampling": True,  # True: top P サンプリングを有効にする
+                             "top_p_value": 0.7,  # top P サンプリングの値
+                             "use_repetition_penalty": False,  # True:繰り返し同じトークンを生成したときのペナルティを有効する
+                             "repetition_penalty": 1,  # ペナルティの値
+                             "repetition_penalty_method": "multiplicative",  # ペナルティの計算方法
+                             "use_prompt_lookup": False  # True: 会話履歴の n-gram から先読みする投機的デコーディングを使う
+             },     
+     :param prompt: プロンプト文字列、またはトークンIDのリスト(create_prompt_input_ids で組み立てたもの)
+     :param executor: InferenceExecutor が指定された場合は、 forward とサンプリングを推論スレッドで実行する
+     :param session_kv_cache: SessionKVCache が指定された場合は、前回のターンのKVキャッシュを再利用する
+     :param session_key: セッションを識別するキー(session_kv_cache のキー)
+     :param prefix_kv_cache: PrefixKVCache が指定された場合は、他のリクエストと共通のプレフィックスのKVキャッシュを再利用する
+     :param kv_block_manager: KVBlockManager が指定された場合は、ステップ間のKVキャッシュをブロックのプールに保持する
+     :param speculative_decoder: SpeculativeDecoder が指定された場合は、ドラフトモデルによる投機的デコーディングで生成する
+     :param prompt_lookup_decoder: PromptLookupDecoder 。 params の use_prompt_lookup が True の場合に使用する
+     :param compiled_decoder: CompiledDecoder が指定された場合は、静的なKVキャッシュとコンパイル済の decode ステップで生成する
+
+    """
+    generator = generate_chat(model, tokenizer, device, params, prompt,
+                              session_kv_cache=session_kv_cache, session_key=session_key,
+                              prefix_kv_cache=prefix_kv_cache, kv_block_manager=kv_block_manager,
+                              speculative_decoder=speculative_decoder, prompt_lookup_decoder=prompt_lookup_decoder,
+                              compiled_decoder=compiled_decoder)
+
+    if executor is not None:
+        # forward とサンプリングは推論スレッドで実行し、生成された文章のみイベントループ側で受け取る
+        async for output in executor.iterate(generator):
+            yield output
+        return
+
+    # Insert asyncio.sleep(0) here to yield control after each token is generated
+    await asyncio.sleep(0)
+    for output in generator:
+        yield output
+        await asyncio.sleep(0)
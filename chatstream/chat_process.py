@@ -1,25 +1,142 @@
+import json
 from typing import Generator
 
 from .chat_prompt import AbstractChatPrompt
-from .chat_core import process_chat
+from .chat_core import process_chat, process_chat_n_best, get_max_input_len
 from .default_finish_token import DEFAULT_FINISH_TOKEN
 from .merge_dic import merge_dict
-import asyncio
+from .response_cache import is_deterministic, ResponseRecorder, replay_diffs
 
 from tokflow import TokFlow
 
 UPDATE_RESPONDER_TOKEN_ONE_BY_ONE = True  # True:トークンが1件生成されるたびに、履歴(chat_prompt) を更新する
 
+# ウォームアップのプロンプトに繰り返し使う文章
+WARMUP_TEXT = "The quick brown fox jumps over the lazy dog. "
+
 condition_for_updated_text = {"in_type": "spot", "out_type": "spot"}
 condition_for_response_text = {"in_type": "full", "out_type": "full"}
 
 
+class RewrittenText(str):
+    """
+    生成済の文章の末尾が書き換わり(出力の置換や、マルチバイト文字のデコードのやり直しなど)、
+    直前の文章への差分として表せない場合に、 updated_text の代わりに yield する生成済の文章全体
+    """
+
+
 class ChatGenerator:
-    def __init__(self, model, tokenizer, device, params):  # , chat_mode):
+    def __init__(self, model, tokenizer, device, params, batch_engine=None, executor=None,
+                 worker_pool=None, session_kv_cache=None, prefix_kv_cache=None,
+                 kv_block_manager=None, speculative_decoder=None, prompt_lookup_decoder=None,
+                 truncate_history_by_turns=True, build_prompt_from_token_ids=False,
+                 compiled_decoder=None, response_cache=None, model_id=None):  # , chat_mode):
         self.model = model
         self.tokenizer = tokenizer
         self.device = device
         self.params = params
+        self.batch_engine = batch_engine  # ChatBatchEngine が指定された場合は、複数リクエストをまとめてバッチ生成する
+        self.executor = executor  # InferenceExecutor が指定された場合は、推論スレッドで forward を実行する
+        self.worker_pool = worker_pool  # ModelWorkerPool が指定された場合は、モデルワーカープロセスで文章生成する
+        self.session_kv_cache = session_kv_cache  # SessionKVCache が指定された場合は、前回のターンのKVキャッシュを再利用する
+        self.prefix_kv_cache = prefix_kv_cache  # PrefixKVCache が指定された場合は、リクエスト間で共通のプレフィックスを再利用する
+        self.kv_block_manager = kv_block_manager  # KVBlockManager が指定された場合は、KVキャッシュをブロックのプールに保持する
+        self.speculative_decoder = speculative_decoder  # SpeculativeDecoder が指定された場合は、投機的デコーディングで生成する
+        self.prompt_lookup_decoder = prompt_lookup_decoder  # 生成パラメータの use_prompt_lookup が True の場合に使う
+        self.truncate_history_by_turns = truncate_history_by_turns  # True: コンテクストに収まるよう古いターンから丸ごと取り除く
+        self.build_prompt_from_token_ids = build_prompt_from_token_ids  # True: メッセージごとにキャッシュしたトークンIDを連結してプロンプトとする
+        self.compiled_decoder = compiled_decoder  # CompiledDecoder が指定された場合は、コンパイル済の decode ステップで生成する
+        self.response_cache = response_cache  # ResponseCache が指定された場合は、 greedy に生成した文章を同じリクエストに使いまわす
+        self.model_id = model_id  # ResponseCache のキーに使うモデルのID。 None の場合はモデルの設定から求める
+
+    def supports_n_best(self):
+        """
+        1回の prefill から n 個の回答を生成できるかどうか
+
+        n 個の回答のバッチはこのプロセスのモデルで直接 decode するため、
+        モデルワーカープロセス・継続バッチングを使う場合は対応しない
+        """
+        return self.model is not None and self.worker_pool is None and self.batch_engine is None
+
+    def generate_from_prompt(self, process_params, prompt, session_key=None, n=1):
+        """
+        組み立て済のプロンプトから、設定に応じた経路(モデルワーカープロセス・バッチ生成・ process_chat)で文章生成する
+
+        :param process_params: 生成パラメータ
+        :param prompt: プロンプト文字列、またはトークンIDのリスト
+        :param session_key: KVキャッシュを再利用するためのセッションのキー
+        :param n: 生成する回答の数。 2 以上の場合は process_chat_n_best で生成し、 n 個の文章のリストを yield する
+        :return: 生成済の文章を逐次 yield する非同期ジェネレータ
+        """
+        # process_chat() は async 関数で、非同期ジェネレータを返す
+        # 非同期ジェネレータを使用する場合は async for を用いて結果を順次取得するため、以下呼出しでの await は不要となる。
+        if n > 1:
+            return process_chat_n_best(self.model, self.tokenizer, self.device, process_params, prompt, n,
+                                       executor=self.executor, session_kv_cache=self.session_kv_cache,
+                                       session_key=session_key, prefix_kv_cache=self.prefix_kv_cache,
+                                       kv_block_manager=self.kv_block_manager)
+        if self.worker_pool is not None:
+            return self.worker_pool.generate(process_params, prompt)
+        if self.batch_engine is not None:
+            return self.batch_engine.generate(process_params, prompt, session_key=session_key)
+        return process_chat(self.model, self.tokenizer, self.device, process_params, prompt,
+                            executor=self.executor, session_kv_cache=self.session_kv_cache,
+                            session_key=session_key, prefix_kv_cache=self.prefix_kv_cache,
+                            kv_block_manager=self.kv_block_manager,
+                            speculative_decoder=self.speculative_decoder,
+                            prompt_lookup_decoder=self.prompt_lookup_decoder,
+                            compiled_decoder=self.compiled_decoder)
+
+    def get_model_id(self):
+        """
+        ResponseCache のキーに使うモデルのID
+        """
+        if self.model_id is not None:
+            return self.model_id
+        if self.model is None:
+            return None
+        config = getattr(self.model, "config", None)
+        return getattr(config, "_name_or_path", None) or type(self.model).__name__
+
+    async def generate_with_response_cache(self, process_params, prompt, session_key=None, n=1):
+        """
+        generate_from_prompt と同じく生成済の文章を逐次 yield する。
+        同じモデル・プロンプト・生成パラメータ(と回答の数)で生成し終えた文章が ResponseCache にある場合は、推論を行わずにそれを yield しなおす
+        """
+        # キーをつくるためだけにプロンプトをトークン化しなおさないよう、組み立て済のプロンプトをそのままハッシュする
+        key_params = process_params if n == 1 else merge_dict(process_params, {"n": n})
+        key = self.response_cache.create_key(self.get_model_id(), prompt, key_params)
+
+        diffs = self.response_cache.get(key)
+        if diffs is not None:
+            for output in replay_diffs(diffs):
+                yield output
+            return
+
+        recorder = ResponseRecorder()
+        async_generator = self.generate_from_prompt(process_params, prompt, session_key=session_key, n=n)
+        try:
+            async for output in async_generator:
+                recorder.append(output)
+                yield output
+        finally:
+            await async_generator.aclose()
+
+        # 最後まで生成し終えた場合のみ保持する(途中で打ち切った場合はここまで来ない)
+        self.response_cache.put(key, recorder.diffs)
+
+    def create_warmup_prompt(self, prompt_len):
+        """
+        ウォームアップ用の、およそ prompt_len トークンのプロンプトをつくる
+
+        トークナイザがある場合は prompt_len トークンちょうどのトークンIDのリスト、
+        無い場合(モデルワーカープロセスで生成する場合)は1単語がおよそ1トークンとなる文字列とする
+        """
+        if self.tokenizer is None:
+            return " ".join(["hello"] * prompt_len)
+
+        token_ids = self.tokenizer.encode(WARMUP_TEXT)
+        return (token_ids * (prompt_len // len(token_ids) + 1))[:prompt_len]
 
     async def generate(self, chat_prompt: AbstractChatPrompt, opts: dict = {}) -> Generator:
         """
@@ -36,29 +153,42 @@ class ChatGenerator:
             opts={"output_type":"updated_text"} とすると、新規生成されたトークンのみ yield する。コンソールチャットではこちらが向いている。
             opts={"output_type":"response_text"} とすると、新規されたトークンを結合した文章のみ yield する。ブラウザでの表示やマルチバイトの表示にはこちらが向いている。
             
+            updated_text は直前の出力からの差分だが、生成済の文章の末尾が書き換わり差分で表せない場合は、
+            代わりに生成済の文章全体を RewrittenText として yield する。
+
             output_type が無指定の場合は (response_text,updated_text,pos) のタプルが yieldされる。
                 
                 pos の意味: 生成されたトークンが文章全体においてどの位置にあるかを表す。これにより文頭、文末の処理を行う
                     pos="begin" ・・・現在の chat_prompt によって生成された最初のトークンである
                     pos="mid" ・・・現在の chat_prompt によって生成された中間のトークンである
                     pos="end" ・・・現在の chat_prompt によって生成された最後のトークンである。つまり文末。
+
+            opts={"session_key":"..."} とすると、そのキーで SessionKVCache に前回のターンのKVキャッシュを保存・再利用する。
+
+            opts={"n": n} (n>=2) とすると、プロンプトを1回だけ prefill して n 個の回答を1つのバッチで生成する。
+            response_text, updated_text はそれぞれ回答ごとの文章を {"alternatives": [回答, ...]} とした JSON 文字列となり、
+            output_type ごとの yield の形式は n=1 の場合と同じ。会話履歴には最初の回答を書き込み、すべての回答を alternatives として保持する。
+            supports_n_best() が False の場合は ValueError とする。
         
         :return: 
         """
 
         output_replacement = chat_prompt.get_replacement_when_output()  # 出力の置換
 
+        tflow_for_updated_text = None
+        tflow_for_response_text = None
+
         if output_replacement is not None:
             tflow_for_updated_text = TokFlow(output_replacement)
             tflow_for_response_text = TokFlow(output_replacement)
 
-        prompt = chat_prompt.create_prompt()  # これまでの会話履歴を含んだプロンプトを生成する
-
         otype = opts.get("output_type", None)
         generated_message_id = opts.get("message_id", None)  # 生成された文章を識別するためのid
 
         post_process_callback = opts.get("post_process_callback", None)
 
+        session_key = opts.get("session_key", None)  # KVキャッシュを再利用するためのセッションのキー
+
         if chat_prompt.is_chat_mode_enabled():
             stop_strs = chat_prompt.get_stop_strs()
         else:
@@ -70,9 +200,32 @@ class ChatGenerator:
         generation_params = opts.get("generation_params", {})
         process_params = merge_dict(self.params, generation_params)
 
-        # process_chat() は async 関数で、非同期ジェネレータを返す
-        # 非同期ジェネレータを使用する場合は async for を用いて結果を順次取得するため、以下呼出しでの await は不要となる。
-        async_generator = process_chat(self.model, self.tokenizer, self.device, process_params, prompt)
+        prompt_opts = {}
+        if self.truncate_history_by_turns and self.tokenizer is not None:
+            # コンテクストに収まらない古いターンは、トークン化する前に丸ごと取り除く
+            prompt_opts = {"tokenizer": self.tokenizer, "max_tokens": get_max_input_len(process_params)}
+
+        prompt = None
+        if self.build_prompt_from_token_ids and self.tokenizer is not None:
+            # 会話履歴全体をトークン化し直さず、メッセージごとにキャッシュしたトークンIDを連結する(対応していない場合は None)
+            prompt = chat_prompt.create_prompt_input_ids(self.tokenizer, prompt_opts)
+
+        if prompt is None:
+            prompt = chat_prompt.create_prompt(prompt_opts)  # これまでの会話履歴を含んだプロンプトを生成する
+
+        num_alternatives = opts.get("n", 1) or 1  # 生成する回答の数
+        if num_alternatives > 1:
+            if not self.supports_n_best():
+                raise ValueError("'n' > 1 is not supported with model workers or continuous batching")
+            async for output in self._generate_n_best(chat_prompt, process_params, prompt, num_alternatives, opts):
+                yield output
+            return
+
+        if self.response_cache is not None and is_deterministic(process_params):
+            # greedy に生成する場合は、同じリクエストに対して生成し終えた文章を使いまわす
+            async_generator = self.generate_with_response_cache(process_params, prompt, session_key=session_key)
+        else:
+            async_generator = self.generate_from_prompt(process_params, prompt, session_key=session_key)
 
         prev = ""
 
@@ -84,53 +237,32 @@ class ChatGenerator:
                 pos = "begin"
 
             if chat_prompt.is_chat_mode_enabled():
-
-                if UPDATE_RESPONDER_TOKEN_ONE_BY_ONE:
-                    # AIが生成したトークンを生成されたタイミングで逐次 chat_prompt の履歴に反映する設定のとき
-                    #
-                    # "USER:東京の首都は？ AI:それは、東京です" という文章生成タスクの場合
-                    # 最終的に yield したい response_text は "それは、東京です" の部分となる。
-                    #
-                    # そこで、 "USER:東京の首都は？ AI:それは、東京です" から  "それは、東京です"　をスライスするために、
-                    #  "USER:東京の首都は？ AI:" の部分の長さを特定する。
-
-                    # ここで、UPDATE_RESPONDER_TOKEN_ONE_BY_ONE=True の場合、
-                    # AIが生成したトークンを順次 chat_prompt 会話履歴に反映していくため
-                    # chat_prompt.create_prompt すると、
-                    # トークンの逐次生成において以下のように逐次履歴が成長する。
-                    #
-                    # "USER:東京の首都は？ AI:そ"
-                    # "USER:東京の首都は？ AI:それ"
-                    # "USER:東京の首都は？ AI:それは、"
-                    #
-                    #
-                    # そこで、 "USER:東京の首都は？ AI:" の部分をスライスするために、omit_last_message=True を指定して、
-                    # 最後のメッセージ部分(つまり、このターンだと "それは、") を省略したぶんの長さ(skip_len) を取得し、
-                    # "USER:東京の首都は？ AI:それは、"　から "USER:東京の首都は？ AI:" をスライスして "それは、" を残して
-                    # response_text にセットする
-                    #
-                    # 他方　UPDATE_RESPONDER_TOKEN_ONE_BY_ONE=False の場合は、
-                    # 会話履歴は成長しないので、response_text[chat_prompt.get_skip_len():]が常に
-                    # "USER:東京の首都は？ AI" をあらわす。
-                    response_text = response_text[chat_prompt.get_skip_len(omit_last_message=True):].strip()
-                else:
-                    response_text = response_text[chat_prompt.get_skip_len():].strip()
+                # process_chat はプロンプトを含まない生成済の文章のみを yield するため、
+                # 会話履歴(プロンプト)の長さを求めてスライスする必要はない
+                response_text = response_text.strip()
             else:
-                # response_text = response_text[len(prompt):].strip()
-                pass
+                # チャットモードでない場合は、従来どおりプロンプトに続けて生成された文章を返す
+                response_text = prompt + response_text
 
+            rewritten = not response_text.startswith(prev)  # 直前の文章に追加したものになっていない場合
             updated_text = response_text[len(prev):]
 
             updated_text_to_disp = updated_text
             response_text_to_disp = response_text
 
             # tokflow 処理が必要な場合はバッファリングしたものをセットする
-            if tflow_for_updated_text is not None:
+            if tflow_for_updated_text is not None and not rewritten:
                 updated_text_to_disp = tflow_for_updated_text.put(updated_text, condition_for_updated_text)
 
             if tflow_for_response_text is not None:
                 response_text_to_disp = tflow_for_response_text.put(response_text, condition_for_response_text)
 
+            if rewritten:
+                # 差分では表せないため、生成済の文章全体を送りなおす
+                updated_text_to_disp = RewrittenText(response_text_to_disp)
+                if tflow_for_updated_text is not None:
+                    tflow_for_updated_text = TokFlow(output_replacement)
+
             if otype == "updated_text":
                 yield updated_text_to_disp
             elif otype == "response_text":
@@ -138,7 +270,6 @@ class ChatGenerator:
             else:
                 yield response_text_to_disp + DEFAULT_FINISH_TOKEN, updated_text_to_disp, pos
 
-            await asyncio.sleep(0.01)  # わずかな遅延を発生させ、逐次返信となるようにする
             prev = response_text
 
             if UPDATE_RESPONDER_TOKEN_ONE_BY_ONE:
@@ -167,7 +298,7 @@ class ChatGenerator:
             # tokflow 内に未出力のバッファが存在する可能性があるため flush する
             updated_text_to_disp = tflow_for_updated_text.flush(condition_for_updated_text)
         else:
-            updated_text_to_disp = updated_text
+            updated_text_to_disp = ""  # 差分はすべて出力済
 
         if tflow_for_response_text is not None:
             # tokflow 内に未出力のバッファが存在する可能性があるため flush する
@@ -186,3 +317,95 @@ class ChatGenerator:
         if post_process_callback is not None:
             # 逐次出力がすべて終了したので、成功をコールバックする
             await post_process_callback("success")
+
+    async def _generate_n_best(self, chat_prompt, process_params, prompt, n, opts):
+        """
+        プロンプトを1回だけ prefill し、 n 個の回答を1つのバッチで生成する(opts の n が 2 以上の場合)
+
+        n 個の回答をまとめた1つのストリームとして、回答ごとの文章を {"alternatives": [...]} の JSON にして generate と同じ形式で yield する
+        """
+        otype = opts.get("output_type", None)
+        generated_message_id = opts.get("message_id", None)
+        post_process_callback = opts.get("post_process_callback", None)
+        session_key = opts.get("session_key", None)
+
+        output_replacement = chat_prompt.get_replacement_when_output()  # 出力の置換
+        tflows_for_updated_text = None
+        tflows_for_response_text = None
+        if output_replacement is not None:
+            tflows_for_updated_text = [TokFlow(output_replacement) for _ in range(n)]
+            tflows_for_response_text = [TokFlow(output_replacement) for _ in range(n)]
+
+        def to_json(texts):
+            return json.dumps({"alternatives": texts}, ensure_ascii=False)
+
+        def to_output(response_texts, updated_texts, pos):
+            # 差分で表せない場合は、 updated_texts はすでに生成済の文章全体の RewrittenText となっている
+            updated_text = updated_texts if isinstance(updated_texts, RewrittenText) else to_json(updated_texts)
+            if otype == "updated_text":
+                return updated_text
+            elif otype == "response_text":
+                return to_json(response_texts) + DEFAULT_FINISH_TOKEN
+            else:
+                return to_json(response_texts) + DEFAULT_FINISH_TOKEN, updated_text, pos
+
+        if self.response_cache is not None and is_deterministic(process_params):
+            async_generator = self.generate_with_response_cache(process_params, prompt, session_key=session_key, n=n)
+        else:
+            async_generator = self.generate_from_prompt(process_params, prompt, session_key=session_key, n=n)
+
+        prevs = [""] * n
+        response_texts = [""] * n
+
+        index = 0
+        async for texts in async_generator:
+            pos = "mid"
+            if index == 0:
+                pos = "begin"
+
+            if chat_prompt.is_chat_mode_enabled():
+                response_texts = [text.strip() for text in texts]
+            else:
+                response_texts = [prompt + text for text in texts]
+
+            rewritten = not all(text.startswith(prev) for text, prev in zip(response_texts, prevs))
+            updated_texts = [text[len(prev):] for text, prev in zip(response_texts, prevs)]
+
+            updated_texts_to_disp = updated_texts
+            response_texts_to_disp = response_texts
+            if tflows_for_updated_text is not None:
+                if not rewritten:
+                    updated_texts_to_disp = [tflow.put(text, condition_for_updated_text)
+                                             for tflow, text in zip(tflows_for_updated_text, updated_texts)]
+                response_texts_to_disp = [tflow.put(text, condition_for_response_text)
+                                          for tflow, text in zip(tflows_for_response_text, response_texts)]
+
+            if rewritten:
+                # いずれかの回答が差分では表せないため、 updated_text はすべての回答の生成済の文章全体とする
+                updated_texts_to_disp = RewrittenText(to_json(response_texts_to_disp))
+                if tflows_for_updated_text is not None:
+                    tflows_for_updated_text = [TokFlow(output_replacement) for _ in range(n)]
+
+            yield to_output(response_texts_to_disp, updated_texts_to_disp, pos)
+
+            prevs = response_texts
+
+            # 途中で切断された場合でも、そこまでの回答を会話履歴に残す
+            chat_prompt.set_responder_last_alternatives(response_texts)
+            if generated_message_id:
+                chat_prompt.set_responder_last_msg_id(generated_message_id)
+
+            index += 1
+
+        # 最後は、まだ出力していない差分(tokflow のバッファ)のみを出力する
+        if tflows_for_updated_text is not None:
+            updated_texts_to_disp = [tflow.flush(condition_for_updated_text) for tflow in tflows_for_updated_text]
+            response_texts_to_disp = [tflow.flush(condition_for_response_text) for tflow in tflows_for_response_text]
+        else:
+            updated_texts_to_disp = [""] * n
+            response_texts_to_disp = response_texts
+
+        yield to_output(response_texts_to_disp, updated_texts_to_disp, "end")
+
+        if post_process_callback is not None:
+            await post_process_callback("success")
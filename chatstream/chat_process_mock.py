@@ -15,6 +15,9 @@ class ChatGeneratorMock:
         self.device = device
         self.params = params
 
+    def supports_n_best(self):
+        return False
+
     async def generate(self, chat_prompt, opts={}):
         try:
 
@@ -1,5 +1,22 @@
 from abc import ABC, abstractmethod
 import uuid
+import weakref
+
+
+def encode_with_cache(cache, tokenizer, text):
+    """
+    text をトークンIDに変換する。 cache が同じトークナイザ・同じ文字列で変換した結果であればそれを使う
+
+    ModelRegistry で会話の途中に別のモデルへ切り替わった場合は、同じ文字列でもトークンIDが異なるため、
+    キャッシュにはトークナイザへの弱参照も含める(会話履歴がアンロードされたモデルのトークナイザを保持し続けないよう、弱参照とする)
+
+    :param cache: 前回の (トークナイザへの弱参照, 文字列, トークンID) 。無い場合は None
+    :return: (新しい cache, トークンID)
+    """
+    if cache is not None and cache[0]() is tokenizer and cache[1] == text:
+        return cache, cache[2]
+    token_ids = tokenizer.encode(text, add_special_tokens=False)
+    return (weakref.ref(tokenizer), text, token_ids), token_ids
 
 
 class ChatContent:
@@ -7,6 +24,8 @@ class ChatContent:
         self.role = role
         self.message = msg
         self.message_id = None
+        self.token_ids_cache = None  # (トークナイザへの弱参照, プロンプト文字列, トークンID) 同じ文字列を毎ターントークン化し直さないためのキャッシュ
+        self.alternatives = None  # n 個の回答を生成した場合の、すべての回答(message はそのうち選ばれたもの)
 
     def get_role(self):
         return self.role
@@ -30,11 +49,39 @@ class ChatContent:
 
     def set_message(self, msg: str):
         """
-        メッセージをセットする
+        メッセージをセットする(編集・再生成されたメッセージのトークンIDのキャッシュは破棄する)
         :param msg:
         :return:
         """
         self.message = msg
+        self.token_ids_cache = None
+
+    def set_alternatives(self, alternatives):
+        """
+        n 個の回答を生成した場合に、すべての回答をセットする
+        """
+        self.alternatives = alternatives
+
+    def get_alternatives(self):
+        return self.alternatives
+
+    def get_token_ids(self, tokenizer, text):
+        """
+        このメッセージのプロンプト文字列(ロール名・区切り文字を含む)をトークンIDに変換する
+        同じトークナイザ・同じ文字列に対しては前回変換した結果を返す
+
+        :param tokenizer: トークナイザ
+        :param text: このメッセージのプロンプト文字列
+        :return: トークンIDのリスト
+        """
+        self.token_ids_cache, token_ids = encode_with_cache(self.token_ids_cache, tokenizer, text)
+        return token_ids
+
+    def get_num_tokens(self, tokenizer, text):
+        """
+        このメッセージのプロンプト文字列(ロール名・区切り文字を含む)のトークン数を取得する
+        """
+        return len(self.get_token_ids(tokenizer, text))
 
     def __dict__(self):
         return {"role": self.role, "message": self.message, "message_id": self.message_id}
@@ -57,6 +104,7 @@ class AbstractChatPrompt(ABC):
         self.requester = ""
         self.responder = ""
         self.chat_mode = True
+        self.system_token_ids_cache = None  # (トークナイザへの弱参照, system, トークンID)
 
     def get_contents(self, opts={}):
         """
@@ -64,11 +112,15 @@ class AbstractChatPrompt(ABC):
         :param opts:
         "omit_last_message":True の場合、最新のメッセージは会話履歴に含めないで返す
         "to_message_id": ここにメッセージID を指定すると、そのメッセージIDまでの会話履歴を返す
+        "max_tokens": ここにトークン数を指定すると、system とあわせてこのトークン数に収まるよう、古いターンから丸ごと取り除いて返す
+                      (トークン数を数えるため "tokenizer" もあわせて指定する)
         :return:
         """
 
         omit_last_message = opts.get("omit_last_message", False)
         to_message_id = opts.get("to_message_id", None)
+        max_tokens = opts.get("max_tokens", None)
+        tokenizer = opts.get("tokenizer", None)
 
         list = []
         for idx, chat_content in enumerate(self.chat_contents):
@@ -85,10 +137,97 @@ class AbstractChatPrompt(ABC):
             if to_message_id is not None:
                 message_id = chat_content.get_message_id()
                 if to_message_id == message_id:
-                    return list  # to_message_id が検出されたらそこで出力終了
+                    break  # to_message_id が検出されたらそこで出力終了
+
+        if max_tokens is not None and tokenizer is not None:
+            list = self.truncate_contents(list, tokenizer, max_tokens)
 
         return list
 
+    def truncate_contents(self, chat_contents, tokenizer, max_tokens):
+        """
+        system とあわせて max_tokens に収まるよう、古いターンから丸ごと取り除く
+
+        先頭からトークン列を切り詰めると system やロール名の途中で切れてしまうため、
+        ターン(ユーザーのメッセージから次のユーザーのメッセージの前まで)単位で取り除く。
+        トークン数は新しいターンから順に数え、収まらなくなった時点で打ち切るため、取り除かれるメッセージはトークン化しない。
+        最新のターンは収まらない場合でも残す(その場合はトークン列の先頭が切り詰められる)
+
+        get_chat_content_text を実装していない場合は切り詰めない
+
+        :param chat_contents: 会話履歴のリスト
+        :param tokenizer: トークナイザ
+        :param max_tokens: プロンプト全体(system を含む)の最大トークン数
+        :return: 切り詰めた会話履歴のリスト
+        """
+        if not chat_contents or self.get_chat_content_text(chat_contents[-1]) is None:
+            return chat_contents
+
+        # ユーザーのメッセージで始まるターンごとに分ける
+        turns = []
+        for chat_content in chat_contents:
+            if not turns or chat_content.get_role() == self.requester:
+                turns.append([])
+            turns[-1].append(chat_content)
+
+        budget = max_tokens - self.get_system_num_tokens(tokenizer)
+        num_kept_contents = 0
+        for idx, turn in enumerate(reversed(turns)):
+            num_tokens = sum(chat_content.get_num_tokens(tokenizer, self.get_chat_content_text(chat_content))
+                             for chat_content in turn)
+            if idx > 0 and num_tokens > budget:
+                break
+            budget -= num_tokens
+            num_kept_contents += len(turn)
+
+        return chat_contents[len(chat_contents) - num_kept_contents:]
+
+    def get_system_token_ids(self, tokenizer):
+        """
+        system をトークンIDに変換する(system とトークナイザが変わるまでは前回の結果を返す)
+        """
+        if not self.system:
+            return []
+        self.system_token_ids_cache, token_ids = encode_with_cache(self.system_token_ids_cache, tokenizer, self.system)
+        return token_ids
+
+    def get_system_num_tokens(self, tokenizer):
+        """
+        system のトークン数を取得する
+        """
+        return len(self.get_system_token_ids(tokenizer))
+
+    def create_prompt_input_ids(self, tokenizer, opts={}):
+        """
+        create_prompt の代わりに、プロンプトをトークンIDのリストとして直接組み立てる
+
+        system と各メッセージのトークンIDはそれぞれキャッシュしておき、それらを連結して組み立てるため、
+        毎ターン会話履歴全体をトークン化し直さなくてよい。
+        メッセージごとに別々にトークン化するため、プロンプト全体を一度にトークン化した場合とは
+        メッセージの境界でトークン列が異なる場合がある
+
+        :param tokenizer: トークナイザ
+        :param opts: get_contents と同じオプション
+        :return: トークンIDのリスト。チャットモードでない場合、 get_chat_content_text を実装していない場合は None
+        """
+        if not self.chat_mode or self.get_chat_content_text(ChatContent(role=self.requester)) is None:
+            return None
+
+        input_ids = list(self.get_system_token_ids(tokenizer))
+        for chat_content in self.get_contents(opts):
+            input_ids += chat_content.get_token_ids(tokenizer, self.get_chat_content_text(chat_content))
+        return input_ids
+
+    def get_chat_content_text(self, chat_content):
+        """
+        会話履歴の1メッセージぶんのプロンプト文字列(ロール名・区切り文字を含む)を返す
+
+        create_prompt で system に続けて連結される文字列と同じものを返すように実装すると、
+        get_contents の "max_tokens" によるターン単位の切り詰めが有効になる。
+        実装しない場合(None を返す場合)は切り詰めない
+        """
+        return None
+
     def find_chat_content_by_message_id(self, message_id):
         """
         メッセージIDで chat_content を検索する
@@ -197,6 +336,28 @@ class AbstractChatPrompt(ABC):
         self.responder_messages[-1].set_message_id(message_id)
         self.chat_contents[-1].set_message_id(message_id)
 
+    def set_responder_last_alternatives(self, alternatives):
+        """
+        AI 側の最新メッセージとして生成した n 個の回答をセットする。最初の回答を会話履歴に使う
+        """
+        self.set_responder_last_msg(alternatives[0])
+        self.chat_contents[-1].set_alternatives(alternatives)
+
+    def select_responder_alternative(self, message_id, index):
+        """
+        n 個の回答を生成したメッセージについて、 index 番目の回答を会話履歴に書き戻す
+
+        :return: 書き戻した場合は True 。メッセージが見つからないか、 index が範囲外の場合は False
+        """
+        chat_content = self.find_chat_content_by_message_id(message_id)
+        if chat_content is None or chat_content.get_alternatives() is None:
+            return False
+        alternatives = chat_content.get_alternatives()
+        if not isinstance(index, int) or not 0 <= index < len(alternatives):
+            return False
+        chat_content.set_message(alternatives[index])
+        return True
+
     def _add_msg(self, chat_content_obj):
         # チャットメッセージリストに追加
         self.chat_contents.append(chat_content_obj)
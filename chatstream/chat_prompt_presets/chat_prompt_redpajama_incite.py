@@ -29,17 +29,20 @@ class ChatPromptTogetherRedPajamaINCITEChat(AbstractChatPrompt):
 
         ret = self.system;
         for chat_content in self.get_contents(opts):
-            chat_content_role = chat_content.get_role()
-            chat_content_message = chat_content.get_message()
-            if chat_content_role:
-                if chat_content_message:
-                    merged_message = chat_content_role + ": " + chat_content_message + "\n"
-                else:
-                    merged_message = chat_content_role + ":"
-                ret += merged_message
+            ret += self.get_chat_content_text(chat_content)
 
         return ret
 
+    def get_chat_content_text(self, chat_content):
+        chat_content_role = chat_content.get_role()
+        chat_content_message = chat_content.get_message()
+        if not chat_content_role:
+            return ""
+        if chat_content_message:
+            return chat_content_role + ": " + chat_content_message + "\n"
+        else:
+            return chat_content_role + ":"
+
     def build_initial_prompt(self, chat_prompt):
         pass
         # If you want a common initial prompt for instructions, override this method and implement
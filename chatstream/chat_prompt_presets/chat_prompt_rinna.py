@@ -29,20 +29,21 @@ class ChatPromptRinnaJapaneseGPTNeoxInst(AbstractChatPrompt):
         # Chat Mode == True の場合のプロンプトを構築する
         ret = self.system;
         for chat_content in self.get_contents(opts):
+            ret += self.get_chat_content_text(chat_content)
 
-            chat_content_role = chat_content.get_role()
-            chat_content_message = chat_content.get_message()
-
-            if chat_content_role:
+        return ret
 
-                if chat_content_message:
-                    merged_message = chat_content_role + ": " + chat_content_message + "<NL>"
-                else:
-                    merged_message = chat_content_role + ": "
+    def get_chat_content_text(self, chat_content):
+        chat_content_role = chat_content.get_role()
+        chat_content_message = chat_content.get_message()
 
-                ret += merged_message
+        if not chat_content_role:
+            return ""
 
-        return ret
+        if chat_content_message:
+            return chat_content_role + ": " + chat_content_message + "<NL>"
+        else:
+            return chat_content_role + ": "
 
     def build_initial_prompt(self, chat_prompt):
         # 初期プロンプトは実装しない
@@ -4,6 +4,7 @@ import logging
 import os
 import signal
 import sys
+import time
 import traceback
 import urllib.parse
 from typing import Generator
@@ -14,14 +15,27 @@ from starlette.responses import JSONResponse
 
 from .access_control.client_role_verifier import ClientRoleVerifier
 from .access_control.client_role_wrapper import ClientRoleWrapper
+from .chat_batch_engine import ChatBatchEngine
 from .chat_process import ChatGenerator
 from .chat_process_mock import ChatGeneratorMock
 from .chat_stream_api_appender import append_apis
+from .compiled_decode import CompiledDecoder
+from .disconnect_watcher import DisconnectWatcher, is_client_disconnected
 from .chat_stream_middleware_appender import append_middlewares
 from .easy_locale import EasyLocale
+from .execution_slots import ExecutionSlotPool
+from .inference_executor import InferenceExecutor
+from .kv_block_manager import KVBlockManager
+from .prefix_kv_cache import PrefixKVCache
+from .quantization import quantize_model
+from .session_kv_cache import SessionKVCache
+from .speculative_decoding import SpeculativeDecoder, PromptLookupDecoder
 from .merge_dic import merge_dict
+from .model_registry import MODEL_SLOT_STATE_NAME, get_model_slot
+from .model_worker_pool import ModelWorkerPool
 from .request_handler.simple_session_request_handler import SimpleSessionRequestHandler
 from .resource_usage import get_resource_usage
+from .response_cache import ResponseCache
 
 from .util_ensure_torch_device import ensure_torch_device
 from .util_request_id import req_id
@@ -53,6 +67,52 @@ class ChatStream:
                  logger=None,  # logging object
                  locale=None,  # locale for logging
                  client_roles=None,
+                 use_continuous_batching=False,  # True: Concurrent generations share one batched forward per token step
+                 prefill_chunk_size=None,  # With use_continuous_batching, prefill long prompts in chunks of this many tokens between decode steps
+                 max_tokens_per_step=None,  # With use_continuous_batching, the maximum number of tokens (decode + prefill) per batched step
+                 use_inference_thread=False,  # True: Model forwards run on a dedicated thread so the event loop is not blocked
+                 model_loader=None,  # Function that returns (model, tokenizer). Required when num_model_workers > 0
+                 num_model_workers=0,  # Number of model worker processes, each owning a model replica. 0: generate in this process
+                 threads_per_model_worker=None,  # Intra-op threads per model worker. None: CPU cores divided by num_model_workers
+                 use_session_kv_cache=False,  # True: Reuse the KV cache of the previous turn so only the new turn is prefilled
+                 max_cached_sessions=64,  # The maximum number of sessions whose KV cache is kept when use_session_kv_cache=True
+                 session_kv_cache_max_device_bytes=None,  # Session KV caches beyond this size move from the device to host RAM
+                 session_kv_cache_max_host_bytes=None,  # Session KV caches beyond this size in host RAM move to files
+                 session_kv_cache_offload_dir=None,  # Directory of the memory-mapped files. None: drop instead of writing files
+                 session_kv_cache_max_disk_bytes=None,  # The maximum total size of the session KV cache files
+                 use_prefix_kv_cache=False,  # True: Share the KV cache of common prompt prefixes (e.g. system prompt) across requests
+                 prefix_kv_cache_max_bytes=256 * 1024 * 1024,  # Memory budget of the shared prefix KV cache in bytes
+                 kv_cache_memory_bytes=None,  # Preallocate a paged KV cache of this many bytes. None: KV cache grows per request
+                 kv_cache_block_size=16,  # The number of tokens per block of the paged KV cache
+                 draft_model=None,  # Small model sharing the vocabulary of the model. Enables speculative decoding
+                 draft_tokenizer=None,  # Tokenizer of the draft model. Must have the same vocabulary as the tokenizer
+                 num_speculative_tokens=4,  # Initial number of tokens proposed by the draft model per verification
+                 use_prompt_lookup=False,  # True: Propose tokens by matching the latest n-gram in the conversation (no draft model)
+                 prompt_lookup_num_tokens=10,  # The maximum number of tokens proposed per verification by prompt lookup
+                 prompt_lookup_max_ngram_size=3,  # The longest n-gram matched against the conversation by prompt lookup
+                 truncate_history_by_turns=True,  # True: Drop the oldest whole turns (keeping the system prompt) to fit the context
+                 build_prompt_from_token_ids=False,  # True: Assemble the prompt from token ids cached per message instead of re-tokenizing the history
+                 use_compiled_decode=False,  # True: Run decode steps as a torch.compile'd graph over a preallocated static KV cache
+                 compiled_decode_batch_size_buckets=None,  # Batch sizes compiled at startup. None: powers of two up to num_of_concurrent_executions
+                 compile_backend="inductor",  # torch.compile backend used when use_compiled_decode=True
+                 quantization=None,  # "int8_dynamic": Quantize the Linear layers of the model to int8 at construction (CPU only)
+                 quantization_check_prompts=None,  # Fixed prompts used to check the output drift of the quantized model. None: built-in prompts
+                 model_registry=None,  # ModelRegistry hosting multiple models chosen per request by name. Replaces model/tokenizer/chat_prompt_clazz
+                 load_model_in_background=False,  # True: Load the model with model_loader on a background thread after start_queue_worker instead of passing model
+                 warmup_prompt_lengths=None,  # Prompt lengths (in tokens) of the warm-up generations run before accepting requests, e.g. [32, 256, 1024]
+                 warmup_max_new_tokens=8,  # The number of tokens generated by each warm-up generation
+                 queue_requests_until_ready=False,  # True: Queue requests until the model is ready. False: Return 503 with Retry-After until ready
+                 not_ready_retry_after=10,  # Seconds in the Retry-After header of the 503 response returned before the model is ready
+                 use_execution_slots=False,  # True: Run each concurrent generation on its own thread with a fixed intra-op thread count and pinned CPU cores
+                 threads_per_execution_slot=None,  # Intra-op threads per execution slot. None: CPU cores divided by num_of_concurrent_executions
+                 pin_execution_slots=True,  # True: Pin each execution slot to its own group of CPU cores (when there are enough cores)
+                 benchmark_execution_slots=False,  # True: At startup, compare aggregate tokens/s of the execution slots against the shared thread pool
+                 watch_client_disconnect=False,  # True: Watch queued requests for client disconnects and skip abandoned ones without generating
+                 max_num_alternatives=4,  # Upper limit of the "n" request parameter (the number of alternative answers generated from one prefill)
+                 use_response_cache=False,  # True: Replay responses of greedy (temperature near 0) generations for requests with the same model, prompt and params
+                 response_cache_max_entries=256,  # The maximum number of responses kept in the response cache (least recently used ones are evicted)
+                 response_cache_ttl=None,  # Seconds a cached response stays valid. None: No expiration
+                 response_cache_file=None,  # Path of the JSON file backing the response cache. None: Keep the cache in memory only
                  ):
 
         if client_roles is None:
@@ -112,6 +172,7 @@ class ChatStream:
             "repetition_penalty": repetition_penalty,  # ペナルティの値
             "repetition_penalty_method": repetition_penalty_method,  # ペナルティの計算方法
             "add_special_tokens": add_special_tokens,  # トークナイザーの add_special_tokens 設定
+            "use_prompt_lookup": use_prompt_lookup,  # True: 会話履歴の n-gram から先読みする投機的デコーディングを使う
         }
 
         self.too_many_request_as_http_error = too_many_request_as_http_error
@@ -120,14 +181,260 @@ class ChatStream:
 
         self.params = chat_params
 
-        # 最大同時処理数を超えないようブロックするための同時処理カウントセマフォ
-        self.concurrent_processing_semaphore = asyncio.Semaphore(num_of_concurrent_executions)
-
         # ユーザー(ブラウザ)からの request を受け付けるリクエストキュー
         # サイズを -1 している理由は run_on_next_queue 側に次に処理にまわされるものを１件入れるため.
         # そのぶんリクエストキューは -1 している
         self.request_queue = asyncio.Queue(maxsize=(max_queue_size - 1))
 
+        # 同時処理数ぶんのセマフォとキューをつくる(paged KV cache によって同時処理数が減る場合は、モデルの準備時につくりなおす)
+        self._set_concurrency(num_of_concurrent_executions)
+
+        # キューで待っているリクエストと文章生成中のリクエストの、クライアントの切断を監視する
+        self.disconnect_watcher = None
+        if watch_client_disconnect:
+            self.disconnect_watcher = DisconnectWatcher()
+
+        # コンソールチャット使用時のシングルユーザー用の ChatPrompt
+        self.chat_prompt_for_single_user_on_console = None
+
+        # モデルのレプリカを持つワーカープロセス群
+        self.model_worker_pool = None
+        if num_model_workers > 0 and not use_mock_response:
+            if model_loader is None:
+                raise ValueError("model_loader is required when num_model_workers > 0")
+            self.model_worker_pool = ModelWorkerPool(model_loader, device=device, num_workers=num_model_workers,
+                                                     threads_per_worker=threads_per_model_worker)
+
+        # セッションごとの前回のターンのKVキャッシュ(モデルワーカープロセスを使う場合は未対応)
+        self.session_kv_cache = None
+        if use_session_kv_cache and not use_mock_response and self.model_worker_pool is None:
+            self.session_kv_cache = SessionKVCache(max_sessions=max_cached_sessions,
+                                                   max_device_bytes=session_kv_cache_max_device_bytes,
+                                                   max_host_bytes=session_kv_cache_max_host_bytes,
+                                                   offload_dir=session_kv_cache_offload_dir,
+                                                   max_disk_bytes=session_kv_cache_max_disk_bytes)
+
+        # リクエスト間で共有するプレフィックスのKVキャッシュ(モデルワーカープロセスを使う場合は未対応)
+        self.prefix_kv_cache = None
+        if use_prefix_kv_cache and not use_mock_response and self.model_worker_pool is None:
+            self.prefix_kv_cache = PrefixKVCache(max_memory_bytes=prefix_kv_cache_max_bytes)
+
+        # 投機的デコーディングは、KVキャッシュの再利用・ブロック管理を行わずに密なKVキャッシュで生成するため、
+        # これらのKVキャッシュとは併用できない(連続バッチングでは投機的デコーディングを使わない)
+        self.uses_kv_caches = (self.session_kv_cache is not None or self.prefix_kv_cache is not None or (
+                kv_cache_memory_bytes is not None and not use_mock_response and self.model_worker_pool is None))
+        if self.uses_kv_caches and not use_continuous_batching and (draft_model is not None or use_prompt_lookup):
+            raise ValueError(
+                "draft_model and use_prompt_lookup cannot be combined with use_session_kv_cache, use_prefix_kv_cache "
+                "or kv_cache_memory_bytes, because speculative decoding does not use those KV caches")
+
+        # greedy に生成した文章を、モデル・プロンプト・生成パラメータが同じリクエストに使いまわすキャッシュ
+        self.response_cache = None
+        if use_response_cache and not use_mock_response:
+            self.response_cache = ResponseCache(max_entries=response_cache_max_entries, ttl=response_cache_ttl,
+                                                file_path=response_cache_file)
+
+        # 複数のモデルをリクエストごとに選んで使う場合のレジストリ
+        self.model_registry = model_registry
+        if model_registry is not None:
+            model_registry.params = chat_params
+            model_registry.response_cache = self.response_cache
+            model_registry.logger = self.logger
+            model_registry.eloc = self.eloc
+            if model_registry.device is None:
+                model_registry.device = self.device
+            self.chat_prompt_clazz = model_registry.get_chat_prompt_clazz()
+
+            # モデルのスロットはリクエストキューに入れる前に確保するため、全体の同時処理数はスロット数の合計とする
+            # (スロットを確保したリクエストが、全体の同時処理数の空きを待たないようにする)
+            self._set_concurrency(model_registry.get_total_slots())
+
+        self.quantization_report = None
+        self.kv_block_manager = None
+        self.speculative_decoder = None
+        self.prompt_lookup_decoder = None
+        self.compiled_decoder = None
+        self.execution_slot_pool = None
+        self.inference_executor = None
+        self.chat_generator = None
+
+        def setup_model(model, tokenizer):
+            """
+            model, tokenizer を使う機能(量子化・paged KV cache・投機的デコーディング・コンパイル済の decode)と
+            ChatGenerator を準備する。 load_model_in_background=True の場合はモデルを読み込んだあと、別スレッドで呼び出される
+            """
+
+            # モデルの Linear を量子化し、量子化前後のメモリ使用量・速度・出力のずれを記録する(モデルワーカープロセスを使う場合は未対応)
+            if quantization is not None and not use_mock_response:
+                if num_model_workers > 0:
+                    self.logger.warning(self.eloc.to_str({
+                        "en": "quantization is ignored because it is not supported with num_model_workers. Quantize the model in model_loader instead",
+                        "ja": "num_model_workers を使う場合は quantization に対応していないため使用しません。model_loader の中で量子化してください"}))
+                else:
+                    model, self.quantization_report = quantize_model(model, tokenizer, quantization,
+                                                                     device=self.device or "cpu",
+                                                                     check_prompts=quantization_check_prompts)
+                    drift = self.quantization_report["drift"]
+                    memory = self.quantization_report["memory"]
+                    self.logger.info(self.eloc.to_str({
+                        "en": f"Quantized the model with {quantization}: {memory['model_bytes_before']} -> {memory['model_bytes_after']} bytes, token agreement {drift['token_agreement']:.2f}",
+                        "ja": f"モデルを {quantization} で量子化しました: {memory['model_bytes_before']} -> {memory['model_bytes_after']} バイト, トークン一致率 {drift['token_agreement']:.2f}"}))
+                    if not drift["passed"]:
+                        self.logger.warning(self.eloc.to_str({
+                            "en": f"The output of the quantized model drifts from the original model (token agreement {drift['token_agreement']:.2f}, top-1 agreement {drift['top1_agreement']:.2f})",
+                            "ja": f"量子化したモデルの出力が元のモデルからずれています(トークン一致率 {drift['token_agreement']:.2f}, top-1 一致率 {drift['top1_agreement']:.2f})"}))
+
+            # paged KV cache のプールを確保し、コンテクストサイズぶんのKVキャッシュを同時に保持できる数を同時処理数の上限とする
+            # forward の間にプールの外に確保される作業領域も kv_cache_memory_bytes に含める
+            if kv_cache_memory_bytes is not None and not use_mock_response and num_model_workers == 0:
+                self.kv_block_manager = KVBlockManager.from_model(model, kv_cache_memory_bytes,
+                                                                  block_size=kv_cache_block_size,
+                                                                  context_len=context_len)
+                max_concurrent_executions = self.kv_block_manager.num_blocks // self.kv_block_manager.get_num_blocks_for(
+                    context_len)
+                if max_concurrent_executions < 1:
+                    raise ValueError(
+                        f"kv_cache_memory_bytes={kv_cache_memory_bytes} cannot hold even one context of {context_len} tokens "
+                        f"together with its forward working set")
+                if self.num_of_concurrent_executions > max_concurrent_executions:
+                    self.logger.warning(self.eloc.to_str({
+                        "en": f"The paged KV cache can hold {max_concurrent_executions} contexts of {context_len} tokens, so num_of_concurrent_executions is reduced from {self.num_of_concurrent_executions} to {max_concurrent_executions}",
+                        "ja": f"paged KV cache に保持できるのは {context_len} トークンのコンテクスト {max_concurrent_executions} 個ぶんのため、num_of_concurrent_executions を {self.num_of_concurrent_executions} から {max_concurrent_executions} に減らします"}))
+                    self._set_concurrency(max_concurrent_executions)
+
+            # ドラフトモデルによる投機的デコーディング(連続バッチング・モデルワーカープロセスを使う場合は未対応)
+            if not use_mock_response and not use_continuous_batching and self.model_worker_pool is None \
+                    and not self.uses_kv_caches:
+                # 生成パラメータ use_prompt_lookup でリクエストごとに有効にできるよう、常に用意しておく
+                # (KVキャッシュを使う場合は用意しないため、リクエストで有効にしても通常の生成となる)
+                self.prompt_lookup_decoder = PromptLookupDecoder(max_ngram_size=prompt_lookup_max_ngram_size,
+                                                                 num_speculative_tokens=prompt_lookup_num_tokens,
+                                                                 max_speculative_tokens=prompt_lookup_num_tokens)
+            if draft_model is not None and not use_mock_response:
+                if use_continuous_batching or self.model_worker_pool is not None:
+                    self.logger.warning(self.eloc.to_str({
+                        "en": "draft_model is ignored because speculative decoding is not supported with use_continuous_batching or num_model_workers",
+                        "ja": "use_continuous_batching または num_model_workers を使う場合は投機的デコーディングに対応していないため、draft_model は使用しません"}))
+                else:
+                    self.speculative_decoder = SpeculativeDecoder(draft_model, draft_tokenizer=draft_tokenizer,
+                                                                  tokenizer=tokenizer,
+                                                                  num_speculative_tokens=num_speculative_tokens)
+
+            # 静的なKVキャッシュとコンパイル済の decode ステップ(モデルワーカープロセスを使う場合は未対応)
+            if use_compiled_decode and not use_mock_response and self.model_worker_pool is None:
+                batch_size_buckets = compiled_decode_batch_size_buckets
+                if batch_size_buckets is None:
+                    max_batch_size = self.num_of_concurrent_executions if use_continuous_batching else 1
+                    batch_size_buckets = [2 ** i for i in range(max_batch_size.bit_length())]
+                    if max_batch_size not in batch_size_buckets:
+                        batch_size_buckets.append(max_batch_size)
+                self.compiled_decoder = CompiledDecoder(model, max_cache_len=context_len,
+                                                        batch_size_buckets=batch_size_buckets,
+                                                        backend=compile_backend)
+
+                # 最初のリクエストでコンパイルが走らないよう、起動時にすべてのバケットをコンパイルしておく
+                for bucket, result in self.compiled_decoder.warmup().items():
+                    self.logger.info(self.eloc.to_str({
+                        "en": f"Compiled decode for batch size {bucket}: eager {result['eager_tokens_per_sec']:.1f} tokens/s, compiled {result['compiled_tokens_per_sec']:.1f} tokens/s",
+                        "ja": f"バッチサイズ {bucket} の decode をコンパイルしました: eager {result['eager_tokens_per_sec']:.1f} tokens/s, コンパイル後 {result['compiled_tokens_per_sec']:.1f} tokens/s"}))
+
+            if use_mock_response:
+                self.chat_generator = ChatGeneratorMock(model=None, tokenizer=None, device=None,
+                                                        params=mock_params)
+            elif model_registry is not None:
+                # モデルごとのスロットと読み込み・取り除きはレジストリが管理する
+                self.chat_generator = model_registry
+            else:
+                executor = None
+                if use_inference_thread:
+                    # forward とサンプリングを推論スレッドで実行し、イベントループをブロックしない
+                    self.inference_executor = InferenceExecutor()
+                    executor = self.inference_executor
+
+                if use_execution_slots:
+                    if use_continuous_batching:
+                        self.logger.warning(self.eloc.to_str({
+                            "en": "use_execution_slots is ignored because use_continuous_batching runs one batched forward with all cores",
+                            "ja": "use_continuous_batching は1つのバッチの forward を全コアで実行するため、use_execution_slots は使用しません"}))
+                    else:
+                        # 同時処理数ぶんのスロットにコアを分け、文章生成ごとに1つのスロットのスレッドで実行する
+                        self.execution_slot_pool = ExecutionSlotPool(self.num_of_concurrent_executions,
+                                                                     threads_per_slot=threads_per_execution_slot,
+                                                                     pin_threads=pin_execution_slots)
+                        executor = self.execution_slot_pool
+
+                        if benchmark_execution_slots:
+                            result = self.execution_slot_pool.benchmark(model)
+                            self.logger.info(self.eloc.to_str({
+                                "en": f"Execution slots: shared thread pool {result['shared_pool_tokens_per_sec']:.1f} tokens/s, slots {result['slots_tokens_per_sec']:.1f} tokens/s",
+                                "ja": f"実行スロット: スレッドプール共有 {result['shared_pool_tokens_per_sec']:.1f} tokens/s, スロット {result['slots_tokens_per_sec']:.1f} tokens/s"}))
+
+                batch_engine = None
+                if use_continuous_batching:
+                    # 同時処理数ぶんのシーケンスを1つのバッチにまとめて生成する
+                    batch_engine = ChatBatchEngine(model, tokenizer, device,
+                                                   max_batch_size=self.num_of_concurrent_executions,
+                                                   executor=executor, session_kv_cache=self.session_kv_cache,
+                                                   prefix_kv_cache=self.prefix_kv_cache,
+                                                   kv_block_manager=self.kv_block_manager,
+                                                   prefill_chunk_size=prefill_chunk_size,
+                                                   max_tokens_per_step=max_tokens_per_step,
+                                                   compiled_decoder=self.compiled_decoder)
+                self.chat_generator = ChatGenerator(model, tokenizer, device, chat_params, batch_engine=batch_engine,
+                                                    executor=executor, worker_pool=self.model_worker_pool,
+                                                    session_kv_cache=self.session_kv_cache,
+                                                    prefix_kv_cache=self.prefix_kv_cache,
+                                                    kv_block_manager=self.kv_block_manager,
+                                                    speculative_decoder=self.speculative_decoder,
+                                                    prompt_lookup_decoder=self.prompt_lookup_decoder,
+                                                    truncate_history_by_turns=truncate_history_by_turns,
+                                                    build_prompt_from_token_ids=build_prompt_from_token_ids,
+                                                    compiled_decoder=self.compiled_decoder,
+                                                    response_cache=self.response_cache)
+
+            # request_handler にパラメータをセット
+            request_handler.chat_generator = self.chat_generator
+
+        request_handler.chat_prompt_clazz = self.chat_prompt_clazz
+        request_handler.model_registry = self.model_registry
+        request_handler.max_num_alternatives = max_num_alternatives
+
+        # 起動後、リクエストを受け付けられるようになるまでの状態
+        # "loading": モデルを読み込み中, "warming_up": ウォームアップの文章生成中, "ready": 受付可能, "failed": 準備に失敗した
+        self.model_loader = model_loader
+        # (モデルレジストリのモデルは最初に使われたときに読み込むため、ウォームアップしない)
+        self.warmup_prompt_lengths = warmup_prompt_lengths if not use_mock_response and model_registry is None else None
+        self.warmup_max_new_tokens = warmup_max_new_tokens
+        self.queue_requests_until_ready = queue_requests_until_ready
+        self.not_ready_retry_after = not_ready_retry_after
+        self.readiness_event = asyncio.Event()  # 準備が終わった(ready または failed になった)ときにセットされる
+        self.readiness_task = None
+        self.readiness_stats = {}  # モデルの読み込み時間と、プロンプト長ごとのウォームアップの時間
+
+        self.setup_model = None  # バックグラウンドで読み込んだあとに呼び出す、モデルの準備処理
+        if load_model_in_background and not use_mock_response and model_registry is None and self.model_worker_pool is None:
+            if model_loader is None:
+                raise ValueError("model_loader is required when load_model_in_background=True")
+            self.setup_model = setup_model
+            self.readiness = "loading"
+        else:
+            setup_model(model, tokenizer)
+            self.readiness = "warming_up" if self.warmup_prompt_lengths else "ready"
+
+        if self.readiness == "ready":
+            self.readiness_event.set()
+
+    def _set_concurrency(self, num_of_concurrent_executions):
+        """
+        同時処理数ぶんの同時処理カウントセマフォと、次処理キュー・処理中キューをつくる
+
+        キューワーカーは準備ができるまでこれらを使わないため、準備中につくりなおしてもよい
+        """
+        self.num_of_concurrent_executions = num_of_concurrent_executions
+
+        # 最大同時処理数を超えないようブロックするための同時処理カウントセマフォ
+        self.concurrent_processing_semaphore = asyncio.Semaphore(num_of_concurrent_executions)
+
         # 現在処理している リクエストタスク が最大同時処理数を超えたとき、
         # 次に実行されるリクエストタスクを一時的に配置しておく「次処理キュー」
         # サイズを +1 している理由は 次処理キューは　現在処理中（言語モデルにより文章生成中）のものと、
@@ -137,19 +444,6 @@ class ChatStream:
         # 現在処理中(文章生成中)の リクエストタスク　が配置されている「処理中キュー」
         self.processing_queue = asyncio.Queue(maxsize=num_of_concurrent_executions)
 
-        # コンソールチャット使用時のシングルユーザー用の ChatPrompt
-        self.chat_prompt_for_single_user_on_console = None
-
-        if use_mock_response:
-            self.chat_generator = ChatGeneratorMock(model=None, tokenizer=None, device=None,
-                                                    params=mock_params)
-        else:
-            self.chat_generator = ChatGenerator(model, tokenizer, device, chat_params)
-
-        # request_handler にパラメータをセット
-        request_handler.chat_generator = self.chat_generator
-        request_handler.chat_prompt_clazz = self.chat_prompt_clazz
-
     async def queue_worker(self):
         """
         A worker for concurrently processing requests from clients. It manages the receipt, processing, and completion of requests.
@@ -169,6 +463,25 @@ class ChatStream:
                     {"en": f"{req_id(request)} Retrieve request tasks from the 'request queue'",
                      "ja": f"{req_id(request)} リクエストキュー'からリクエストタスク取り出し"}))
 
+                if self.disconnect_watcher is not None:
+                    # ここから先の切断は StreamingResponse が検出する(receive を読むのは1か所だけとする)
+                    self.disconnect_watcher.unwatch(request)
+
+                if is_client_disconnected(request):
+                    # キューで待っている間にクライアントが切断し、すでに応答済のリクエストは読み飛ばす
+                    continue
+
+                if not self.readiness_event.is_set():
+                    # モデルの読み込み・ウォームアップが終わるまで、次実行キューに移さずに待つ
+                    await self.readiness_event.wait()
+
+                if self.readiness == "failed":
+                    # モデルの準備に失敗した場合は文章生成せずに 503 を返す
+                    self._release_model_slot(request)
+                    future_result.set_result(self.create_not_ready_response())
+                    this_request_semaphore.release()
+                    continue
+
                 # 同時処理カウントセマフォ(concurrent_processing_semaphore) がロックされているときに
                 # 短時間（１秒以内）に大量リクエストが来た場合、　次実行キュー(run_on_next_queue) に詰める前に
                 # リクエストキュー(request_queue) がいっぱいになるため、実際には run_on_next_queue のサイズ -1 の同時リクエストで
@@ -215,6 +528,8 @@ class ChatStream:
                     :return:
                     """
 
+                    self._release_model_slot(request)
+
                     # message は現在のところ、これより先には通知しない
                     self.concurrent_processing_semaphore.release()  # 同時処理管理セマフォをリリースする Release the concurrent processing semaphore
                     await self.processing_queue.get()  # 現在の request を、リクエスト処理中キューから取り出す Get the current request from the request processing queue
@@ -273,8 +588,10 @@ class ChatStream:
 
         except asyncio.CancelledError:
             print("Queue worker stopped.")
+            self.shutdown_executors()
         except KeyboardInterrupt:
             print("Interrupted by user, shutting down.")
+            self.shutdown_executors()
         except Exception as e:
             # リクエスト処理中に想定していないエラーが発生した場合
             self.logger.warning(
@@ -282,6 +599,18 @@ class ChatStream:
                     {"en": f"{req_id(request)} An unexpected error has occurred. {e}\n{traceback.format_exc()}",
                      "ja": f"{req_id(request)} 予期せぬエラーが発生しました: {e}\n{traceback.format_exc()}"}))
 
+    def shutdown_executors(self):
+        """
+        推論スレッドと実行スロットのスレッドを停止する
+        実行スロットが変更したプロセス全体の intra-op スレッド数も元に戻る
+        """
+        if self.inference_executor is not None:
+            self.inference_executor.shutdown()
+            self.inference_executor = None
+        if self.execution_slot_pool is not None:
+            self.execution_slot_pool.shutdown()
+            self.execution_slot_pool = None
+
     async def start_queue_worker(self):
         """
         Starts the queue worker and registers the force termination and shutdown handlers.
@@ -289,9 +618,99 @@ class ChatStream:
 
         self.queue_worker_task = asyncio.create_task(self.queue_worker())  # キューワーカーを開始
 
+        if self.model_worker_pool is not None:
+            # モデルワーカープロセスを起動する(モデルの読み込みはワーカー側で行われる)
+            self.model_worker_pool.start()
+
+        if not self.readiness_event.is_set() and self.readiness_task is None:
+            # モデルの読み込みとウォームアップをバックグラウンドで行う。終わるまでのリクエストは待たせるか 503 を返す
+            self.readiness_task = asyncio.create_task(self.prepare())
+
         # 強制終了のシャットダウンハンドラを登録
         signal.signal(signal.SIGINT, lambda s, f: os._exit(0))
 
+    async def prepare(self):
+        """
+        load_model_in_background=True の場合はモデルを読み込み、 warmup_prompt_lengths の長さのプロンプトで
+        ウォームアップの文章生成を行ってから、リクエストを受け付けられる状態(ready)にする
+
+        モデルの読み込み・量子化・コンパイルなど時間のかかる処理は、イベントループを止めないよう別スレッドで行う
+        """
+        try:
+            if self.setup_model is not None:
+                self.readiness = "loading"
+                start = time.perf_counter()
+                loop = asyncio.get_running_loop()
+                model, tokenizer = await loop.run_in_executor(None, self.model_loader)
+                await loop.run_in_executor(None, self.setup_model, model, tokenizer)
+                self.setup_model = None
+                self.readiness_stats["load_sec"] = time.perf_counter() - start
+
+                self.logger.info(self.eloc.to_str({
+                    "en": f"Loaded the model in {self.readiness_stats['load_sec']:.1f} sec",
+                    "ja": f"モデルを {self.readiness_stats['load_sec']:.1f} 秒で読み込みました"}))
+
+            if self.warmup_prompt_lengths:
+                self.readiness = "warming_up"
+                await self.warmup()
+
+            self.readiness = "ready"
+            self.logger.info(self.eloc.to_str({"en": "Ready to accept requests", "ja": "リクエストの受付を開始します"}))
+
+        except Exception as e:
+            self.readiness = "failed"
+            self.logger.error(self.eloc.to_str({
+                "en": f"Failed to prepare the model. {e}\n{traceback.format_exc()}",
+                "ja": f"モデルの準備に失敗しました: {e}\n{traceback.format_exc()}"}))
+        finally:
+            self.readiness_event.set()
+
+    async def warmup(self):
+        """
+        代表的なプロンプト長(warmup_prompt_lengths)ごとに、実際のリクエストと同じ経路で文章生成を行う
+
+        最初のリクエストで発生する遅延初期化(カーネルの選択・メモリの確保・アロケータのキャッシュなど)を、
+        プロンプト長ごとに起動時に済ませておく
+        """
+        warmup_sec = {}
+        for prompt_len in self.warmup_prompt_lengths:
+            prompt = self.chat_generator.create_warmup_prompt(prompt_len)
+            params = merge_dict(self.params, {"max_new_tokens": self.warmup_max_new_tokens, "stop_strs": None})
+
+            start = time.perf_counter()
+            async for _ in self.chat_generator.generate_from_prompt(params, prompt):
+                pass
+            warmup_sec[prompt_len] = time.perf_counter() - start
+
+            self.logger.info(self.eloc.to_str({
+                "en": f"Warmed up with a prompt of {prompt_len} tokens in {warmup_sec[prompt_len]:.2f} sec",
+                "ja": f"{prompt_len} トークンのプロンプトで {warmup_sec[prompt_len]:.2f} 秒ウォームアップしました"}))
+
+        self.readiness_stats["warmup_sec"] = {str(prompt_len): sec for prompt_len, sec in warmup_sec.items()}
+
+    def is_ready(self):
+        """
+        リクエストを受け付けられる状態かどうか
+        """
+        return self.readiness == "ready"
+
+    async def wait_until_ready(self):
+        """
+        モデルの準備が終わる(ready または failed になる)まで待つ
+
+        :return: 準備が終わったときの状態
+        """
+        await self.readiness_event.wait()
+        return self.readiness
+
+    def create_not_ready_response(self):
+        """
+        モデルの準備ができていないときに返す 503 レスポンス。 Retry-After で再送までの秒数を示す
+        """
+        return JSONResponse(content={"error": "not_ready", "readiness": self.readiness}, status_code=503,
+                            headers={"Retry-After": str(self.not_ready_retry_after)},
+                            media_type="application/json")
+
     def verify_role_for_api(self, request, api_name):
         """
         指定した API 名のロールをみて、そのAPIにアクセス可能かどうか判定する
@@ -338,6 +757,24 @@ class ChatStream:
         if verify_error_response:
             return verify_error_response
 
+        if not self.is_ready() and (self.readiness == "failed" or not self.queue_requests_until_ready):
+            # モデルの読み込み・ウォームアップ中は、キューに入れずに 503 と Retry-After を返す
+            return self.create_not_ready_response()
+
+        if self.disconnect_watcher is not None and request_body is None:
+            # 切断の監視は receive を読むため、先にリクエストボディを読み込んでおく(request.json() はこれを使う)
+            await request.body()
+
+        if self.model_registry is not None:
+            # 混んでいるモデルを待つリクエストが全体の同時処理数を占有しないよう、リクエストキューに入れる前にモデルのスロットを確保する
+            if self.model_registry.get_num_waiting() + self.request_queue.qsize() >= self.request_queue.maxsize:
+                return self.create_too_many_requests_response()
+
+            model_name = self._get_requested_model_name(request_body if request_body is not None else await request.body())
+            if self.model_registry.has_model(model_name):
+                # 登録されていないモデルの場合は、リクエストハンドラが 400 を返す
+                setattr(request.state, MODEL_SLOT_STATE_NAME, await self.model_registry.acquire_slot(model_name))
+
         # この request の処理待ち用カウントセマフォをつくる
         this_request_semaphore = asyncio.Semaphore(0)
 
@@ -346,9 +783,8 @@ class ChatStream:
 
         try:
             # リクエストキュー（処理待ち行列）にリクエストタスク(request, this_request_semaphore, future_result)を追加する
-            self.request_queue.put_nowait(
-                (request, request_body, callback, this_request_semaphore,
-                 future_result))  # put_nowait=>キューが一杯でない場合にのみ要求を追加
+            request_task = (request, request_body, callback, this_request_semaphore, future_result)
+            self.request_queue.put_nowait(request_task)  # put_nowait=>キューが一杯でない場合にのみ要求を追加
 
             self.logger.debug(self.eloc.to_str(
                 {
@@ -356,6 +792,9 @@ class ChatStream:
                     "ja": f"{req_id(request)} このリクエストを'リクエストキュー'に追加 キューサイズ:{self.request_queue.qsize()}/{self.request_queue.maxsize}"
                 }))
 
+            if self.disconnect_watcher is not None:
+                self.disconnect_watcher.watch(request, lambda _: self._cancel_queued_request(request_task))
+
         except asyncio.QueueFull:
 
             # リクエストキュー（処理ち行列）を超えるリクエストがあった場合はエラーを返す
@@ -367,13 +806,11 @@ class ChatStream:
                     "ja": f"{req_id(request)} このリクエストを'リクエストキュー'に追加失敗。リクエストキューがいっぱいです"
                 }))
 
-            if self.too_many_request_as_http_error:
-                return JSONResponse(content={"error": "too_many_requests"}, status_code=429,
-                                    media_type="application/json")
-            else:
-                return JSONResponse(content={"error": "too_many_requests"}, media_type="application/json")
+            self._release_model_slot(request)
+            return self.create_too_many_requests_response()
         except Exception as e:
             # リクエスト処理中に想定していないエラーが発生した場合
+            self._release_model_slot(request)
 
             self.logger.warning(
                 self.eloc.to_str(
@@ -392,6 +829,55 @@ class ChatStream:
 
         return await future_result
 
+    def create_too_many_requests_response(self):
+        """
+        リクエストキューがいっぱいの場合のレスポンス
+        """
+        if self.too_many_request_as_http_error:
+            return JSONResponse(content={"error": "too_many_requests"}, status_code=429,
+                                media_type="application/json")
+        else:
+            return JSONResponse(content={"error": "too_many_requests"}, media_type="application/json")
+
+    def _get_requested_model_name(self, request_body):
+        """
+        リクエストボディの "model" (ModelRegistry で文章生成するモデルの登録名)。読み取れない場合は None (既定のモデル)
+        """
+        try:
+            data = json.loads(request_body)
+        except ValueError:
+            return None
+        return data.get("model", None) if isinstance(data, dict) else None
+
+    def _release_model_slot(self, request):
+        """
+        リクエストキューに入れる前に確保したモデルのスロットを解放する(確保していない場合や、解放済の場合は何もしない)
+        """
+        entry = get_model_slot(request)
+        if entry is not None:
+            setattr(request.state, MODEL_SLOT_STATE_NAME, None)
+            self.model_registry.release_slot(entry)
+
+    def _cancel_queued_request(self, request_task):
+        """
+        クライアントが切断した、リクエストキューで待っているリクエストを文章生成せずに終える
+
+        リクエストキューをつくりなおすと、キューの長さに比例する時間がかかり、同時に追加されるリクエストとも競合するため、
+        リクエストタスクはキューに残したまま、 request.state の切断の印によりキューワーカーが取り出したときに読み飛ばす
+        """
+        request, request_body, callback, this_request_semaphore, future_result = request_task
+        self.disconnect_watcher.num_removed_from_queue += 1
+
+        self.logger.debug(self.eloc.to_str({
+            "en": f"{req_id(request)} The client disconnected, so the request in the 'request queue' will be skipped",
+            "ja": f"{req_id(request)} クライアントが切断したため、'リクエストキュー'のリクエストを読み飛ばします"}))
+
+        self._release_model_slot(request)
+        if callback:
+            callback(request, "client_disconnected_before_streaming")
+        future_result.set_result(None)
+        this_request_semaphore.release()
+
     async def handle_get_resource_usage_request(self, request: Request):
         try:
             api_name = "get_resource_usage"
@@ -399,7 +885,8 @@ class ChatStream:
             if verify_error_response:
                 return verify_error_response
 
-            memory_usage = get_resource_usage({"num_gpus": self.num_gpus, "device": self.device})
+            memory_usage = get_resource_usage({"num_gpus": self.num_gpus, "device": self.device,
+                                               "quantization": self.quantization_report})
 
             memory_usage["name"] = self.name
 
@@ -446,6 +933,10 @@ class ChatStream:
                 if chat_prompt:
                     session.pop("chat_prompt", None)  # 削除する
 
+                if self.session_kv_cache is not None:
+                    # 会話履歴に対応するKVキャッシュも破棄する
+                    self.session_kv_cache.invalidate(session_mgr.get_session_id())
+
                 self.logger.debug(self.eloc.to_str({"en": f"{req_id(request)} Context has been cleared.",
                                                     "ja": f"{req_id(request)} コンテクストがクリアされました"}))
 
@@ -472,7 +963,7 @@ class ChatStream:
         文章生成パラメータ（temperature, top_k_value, top_p_value）の設定を更新する Web API エンドポイントのハンドリングをする
 
         :param request: クライアントからのリクエスト。次のキーを含む JSON 形式を想定
-                        temperature (0.0 から 1.0 の範囲), top_k_value (1 から 500 の範囲), top_p_value (0.0 から 1.0 の範囲).
+                        temperature (0.0 から 1.0 の範囲), top_k_value (1 から 500 の範囲), top_p_value (0.0 から 1.0 の範囲), use_prompt_lookup (true または false).
         :type request: Request
         :return: 処理結果の辞書。
         成功時には "success": True 、失敗時には "success": False
@@ -493,11 +984,13 @@ class ChatStream:
             temperature = generation_params_from_client.get("temperature")
             top_k_value = generation_params_from_client.get("top_k_value")
             top_p_value = generation_params_from_client.get("top_p_value")
+            use_prompt_lookup = generation_params_from_client.get("use_prompt_lookup")
 
             user_specified_generation_params = {
                 "temperature": temperature,
                 "top_k_value": top_k_value,
-                "top_p_value": top_p_value
+                "top_p_value": top_p_value,
+                "use_prompt_lookup": use_prompt_lookup,
             }
 
             if temperature is not None and not (0.0 <= temperature <= 1.0):
@@ -512,6 +1005,15 @@ class ChatStream:
                 error_message = "Invalid top_p value. top_p_value should be between 0.0 and 1.0."
                 return {"success": False, "message": error_message}
 
+            if use_prompt_lookup is not None and not isinstance(use_prompt_lookup, bool):
+                error_message = "Invalid use_prompt_lookup value. use_prompt_lookup should be true or false."
+                return {"success": False, "message": error_message}
+
+            if use_prompt_lookup and self.uses_kv_caches:
+                # 投機的デコーディングは KVキャッシュの再利用・ブロック管理(kv_cache_memory_bytes の予算)を使わずに生成してしまう
+                error_message = "use_prompt_lookup is not available because this server uses the session, prefix or paged KV cache."
+                return {"success": False, "message": error_message}
+
             session_mgr = getattr(request.state, "session", None)
 
             if session_mgr:
@@ -526,6 +1028,7 @@ class ChatStream:
                     "temperature": self.params.get("temperature"),
                     "top_k_value": self.params.get("top_k_value"),
                     "top_p_value": self.params.get("top_p_value"),
+                    "use_prompt_lookup": self.params.get("use_prompt_lookup"),
                 }
 
                 merged_params = merge_dict(crr_params, user_specified_generation_params)
@@ -601,6 +1104,7 @@ class ChatStream:
             "temperature": self.params.get("temperature"),
             "top_k_value": self.params.get("top_k_value"),
             "top_p_value": self.params.get("top_p_value"),
+            "use_prompt_lookup": self.params.get("use_prompt_lookup"),
         }
         # TODO seed値も含める
         # ChatStream 初期化時に指定された生成パラメータに、現在セッションで保持されているユーザーごとの生成パラメータをマージしたものを返す
@@ -747,20 +1251,69 @@ class ChatStream:
         if verify_error_response:
             return verify_error_response
 
+        chatstream_worker = {
+            "name": self.name,
+            "readiness": self.readiness,
+            "processing": self.processing_queue.qsize(),
+            "waiting": self.run_on_next_queue.qsize() + self.request_queue.qsize(),
+            "_num_of_next_queue": self.run_on_next_queue.qsize(),
+            "_num_of_request_queue": self.request_queue.qsize(),
+            "max_processing": self.processing_queue.maxsize,
+            "max_waiting": self.request_queue.maxsize + self.run_on_next_queue.maxsize
+        }
+
+        if self.readiness_stats:
+            # モデルの読み込み時間と、プロンプト長ごとのウォームアップの時間
+            chatstream_worker["readiness_stats"] = self.readiness_stats
+
+        if self.model_worker_pool is not None:
+            # モデルワーカープロセスごとの処理状況
+            chatstream_worker["model_workers"] = self.model_worker_pool.get_worker_loads()
+
+        if self.session_kv_cache is not None:
+            # セッションごとのKVキャッシュの使用状況
+            chatstream_worker["session_kv_cache"] = self.session_kv_cache.get_stats()
+
+        if self.prefix_kv_cache is not None:
+            # リクエスト間で共有するプレフィックスのKVキャッシュのヒット率など
+            chatstream_worker["prefix_kv_cache"] = self.prefix_kv_cache.get_stats()
+
+        if self.kv_block_manager is not None:
+            # paged KV cache のブロックの使用状況
+            chatstream_worker["kv_cache"] = self.kv_block_manager.get_stats()
+
+        if self.speculative_decoder is not None:
+            # 投機的デコーディングの受理率(全体と直近のリクエストごと)
+            chatstream_worker["speculative_decoding"] = self.speculative_decoder.get_stats()
+
+        if self.prompt_lookup_decoder is not None and self.prompt_lookup_decoder.get_stats()["verifications"] > 0:
+            # n-gram による先読みの受理率
+            chatstream_worker["prompt_lookup_decoding"] = self.prompt_lookup_decoder.get_stats()
+
+        if self.compiled_decoder is not None:
+            # コンパイル済の decode ステップ数と、起動時に計測した eager との tokens/s の比較
+            chatstream_worker["compiled_decode"] = self.compiled_decoder.get_stats()
+
+        if self.execution_slot_pool is not None:
+            # 実行スロットごとのコアの割り当てと、起動時に計測したスレッドプール共有との tokens/s の比較
+            chatstream_worker["execution_slots"] = self.execution_slot_pool.get_stats()
+
+        if self.disconnect_watcher is not None:
+            # 監視中のリクエスト数と、切断を検出したリクエスト数
+            chatstream_worker["disconnect_watcher"] = self.disconnect_watcher.get_stats()
+
+        if self.response_cache is not None:
+            # レスポンスキャッシュのヒット数・ミス数
+            chatstream_worker["response_cache"] = self.response_cache.get_stats()
+
+        if self.model_registry is not None:
+            # モデルごとの処理状況と、読み込み済のモデルのメモリ使用量
+            chatstream_worker["model_registry"] = self.model_registry.get_loads()
+
         return {
             "success": True,
             "message": "success",
-            "chatstream_workers": [
-                {
-                    "name": self.name,
-                    "processing": self.processing_queue.qsize(),
-                    "waiting": self.run_on_next_queue.qsize() + self.request_queue.qsize(),
-                    "_num_of_next_queue": self.run_on_next_queue.qsize(),
-                    "_num_of_request_queue": self.request_queue.qsize(),
-                    "max_processing": self.processing_queue.maxsize,
-                    "max_waiting": self.request_queue.maxsize + self.run_on_next_queue.maxsize
-                },
-            ],
+            "chatstream_workers": [chatstream_worker],
         }
 
     async def index(self, request: Request, response: Response, opts={}):
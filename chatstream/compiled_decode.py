@@ -0,0 +1,264 @@
+import threading
+import time
+
+import torch
+
+from .chat_core import sample_next_token
+from .kv_block_manager import get_model_kv_shape
+from .util_kv_cache import to_legacy_kv
+
+import transformers
+
+try:
+    from transformers import StaticCache
+except ImportError:  # StaticCache が無い transformers
+    StaticCache = None
+
+
+def get_static_cache_support_error(model):
+    """
+    CompiledDecoder が使う StaticCache の API がインストールされている transformers にあるかを確かめる
+
+    StaticCache(config=..., max_cache_len=...), early_initialization と、レイヤーごとの keys / values / cumulative_length は
+    比較的新しい transformers にしか無く、 StaticCache があっても古いものでは使えない。
+    1トークンぶんの StaticCache を実際に作って確かめる
+
+    :return: 使えない場合はその理由、使える場合は None
+    """
+    if StaticCache is None:
+        return f"transformers {transformers.__version__} has no StaticCache"
+    if not hasattr(StaticCache, "early_initialization"):
+        return f"StaticCache of transformers {transformers.__version__} has no early_initialization"
+
+    try:
+        _, num_kv_heads, head_dim = get_model_kv_shape(model)
+        parameter = next(model.parameters())
+        cache = StaticCache(config=model.config, max_cache_len=1)
+        cache.early_initialization(1, num_kv_heads, head_dim, parameter.dtype, parameter.device)
+        layers = cache.layers
+    except (TypeError, AttributeError) as e:
+        return f"StaticCache of transformers {transformers.__version__} is not supported ({e})"
+
+    if not all(hasattr(layer, attr) for layer in layers for attr in ["keys", "values", "cumulative_length"]):
+        return f"StaticCache layers of transformers {transformers.__version__} have no keys / values / cumulative_length"
+    return None
+
+
+class CompiledDecoder:
+    """
+    あらかじめ確保した静的なKVキャッシュ(StaticCache)と torch.compile で decode ステップを実行する
+
+    eager の HF モデルに伸び続ける past_key_values を渡して1トークンずつ forward すると、
+    小さな forward のたびに Python とディスパッチャのオーバーヘッドがかかる。
+    本クラスは KVキャッシュを [バッチサイズ, ヘッド, max_cache_len, 次元] の固定の形で確保し、
+    decode の入力(トークンID、position_ids、attention mask、cache_position)もすべて固定の形にそろえることで、
+    decode ステップを再コンパイルなしで torch.compile したグラフで実行する。
+
+    - バッチサイズはいくつかのバケット(batch_size_buckets)に切り上げ、バケットごとにコンパイル済のグラフを持つ
+    - prefill は入力長が毎回異なるため eager で実行し、KVキャッシュだけを静的なKVキャッシュに書き込む
+    - コンパイルは warmup() で起動時に済ませ、最初のユーザーのリクエストでコンパイルが走らないようにする
+    """
+
+    def __init__(self, model, max_cache_len, batch_size_buckets=(1,), backend="inductor", mode=None):
+        """
+        :param model: 事前学習済言語モデル
+        :param max_cache_len: 静的なKVキャッシュのシーケンス方向の長さ(コンテクストサイズ)
+        :param batch_size_buckets: コンパイルするバッチサイズのバケット
+        :param backend: torch.compile の backend
+        :param mode: torch.compile の mode
+        """
+        error = get_static_cache_support_error(model)
+        if error is not None:
+            raise ValueError(f"CompiledDecoder cannot be used: {error}. Upgrade transformers or disable use_compiled_decode")
+
+        self.model = model
+        self.max_cache_len = max_cache_len
+        self.batch_size_buckets = sorted(set(batch_size_buckets))
+        self.compiled_forward = torch.compile(model.forward, backend=backend, mode=mode, dynamic=False)
+
+        parameter = next(model.parameters())
+        self.dtype = parameter.dtype
+        self.device = parameter.device
+
+        self.free_caches = {bucket: [] for bucket in self.batch_size_buckets}  # 再利用する空きの StaticCache
+        self.lock = threading.Lock()  # 推論スレッドからも操作されるため
+
+        self.num_compiled_steps = 0  # コンパイル済のグラフで実行した decode ステップ数
+        self.benchmark = {}  # バケットごとの eager とコンパイル後の tokens/s (warmup で計測)
+
+    def get_bucket(self, batch_size):
+        """
+        バッチサイズを切り上げたバケットを返す。どのバケットにも収まらない場合は None
+        """
+        for bucket in self.batch_size_buckets:
+            if batch_size <= bucket:
+                return bucket
+        return None
+
+    def can_decode(self, batch_size, seq_len):
+        """
+        バッチサイズ batch_size で、シーケンス長 seq_len まで静的なKVキャッシュで decode できるかどうか
+        """
+        return self.get_bucket(batch_size) is not None and seq_len <= self.max_cache_len
+
+    def acquire_cache(self, batch_size):
+        """
+        バッチサイズが収まるバケットの空の StaticCache を取得する
+        """
+        bucket = self.get_bucket(batch_size)
+        with self.lock:
+            if self.free_caches[bucket]:
+                return self.free_caches[bucket].pop()
+
+        num_layers, num_kv_heads, head_dim = get_model_kv_shape(self.model)
+        cache = StaticCache(config=self.model.config, max_cache_len=self.max_cache_len)
+        cache.early_initialization(bucket, num_kv_heads, head_dim, self.dtype, self.device)
+        return cache
+
+    def release_cache(self, cache):
+        """
+        使い終わった StaticCache を空にして、次のリクエストで再利用できるようにする
+        """
+        cache.reset()
+        with self.lock:
+            self.free_caches[cache.layers[0].keys.shape[0]].append(cache)
+
+    def load(self, cache, past_key_values):
+        """
+        ((key, value), ...) [batch, heads, seq_len, head_dim] のKVキャッシュを StaticCache の先頭に書き込む
+
+        :return: StaticCache 上の、書き込んだ範囲のビュー ((key, value), ...)
+        """
+        batch_size, _, seq_len, _ = past_key_values[0][0].shape
+        for layer, (key, value) in zip(cache.layers, past_key_values):
+            layer.keys[:batch_size, :, :seq_len].copy_(key)
+            layer.values[:batch_size, :, :seq_len].copy_(value)
+            layer.cumulative_length.fill_(seq_len)
+        return self.get_views(cache, batch_size, seq_len)
+
+    @staticmethod
+    def get_views(cache, batch_size, seq_len):
+        """
+        StaticCache のうち、バッチの先頭 batch_size 行・シーケンスの先頭 seq_len までのビュー ((key, value), ...)
+        """
+        return tuple((layer.keys[:batch_size, :, :seq_len], layer.values[:batch_size, :, :seq_len])
+                     for layer in cache.layers)
+
+    def prefill(self, cache, input_ids, device):
+        """
+        プロンプトを eager で prefill し、KVキャッシュを StaticCache に書き込む(バッチサイズ1)
+
+        :return: 最終位置の logits [vocab_size]
+        """
+        seq_len = len(input_ids)
+        out = self.model(input_ids=torch.as_tensor([input_ids], device=device), past_key_values=cache,
+                         cache_position=torch.arange(seq_len, device=device), use_cache=True)
+        return out.logits[0][-1]
+
+    def decode(self, cache, token_ids, position_ids, attention_mask):
+        """
+        バッチ全体で1トークンぶんの decode をコンパイル済のグラフで実行する
+
+        入力はバケットのバッチサイズまで、attention mask は max_cache_len まで埋めて、常に同じ形で実行する
+
+        :param cache: StaticCache (seq_len = attention_mask の長さ - 1 まで書き込み済)
+        :param token_ids: 入力するトークンID [batch]
+        :param position_ids: 入力するトークンの position_id [batch]
+        :param attention_mask: 入力するトークンを含む attention mask [batch, seq_len + 1]
+        :return: logits [batch, vocab_size]
+        """
+        batch_size = len(token_ids)
+        bucket = cache.layers[0].keys.shape[0]
+        seq_len = attention_mask.shape[1] - 1
+        device = cache.layers[0].keys.device
+
+        input_ids = torch.zeros((bucket, 1), dtype=torch.long, device=device)
+        input_ids[:batch_size, 0] = torch.as_tensor(token_ids, device=device)
+        positions = torch.zeros((bucket, 1), dtype=torch.long, device=device)
+        positions[:batch_size, 0] = torch.as_tensor(position_ids, device=device)
+
+        # バケットを埋めるための行は先頭の位置だけを参照させる(すべて参照しない行があると softmax が NaN になるため)
+        mask = torch.zeros((bucket, self.max_cache_len), dtype=torch.long, device=device)
+        mask[:, 0] = 1
+        mask[:batch_size, :seq_len + 1] = attention_mask.to(device)
+
+        out = self.compiled_forward(input_ids=input_ids, position_ids=positions, attention_mask=mask,
+                                    past_key_values=cache, cache_position=torch.tensor([seq_len], device=device),
+                                    use_cache=True)
+        self.num_compiled_steps += 1
+        return out.logits[:batch_size, -1]
+
+    @torch.no_grad()
+    def generate(self, model, device, config, input_ids, token_counts, output_builder):
+        """
+        静的なKVキャッシュとコンパイル済の decode で1リクエストぶんの文章を生成し、
+        1トークン生成するごとに生成済の文章を yield する同期ジェネレータ
+        """
+        cache = self.acquire_cache(1)
+        try:
+            last_token_logits = self.prefill(cache, input_ids, device)
+            seq_len = len(input_ids)
+            while True:
+                token_id = sample_next_token(last_token_logits, config, token_counts, device)
+                if token_counts is not None:
+                    token_counts.add(token_id)
+
+                stopped = output_builder.append(token_id)
+                yield output_builder.text
+                if stopped:
+                    break
+
+                attention_mask = torch.ones((1, seq_len + 1), dtype=torch.long)
+                last_token_logits = self.decode(cache, [token_id], [seq_len], attention_mask)[0]
+                seq_len += 1
+        finally:
+            self.release_cache(cache)
+
+    @torch.no_grad()
+    def warmup(self, num_steps=16, prompt_len=8):
+        """
+        バケットごとに decode をコンパイルし、eager とコンパイル後の decode の tokens/s を計測する
+        """
+        device = self.device
+        for bucket in self.batch_size_buckets:
+            prompt = torch.ones((bucket, prompt_len), dtype=torch.long, device=device)
+
+            # eager (伸び続ける past_key_values)
+            out = self.model(input_ids=prompt, use_cache=True)
+            past_key_values = out.past_key_values
+            next_ids = torch.ones((bucket, 1), dtype=torch.long, device=device)
+            start = time.perf_counter()
+            for _ in range(num_steps):
+                out = self.model(input_ids=next_ids, past_key_values=past_key_values, use_cache=True)
+                past_key_values = out.past_key_values
+            eager_sec = time.perf_counter() - start
+            del past_key_values
+
+            # コンパイル後(最初の1ステップでコンパイルされるので、計測から除く)
+            cache = self.acquire_cache(bucket)
+            try:
+                self.load(cache, to_legacy_kv(self.model(input_ids=prompt, use_cache=True).past_key_values))
+                token_ids = [1] * bucket
+                attention_mask = torch.ones((bucket, prompt_len + 1), dtype=torch.long)
+                self.decode(cache, token_ids, [prompt_len] * bucket, attention_mask)
+                start = time.perf_counter()
+                for step in range(1, num_steps + 1):
+                    attention_mask = torch.ones((bucket, prompt_len + step + 1), dtype=torch.long)
+                    self.decode(cache, token_ids, [prompt_len + step] * bucket, attention_mask)
+                compiled_sec = time.perf_counter() - start
+            finally:
+                self.release_cache(cache)
+
+            self.benchmark[bucket] = {
+                "eager_tokens_per_sec": bucket * num_steps / eager_sec,
+                "compiled_tokens_per_sec": bucket * num_steps / compiled_sec,
+            }
+        return self.benchmark
+
+    def get_stats(self):
+        return {
+            "batch_size_buckets": self.batch_size_buckets,
+            "max_cache_len": self.max_cache_len,
+            "compiled_steps": self.num_compiled_steps,
+            "benchmark": {str(bucket): result for bucket, result in self.benchmark.items()},
+        }
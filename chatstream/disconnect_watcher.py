@@ -0,0 +1,70 @@
+import asyncio
+
+CLIENT_DISCONNECTED_STATE_NAME = "chatstream_client_disconnected"
+
+
+def is_client_disconnected(request):
+    """
+    DisconnectWatcher によって、リクエストのクライアントの切断が検出されたかどうか
+    """
+    state = getattr(request, "state", None)
+    return getattr(state, CLIENT_DISCONNECTED_STATE_NAME, False)
+
+
+class DisconnectWatcher:
+    """
+    リクエストキューで待っているリクエストについて、クライアントが切断していないかを監視する
+
+    Starlette の StreamingResponse は、レスポンスを返し始めてからしか切断を検出しないため、
+    キューで待っている間にクライアントが去ったリクエストも、そのまま文章生成まで進んでしまう。
+    本クラスは監視しているリクエストごとに receive() を待つタスクを1つだけ動かし、
+    http.disconnect を受け取ったリクエストには request.state に印をつけて、 on_disconnect をコールバックする。
+
+    receive() を読むのはこのタスクだけとするため、文章生成を始める前(StreamingResponse が receive を読み始める前)に
+    unwatch で監視を終えること。文章生成中の切断は StreamingResponse が検出する。
+    また、リクエストボディを読み込む前に監視を始めるとボディが失われるため、先に request.body() で読み込んでおくこと
+    """
+
+    def __init__(self):
+        self.tasks = {}  # id(request) -> receive() を待つタスク
+
+        self.num_disconnected = 0  # 切断を検出したリクエスト数
+        self.num_removed_from_queue = 0  # 切断によりキューから取り除いたリクエスト数
+
+    def watch(self, request, on_disconnect=None):
+        """
+        リクエストの監視を始める
+
+        :param request: 監視するリクエスト
+        :param on_disconnect: 切断を検出したときに request を引数に呼び出す関数
+        """
+        self.tasks[id(request)] = asyncio.create_task(self._wait_for_disconnect(request, on_disconnect))
+
+    def unwatch(self, request):
+        """
+        リクエストの監視を終える(リクエストキューから取り出したとき)
+
+        receive() を待っている途中で取り消しても、メッセージは失われない
+        """
+        task = self.tasks.pop(id(request), None)
+        if task is not None:
+            task.cancel()
+
+    async def _wait_for_disconnect(self, request, on_disconnect):
+        while True:
+            message = await request.receive()
+            if message["type"] == "http.disconnect":
+                break
+
+        self.tasks.pop(id(request), None)
+        self.num_disconnected += 1
+        setattr(request.state, CLIENT_DISCONNECTED_STATE_NAME, True)
+        if on_disconnect is not None:
+            on_disconnect(request)
+
+    def get_stats(self):
+        return {
+            "watching": len(self.tasks),
+            "disconnected": self.num_disconnected,
+            "removed_from_queue": self.num_removed_from_queue,
+        }
@@ -0,0 +1,219 @@
+import asyncio
+import os
+import threading
+import time
+
+import torch
+
+from .inference_executor import InferenceExecutor
+
+
+def get_available_cpus():
+    """
+    このプロセスが使用できる CPU コアの番号のリスト
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def partition_cpus(cpus, num_slots, threads_per_slot):
+    """
+    CPU コアを num_slots 個の重ならないグループに分ける。コアが足りない場合は None (ピン留めしない)
+    """
+    if num_slots * threads_per_slot > len(cpus):
+        return None
+    return [cpus[index * threads_per_slot:(index + 1) * threads_per_slot] for index in range(num_slots)]
+
+
+class ExecutionSlot(InferenceExecutor):
+    """
+    1つの文章生成を実行する専用スレッド
+
+    スレッドの開始時に CPU アフィニティを設定する。アフィニティはスレッドごとに保持されるため、
+    このスレッドで実行する forward は、割り当てられたコアのグループの中だけで実行される。
+
+    intra-op スレッド数(torch.set_num_threads)はプロセス全体で共有される設定のため、スレッドの開始時ではなく
+    ジョブを実行する直前に確認して設定する(ExecutionSlotPool の benchmark が途中で元のスレッド数に戻すことがあるため)
+    """
+
+    def __init__(self, index, num_threads, cpus=None):
+        self.index = index
+        self.num_threads = num_threads
+        self.cpus = cpus  # None の場合はアフィニティを設定しない
+        self.pinned = False
+        self.num_generations = 0
+        self.busy = False
+        super().__init__(thread_name_prefix=f"chatstream-slot-{index}", initializer=self._initialize_thread)
+
+    def _initialize_thread(self):
+        if self.cpus is not None and hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(0, self.cpus)  # 0 は呼び出したスレッド自身
+                self.pinned = True
+            except OSError:
+                self.pinned = False
+
+    def _run_with_num_threads(self, func, *args, **kwargs):
+        if torch.get_num_threads() != self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        return func(*args, **kwargs)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        このスロットのスレッドで、 intra-op スレッド数を設定してから func を実行し、その結果を待つ
+        """
+        return await super().run(self._run_with_num_threads, func, *args, **kwargs)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        run の同期版。 concurrent.futures.Future を返す
+        """
+        return self.executor.submit(self._run_with_num_threads, func, *args, **kwargs)
+
+
+class ExecutionSlotPool:
+    """
+    同時に実行する文章生成ごとに、 CPU コアを分けた実行スロット(ExecutionSlot)を割り当てるプール
+
+    num_of_concurrent_executions=2 で2つの文章生成を同時に行うと、どちらも torch のプロセス全体の intra-op スレッドプールを
+    共有し、1トークンずつの小さな forward が交互に全コアを奪い合うため、キャッシュが荒れ、コアも過剰に割り当てられる。
+    本クラスはコアを重ならないグループに分け、文章生成1つを1つのスロット(専用スレッド)で最後まで実行する。
+
+    InferenceExecutor と同じ run / iterate を持ち、 process_chat などの executor として渡せる
+
+    【intra-op スレッド数について】
+    torch.set_num_threads はプロセス全体の設定で、あとから作られるスレッドもその値を使う。
+    そのため、スロットでジョブを実行するとプロセス全体の intra-op スレッド数が threads_per_slot になる
+    (すべてのスロットは同じ値を使うため、スロットどうしで設定を奪い合うことはない)。
+    プールを作成したときのスレッド数は original_num_threads に保持し、 shutdown で元に戻す
+    """
+
+    def __init__(self, num_slots, threads_per_slot=None, pin_threads=True):
+        """
+        :param num_slots: スロット数(同時に実行する文章生成の数)
+        :param threads_per_slot: スロットごとの intra-op スレッド数。 None の場合は使用できるコア数をスロット数で等分する
+        :param pin_threads: True: スロットごとに重ならないコアのグループへ CPU アフィニティを設定する(コアが足りる場合のみ)
+        """
+        cpus = get_available_cpus()
+        if threads_per_slot is None:
+            threads_per_slot = max(1, len(cpus) // num_slots)
+
+        self.num_slots = num_slots
+        self.threads_per_slot = threads_per_slot
+        self.original_num_threads = torch.get_num_threads()  # スロットがプロセスの intra-op スレッド数を変える前の値
+        self.cpu_groups = partition_cpus(cpus, num_slots, threads_per_slot) if pin_threads else None
+
+        self.slots = [ExecutionSlot(index, threads_per_slot,
+                                    cpus=self.cpu_groups[index] if self.cpu_groups is not None else None)
+                      for index in range(num_slots)]
+        self.free_slots = None  # 空きスロットのキュー (イベントループ上で作る)
+
+        self.benchmark_result = None
+
+    def _get_free_slots(self):
+        if self.free_slots is None:
+            self.free_slots = asyncio.Queue()
+            for slot in self.slots:
+                self.free_slots.put_nowait(slot)
+        return self.free_slots
+
+    async def acquire(self):
+        slot = await self._get_free_slots().get()
+        slot.busy = True
+        return slot
+
+    def release(self, slot):
+        slot.busy = False
+        self._get_free_slots().put_nowait(slot)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        空いているスロットで func を実行し、その結果を待つ
+        """
+        slot = await self.acquire()
+        try:
+            return await slot.run(func, *args, **kwargs)
+        finally:
+            self.release(slot)
+
+    async def iterate(self, generator):
+        """
+        空いているスロットを1つ確保し、同期ジェネレータを最後までそのスロットのスレッドで進める
+        """
+        slot = await self.acquire()
+        slot.num_generations += 1
+        try:
+            async for item in slot.iterate(generator):
+                yield item
+        finally:
+            self.release(slot)
+
+    def shutdown(self):
+        for slot in self.slots:
+            slot.shutdown()
+        # スロットが変更したプロセス全体の intra-op スレッド数を元に戻す
+        torch.set_num_threads(self.original_num_threads)
+
+    @torch.no_grad()
+    def benchmark(self, model, prompt_len=16, max_new_tokens=32):
+        """
+        スロット数ぶんの greedy の decode を同時に実行し、合計の tokens/s を
+        従来の(プロセス全体の intra-op スレッドプールを共有する)場合と、スロットで実行する場合とで比較する
+
+        従来の場合は、プールを作成する前の intra-op スレッド数(original_num_threads)に戻してから計測する
+        """
+        device = next(model.parameters()).device
+
+        def decode():
+            input_ids = torch.ones((1, prompt_len), dtype=torch.long, device=device)
+            out = model(input_ids=input_ids, use_cache=True)
+            for _ in range(max_new_tokens):
+                next_ids = torch.argmax(out.logits[:, -1:], dim=-1)
+                out = model(input_ids=next_ids, past_key_values=out.past_key_values, use_cache=True)
+
+        def measure(run_all):
+            start = time.perf_counter()
+            run_all()
+            return self.num_slots * max_new_tokens / (time.perf_counter() - start)
+
+        def run_on_shared_pool():
+            # スロットが intra-op スレッド数を変えている場合があるため、従来のスレッド数に戻してから実行する
+            torch.set_num_threads(self.original_num_threads)
+            threads = [threading.Thread(target=decode) for _ in range(self.num_slots)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        def run_on_slots():
+            futures = [slot.submit(decode) for slot in self.slots]
+            for future in futures:
+                future.result()
+
+        # 従来の場合を、スロットがプロセスの intra-op スレッド数を変える前に計測する
+        # (それぞれ1回目は、スレッドの初期化と最初の forward の遅延初期化を計測から除くために実行する)
+        run_on_shared_pool()
+        shared_tokens_per_sec = measure(run_on_shared_pool)
+        run_on_slots()
+        slots_tokens_per_sec = measure(run_on_slots)
+
+        self.benchmark_result = {
+            "shared_pool_tokens_per_sec": shared_tokens_per_sec,
+            "slots_tokens_per_sec": slots_tokens_per_sec,
+            "speedup": round(slots_tokens_per_sec / shared_tokens_per_sec, 4),
+        }
+        return self.benchmark_result
+
+    def get_stats(self):
+        return {
+            "num_slots": self.num_slots,
+            "threads_per_slot": self.threads_per_slot,
+            "slots": [{
+                "cpus": slot.cpus,
+                "pinned": slot.pinned,
+                "busy": slot.busy,
+                "generations": slot.num_generations,
+            } for slot in self.slots],
+            "benchmark": self.benchmark_result,
+        }
@@ -0,0 +1,79 @@
+class IncrementalDetokenizer:
+    """
+    生成されたトークンを1つずつ受け取り、新たに確定した文字列(差分)だけを返すデトークナイザ
+
+    トークンが生成されるたびに、プロンプトを含むトークン列全体を tokenizer.decode すると、
+    1トークンあたりのコストが会話履歴の長さに比例してしまう。
+    本クラスは直近の数トークンぶんの窓だけをデコードするため、1トークンあたりのコストは会話履歴の長さによらない。
+
+    - SentencePiece 系トークナイザは、デコード結果の先頭の空白("▁")を落とすため、
+      直前のトークン(lookback)を含めた窓でデコードし、その差分を新たな文字列とする
+    - バイトフォールバックなどでマルチバイト文字が複数トークンに分割される場合、文字が完成するまでは
+      デコード結果の末尾が置換文字(U+FFFD)となるので、完成するまで出力を保留する
+    """
+
+    def __init__(self, tokenizer, prompt_token_ids=None, skip_special_tokens=True, lookback=5):
+        """
+        :param tokenizer: HuggingFace style tokenizer
+        :param prompt_token_ids: プロンプトのトークンID。生成トークンの直前の文脈としてデコード窓に含める
+        :param skip_special_tokens: デコード時に特殊トークンを除くかどうか
+        :param lookback: デコード窓に含める直前のトークン数
+        """
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+
+        context_ids = list(prompt_token_ids[-lookback:]) if prompt_token_ids else []
+        self.token_ids = context_ids  # デコード窓の計算に必要な範囲のトークンID
+        self.prefix_offset = 0  # デコード窓の先頭
+        self.read_offset = len(context_ids)  # ここまでのトークンは文字列として出力済
+        self.text = ""  # 生成されたトークンから確定した文字列全体
+
+    def put(self, token_id):
+        """
+        生成されたトークンを1つ追加し、新たに確定した文字列を返す
+
+        :param token_id: 生成されたトークンID
+        :return: 新たに確定した文字列。文字が未完成の場合は空文字
+        """
+        self.token_ids.append(token_id)
+
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            # 特殊トークンのみ、またはマルチバイト文字の途中のため、まだ出力しない
+            return ""
+
+        delta = new_text[len(prefix_text):]
+        self._advance()
+        self.text += delta
+        return delta
+
+    def flush(self):
+        """
+        保留中のトークンを強制的に文字列にして返す（生成終了時に呼び出す）
+        """
+        if self.read_offset >= len(self.token_ids):
+            return ""
+
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        delta = new_text[len(prefix_text):]
+        self._advance()
+        self.text += delta
+        return delta
+
+    def _advance(self):
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+
+        # デコード窓より前のトークンはもう参照しないので捨てる
+        if self.prefix_offset > 0:
+            del self.token_ids[:self.prefix_offset]
+            self.read_offset -= self.prefix_offset
+            self.prefix_offset = 0
+
+    def _decode(self, token_ids):
+        if not token_ids:
+            return ""
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
@@ -0,0 +1,56 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+_END_OF_GENERATION = object()
+
+
+class InferenceExecutor:
+    """
+    モデルの forward とサンプリングを、イベントループとは別の専用スレッドで実行するためのエグゼキュータ
+
+    process_chat の中で model(...) を直接呼び出すと、 prefill や decode を実行している間
+    uvicorn のイベントループがブロックされ、 get_load などの他の Web API や、他のストリームへの送出が止まってしまう。
+    torch は演算中に GIL を解放するため、推論を専用スレッドで実行すればイベントループは応答可能なままとなる。
+
+    推論スレッドは1本だけ使用するため、複数リクエストの forward は同時には実行されず、
+    ジョブの投入順（おおむねトークン単位のラウンドロビン）に処理される。
+    """
+
+    def __init__(self, thread_name_prefix="chatstream-inference", initializer=None):
+        """
+        :param thread_name_prefix: 推論スレッドの名前
+        :param initializer: 推論スレッドの開始時に、そのスレッド上で呼び出す関数
+        """
+        self.thread_name_prefix = thread_name_prefix
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=thread_name_prefix,
+                                           initializer=initializer)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        推論スレッドで func を実行し、その結果を待つ
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def iterate(self, generator):
+        """
+        同期ジェネレータを推論スレッドで1要素ずつ進め、非同期ジェネレータとして yield する
+
+        1要素(=1トークン)ごとにジョブを投入するため、他のリクエストのジョブと交互に実行される。
+        途中で終了（クライアントからの切断など）した場合は、推論スレッド上でジェネレータを close する
+
+        :param generator: 同期ジェネレータ（ generate_chat など ）
+        """
+        try:
+            while True:
+                item = await self.run(next, generator, _END_OF_GENERATION)
+                if item is _END_OF_GENERATION:
+                    break
+                yield item
+        finally:
+            # ジェネレータの後始末(KVキャッシュの解放など)も推論スレッドで行う
+            self.executor.submit(generator.close)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,255 @@
+import threading
+
+import torch
+
+
+# forward の間だけプールの外に確保されるKVキャッシュが、1シーケンスあたりそのKVキャッシュ何個ぶんになるか
+# (gather で集めた密なKVキャッシュと、モデルが新しいトークンを連結して返すKVキャッシュの2つ)
+NUM_WORKING_COPIES = 2
+
+
+class KVCacheOutOfBlocksError(Exception):
+    """
+    KVキャッシュのブロックが不足して、トークンを格納できなかった
+    """
+    pass
+
+
+class KVBlockTable:
+    """
+    1シーケンスぶんのKVキャッシュが格納されているブロックの一覧(ブロックテーブル)
+    """
+
+    def __init__(self):
+        self.block_ids = []  # 論理ブロック順の物理ブロックID
+        self.num_tokens = 0  # 格納済のトークン数
+
+
+def get_model_kv_shape(model):
+    """
+    モデルの設定から (レイヤー数, KVのヘッド数, ヘッドの次元数) を求める
+    """
+    config = model.config
+    num_layers = config.num_hidden_layers
+    num_heads = config.num_attention_heads
+    num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+    return num_layers, num_kv_heads, head_dim
+
+
+def get_kv_bytes_per_token(model):
+    """
+    1トークンぶんのKVキャッシュ(全レイヤーの key と value)のバイト数
+    """
+    num_layers, num_kv_heads, head_dim = get_model_kv_shape(model)
+    element_size = torch.tensor([], dtype=next(model.parameters()).dtype).element_size()
+    return 2 * num_layers * num_kv_heads * head_dim * element_size
+
+
+class KVBlockManager:
+    """
+    あらかじめ確保した固定サイズのブロックのプールに、各シーケンスのKVキャッシュを格納する paged KV cache
+
+    モデルが返す past_key_values をシーケンスごとに持ち続けると、同時に生成するユーザー数が増えるにつれて
+    メモリ使用量が予測できなくなる。
+    本クラスは KVキャッシュ用のメモリを最初に一括で確保し、それを block_size トークンずつのブロックに分けて管理する。
+
+    - 各シーケンスはブロックテーブル(KVBlockTable)を持ち、トークンが増えるたびにブロックを1つずつ割り当てる
+    - fork したシーケンスはブロックを共有し(参照カウント)、共有中のブロックに書き込むときだけコピーする(copy-on-write)
+    - forward の直前に、ブロックからバッチぶんのKVキャッシュを(左パディングして)集めてモデルに入力する
+
+    ステップ間でKVキャッシュを保持するのはプールだけになるため、保持できるトークン数はプールの大きさで決まる。
+    ただし forward の間は、集めた密なKVキャッシュと、モデルがそれに新しいトークンを連結したKVキャッシュが
+    プールの外に一時的に確保される(1トークンごとにコンテクスト全体のコピーが発生する)。
+    from_model で context_len を指定すると、この作業領域(NUM_WORKING_COPIES 個ぶん)も含めて memory_bytes に収まるようにプールを確保する
+    """
+
+    def __init__(self, num_layers, num_kv_heads, head_dim, num_blocks, block_size=16, dtype=torch.float32,
+                 device="cpu"):
+        """
+        :param num_layers: モデルのレイヤー数
+        :param num_kv_heads: KVのヘッド数
+        :param head_dim: ヘッドの次元数
+        :param num_blocks: プールのブロック数
+        :param block_size: 1ブロックに格納するトークン数
+        :param dtype: KVキャッシュのデータ型
+        :param device: プールを確保するデバイス
+        """
+        self.num_layers = num_layers
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+
+        # [レイヤー, スロット, ヘッド, 次元] スロット = ブロックID * block_size + ブロック内の位置
+        # 最後の1スロットは左パディング用で、常にゼロのまま
+        pool_shape = (num_layers, num_blocks * block_size + 1, num_kv_heads, head_dim)
+        self.key_pool = torch.zeros(pool_shape, dtype=dtype, device=device)
+        self.value_pool = torch.zeros(pool_shape, dtype=dtype, device=device)
+        self.pad_slot = num_blocks * block_size
+
+        self.free_block_ids = list(range(num_blocks - 1, -1, -1))
+        self.ref_counts = [0] * num_blocks
+        self.lock = threading.Lock()  # 推論スレッドからも操作されるため
+
+        self.working_set_bytes = 0  # forward の間にプールの外に確保される作業領域の上限として、予算から差し引いたバイト数
+
+    @classmethod
+    def from_model(cls, model, memory_bytes, block_size=16, device=None, context_len=None):
+        """
+        モデルの設定と、KVキャッシュに使用するメモリのバイト数からプールを確保する
+
+        :param device: プールを確保するデバイス。 None の場合はモデルと同じデバイス
+        :param context_len: 指定した場合は、 context_len トークンのコンテクストを単位として、
+            プールと forward 中の作業領域(コンテクストあたり NUM_WORKING_COPIES 個ぶん)の合計が memory_bytes に収まる数だけブロックを確保する。
+            1コンテクストも収まらない場合はブロック数が 0 となる
+        """
+        num_layers, num_kv_heads, head_dim = get_model_kv_shape(model)
+        parameter = next(model.parameters())
+        dtype = parameter.dtype
+        if device is None:
+            device = parameter.device
+        block_bytes = get_kv_bytes_per_token(model) * block_size
+
+        if context_len is None:
+            num_blocks = max(1, memory_bytes // block_bytes)
+            return cls(num_layers, num_kv_heads, head_dim, num_blocks, block_size=block_size, dtype=dtype,
+                       device=device)
+
+        blocks_per_context = (context_len + block_size - 1) // block_size
+        context_bytes = block_bytes * blocks_per_context
+        num_contexts = memory_bytes // (context_bytes * (1 + NUM_WORKING_COPIES))
+        manager = cls(num_layers, num_kv_heads, head_dim, num_contexts * blocks_per_context, block_size=block_size,
+                      dtype=dtype, device=device)
+        manager.working_set_bytes = num_contexts * context_bytes * NUM_WORKING_COPIES
+        return manager
+
+    def get_num_blocks_for(self, num_tokens):
+        """
+        num_tokens トークンを格納するのに必要なブロック数
+        """
+        return (num_tokens + self.block_size - 1) // self.block_size
+
+    def get_num_free_blocks(self):
+        return len(self.free_block_ids)
+
+    def can_allocate(self, num_tokens):
+        return self.get_num_blocks_for(num_tokens) <= self.get_num_free_blocks()
+
+    def write(self, table, past_key_values, start=0):
+        """
+        KVキャッシュのシーケンス方向の start 以降を、ブロックテーブルの末尾に追加する
+
+        :param table: 書き込み先のブロックテーブル
+        :param past_key_values: ((key, value), ...) [1, heads, seq_len, head_dim]
+        :param start: 追加を開始するシーケンス方向の位置
+        """
+        num_new_tokens = past_key_values[0][0].shape[-2] - start
+        if num_new_tokens <= 0:
+            return
+        slots = torch.as_tensor(self._allocate_slots(table, num_new_tokens), dtype=torch.long,
+                                device=self.key_pool.device)
+        for layer_idx, (key, value) in enumerate(past_key_values):
+            # [1, heads, n, dim] -> [n, heads, dim]
+            self.key_pool[layer_idx].index_copy_(0, slots, key[0, :, start:, :].transpose(0, 1).to(self.key_pool))
+            self.value_pool[layer_idx].index_copy_(0, slots,
+                                                   value[0, :, start:, :].transpose(0, 1).to(self.value_pool))
+
+    def gather(self, tables):
+        """
+        複数のシーケンスのKVキャッシュをブロックから集め、左パディングしたバッチのKVキャッシュにする
+
+        :param tables: ブロックテーブルのリスト
+        :return: (((key, value), ...) [batch, heads, seq_len, head_dim], attention_mask [batch, seq_len])
+        """
+        max_len = max(table.num_tokens for table in tables)
+        slots = torch.cat([
+            torch.cat([torch.full((max_len - table.num_tokens,), self.pad_slot, dtype=torch.long),
+                       self._get_slots(table)])
+            for table in tables]).to(self.key_pool.device)
+        batch_shape = (len(tables), max_len) + tuple(self.key_pool.shape[2:])
+
+        past_key_values = tuple(
+            (self.key_pool[layer_idx].index_select(0, slots).view(batch_shape).transpose(1, 2),
+             self.value_pool[layer_idx].index_select(0, slots).view(batch_shape).transpose(1, 2))
+            for layer_idx in range(self.num_layers))
+        attention_mask = (slots != self.pad_slot).long().view(len(tables), max_len)
+        return past_key_values, attention_mask
+
+    def fork(self, table):
+        """
+        ブロックを共有する新しいブロックテーブルを作る(書き込まれるまでブロックはコピーしない)
+        """
+        with self.lock:
+            forked = KVBlockTable()
+            forked.block_ids = list(table.block_ids)
+            forked.num_tokens = table.num_tokens
+            for block_id in forked.block_ids:
+                self.ref_counts[block_id] += 1
+            return forked
+
+    def free(self, table):
+        """
+        ブロックテーブルのブロックを解放する
+        """
+        with self.lock:
+            for block_id in table.block_ids:
+                self.ref_counts[block_id] -= 1
+                if self.ref_counts[block_id] == 0:
+                    self.free_block_ids.append(block_id)
+            table.block_ids = []
+            table.num_tokens = 0
+
+    def get_stats(self):
+        num_free_blocks = self.get_num_free_blocks()
+        return {
+            "block_size": self.block_size,
+            "num_blocks": self.num_blocks,
+            "num_free_blocks": num_free_blocks,
+            "max_tokens": self.num_blocks * self.block_size,
+            "memory_bytes": self.key_pool.element_size() * (self.key_pool.nelement() + self.value_pool.nelement()),
+            "working_set_bytes": self.working_set_bytes,
+        }
+
+    def _allocate_slots(self, table, num_tokens):
+        """
+        ブロックテーブルの末尾に num_tokens ぶんのスロットを割り当てる
+        """
+        with self.lock:
+            offset = table.num_tokens % self.block_size
+            num_new_blocks = self.get_num_blocks_for(table.num_tokens + num_tokens) - len(table.block_ids)
+            is_last_block_shared = offset > 0 and self.ref_counts[table.block_ids[-1]] > 1
+            if num_new_blocks + (1 if is_last_block_shared else 0) > len(self.free_block_ids):
+                raise KVCacheOutOfBlocksError(
+                    f"Not enough KV cache blocks: {num_tokens} tokens requested, "
+                    f"{len(self.free_block_ids)} blocks free")
+
+            if is_last_block_shared:
+                # 共有中のブロックの途中に書き込むため、書き込む前にコピーする(copy-on-write)
+                self._copy_on_write(table, offset)
+
+            for _ in range(num_new_blocks):
+                block_id = self.free_block_ids.pop()
+                self.ref_counts[block_id] = 1
+                table.block_ids.append(block_id)
+
+            start = table.num_tokens
+            table.num_tokens += num_tokens
+            return [self._to_slot(table, pos) for pos in range(start, table.num_tokens)]
+
+    def _copy_on_write(self, table, num_filled):
+        src_block_id = table.block_ids[-1]
+        dst_block_id = self.free_block_ids.pop()
+        src = src_block_id * self.block_size
+        dst = dst_block_id * self.block_size
+        self.key_pool[:, dst:dst + num_filled] = self.key_pool[:, src:src + num_filled]
+        self.value_pool[:, dst:dst + num_filled] = self.value_pool[:, src:src + num_filled]
+        self.ref_counts[src_block_id] -= 1
+        self.ref_counts[dst_block_id] = 1
+        table.block_ids[-1] = dst_block_id
+
+    def _get_slots(self, table):
+        block_ids = torch.as_tensor(table.block_ids, dtype=torch.long)
+        slots = block_ids.unsqueeze(1) * self.block_size + torch.arange(self.block_size)
+        return slots.view(-1)[:table.num_tokens]
+
+    def _to_slot(self, table, pos):
+        return table.block_ids[pos // self.block_size] * self.block_size + pos % self.block_size
@@ -0,0 +1,177 @@
+from abc import ABC, abstractmethod
+
+import torch
+
+
+class TokenCounts:
+    """
+    1シーケンスぶんの、トークンIDごとの出現回数 [vocab_size]
+
+    繰り返しペナルティの計算に使う。これまでのトークンID列を毎回走査しなくてよいよう、
+    最初にまとめて数えたあとは、トークンが生成されるたびに add で1つずつ更新する
+    """
+
+    def __init__(self, token_ids=None):
+        """
+        :param token_ids: これまでのトークンID(プロンプトなど)
+        """
+        self.pending_token_ids = list(token_ids or [])  # 語彙サイズが分かるまで(最初の get まで)保留しているトークンID
+        self.counts = None
+
+    def add(self, token_id):
+        if self.counts is None:
+            self.pending_token_ids.append(token_id)
+        else:
+            self.counts[token_id] += 1
+
+    def get(self, vocab_size, device):
+        """
+        出現回数のテンソルを取得する
+
+        :param vocab_size: 語彙サイズ(logits の次元数)
+        :param device: テンソルのデバイス
+        :return: 出現回数 [vocab_size]
+        """
+        if self.counts is None:
+            token_ids = torch.as_tensor(self.pending_token_ids, dtype=torch.long)
+            self.counts = torch.bincount(token_ids, minlength=vocab_size)[:vocab_size].to(device)
+            self.pending_token_ids = None
+        return self.counts
+
+
+def _as_column(value, logits):
+    """
+    スカラーまたはシーケンスごとの値 [batch] を、 logits [batch, vocab_size] に対してブロードキャストできる形にする
+    """
+    if isinstance(value, torch.Tensor):
+        return value.to(device=logits.device, dtype=logits.dtype).view(-1, 1)
+    return value
+
+
+class LogitsProcessor(ABC):
+    """
+    logits [batch, vocab_size] を加工する処理の基底クラス
+    """
+
+    @abstractmethod
+    def __call__(self, logits, token_counts):
+        """
+        :param logits: logits [batch, vocab_size]
+        :param token_counts: トークンIDごとの出現回数 [batch, vocab_size] 。不要な場合は None
+        :return: 加工した logits [batch, vocab_size]
+        """
+        pass
+
+
+class RepetitionPenaltyProcessor(LogitsProcessor):
+    """
+    これまでに出現したトークンの logits にペナルティを与える
+
+    - multiplicative: 出現回数ぶんペナルティを掛ける (logits * penalty ** count)
+    - subtractive: 出現したトークンからペナルティを引く (logits - penalty)
+    """
+
+    def __init__(self, penalty, method="multiplicative"):
+        if not isinstance(penalty, (int, float, torch.Tensor)):
+            raise ValueError(f"penalty should be a scalar value, but got {penalty}({type(penalty)})")
+        if method not in ("multiplicative", "subtractive"):
+            raise ValueError(f"Unknown repetition penalty method: {method}")
+        self.penalty = penalty
+        self.method = method
+
+    def __call__(self, logits, token_counts):
+        # NaN は 0 に、 Inf はその dtype の最大値・最小値に置き換える
+        logits = torch.nan_to_num(logits)
+        penalty = _as_column(self.penalty, logits)
+        counts = token_counts.to(logits.dtype)
+        if self.method == "multiplicative":
+            return logits * torch.pow(penalty, counts)
+        return logits - penalty * (counts > 0).to(logits.dtype)
+
+
+class TemperatureProcessor(LogitsProcessor):
+    def __init__(self, temperature):
+        self.temperature = temperature
+
+    def __call__(self, logits, token_counts):
+        return logits / _as_column(self.temperature, logits)
+
+
+class TopKProcessor(LogitsProcessor):
+    """
+    logits の上位 k 個以外を候補から外す
+    """
+
+    def __init__(self, k):
+        self.k = k  # スカラー、またはシーケンスごとの値 [batch]
+
+    def __call__(self, logits, token_counts):
+        vocab_size = logits.shape[-1]
+        if isinstance(self.k, torch.Tensor):
+            k = self.k.to(device=logits.device, dtype=torch.long).clamp(1, vocab_size).view(-1, 1)
+            top_values = torch.topk(logits, int(k.max()), dim=-1).values
+            kth_values = top_values.gather(-1, k - 1)
+        else:
+            kth_values = torch.topk(logits, min(int(self.k), vocab_size), dim=-1).values[..., -1:]
+        return logits.masked_fill(logits < kth_values, float("-inf"))
+
+
+class TopPProcessor(LogitsProcessor):
+    """
+    確率の高い順に累積確率が p を超えるまでのトークン以外を候補から外す(nucleus sampling)
+    """
+
+    def __init__(self, p):
+        self.p = p  # スカラー、またはシーケンスごとの値 [batch]
+
+    def __call__(self, logits, token_counts):
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+        cumulative_probs = torch.cumsum(torch.softmax(sorted_logits, dim=-1), dim=-1)
+
+        # 累積確率が p を超えたトークンの次から外す(先頭のトークンは必ず残す)
+        sorted_indices_to_remove = cumulative_probs > _as_column(self.p, cumulative_probs)
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = False
+
+        indices_to_remove = sorted_indices_to_remove.scatter(-1, sorted_indices, sorted_indices_to_remove)
+        return logits.masked_fill(indices_to_remove, float("-inf"))
+
+
+class LogitsProcessorList(list):
+    """
+    LogitsProcessor を順に適用するパイプライン
+    """
+
+    def __call__(self, logits, token_counts=None):
+        for processor in self:
+            logits = processor(logits, token_counts)
+        return logits
+
+
+def build_logits_processors(temperature=1.0, top_k=None, top_p=None, repetition_penalty=None,
+                            repetition_penalty_method="multiplicative"):
+    """
+    生成パラメータから、繰り返しペナルティ → temperature → top-k → top-p の順に適用するパイプラインを作る
+
+    :return: LogitsProcessorList
+    """
+    processors = LogitsProcessorList()
+    if repetition_penalty is not None:
+        processors.append(RepetitionPenaltyProcessor(repetition_penalty, repetition_penalty_method))
+    if temperature is not None and temperature != 1.0:
+        processors.append(TemperatureProcessor(temperature))
+    if top_k is not None:
+        processors.append(TopKProcessor(top_k))
+    if top_p is not None and top_p < 1.0:
+        processors.append(TopPProcessor(top_p))
+    return processors
+
+
+def sample_from_logits(logits):
+    """
+    加工済の logits [batch, vocab_size] から、シーケンスごとにトークンIDを1つずつサンプリングする
+
+    :return: トークンID [batch]
+    """
+    probabilities = torch.softmax(logits, dim=-1)
+    return torch.multinomial(probabilities, num_samples=1).view(-1)
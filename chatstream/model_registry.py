@@ -0,0 +1,300 @@
+import asyncio
+import collections
+import gc
+import logging
+import time
+
+import torch
+
+from .chat_process import ChatGenerator
+from .easy_locale import EasyLocale
+from .merge_dic import merge_dict
+from .quantization import get_model_bytes
+
+MODEL_SLOT_STATE_NAME = "chatstream_model_slot"
+
+
+def get_model_slot(request):
+    """
+    ChatStream がリクエストキューに入れる前に確保した、そのリクエストのモデルの ModelEntry 。確保していない場合は None
+    """
+    state = getattr(request, "state", None)
+    return getattr(state, MODEL_SLOT_STATE_NAME, None)
+
+
+class ModelEntry:
+    """
+    ModelRegistry に登録された1つのモデル
+    """
+
+    def __init__(self, name, model_loader, chat_prompt_clazz, num_of_concurrent_executions=1, params=None,
+                 memory_bytes=None):
+        self.name = name
+        self.model_loader = model_loader  # (model, tokenizer) を返す関数
+        self.chat_prompt_clazz = chat_prompt_clazz
+        self.params = params or {}  # このモデルだけの生成パラメータ(ChatStream の生成パラメータに上書きする)
+        self.memory_bytes = memory_bytes  # モデルのメモリ使用量。 None の場合は読み込んだあとに計測する
+
+        # モデルごとの同時処理数(スケジューリングのスロット)
+        self.max_processing = num_of_concurrent_executions
+        self.slots = asyncio.Semaphore(num_of_concurrent_executions)
+
+        self.chat_generator = None  # 読み込み済の場合はこのモデルの ChatGenerator
+        self.load_lock = asyncio.Lock()
+        self.loading = False
+
+        self.num_processing = 0
+        self.num_waiting = 0
+        self.num_loads = 0
+        self.num_unloads = 0
+
+    def is_loaded(self):
+        return self.chat_generator is not None
+
+    def is_in_use(self):
+        return self.num_processing > 0 or self.loading
+
+
+class ModelRegistry:
+    """
+    1つの ChatStream で複数のモデルを提供するためのモデルのレジストリ
+
+    リクエストは登録名でモデルを選ぶ。モデルは最初に使われたときに読み込み、
+    読み込み済のモデルのメモリ使用量の合計が max_memory_bytes を超える場合は、使われていないモデルのうち
+    最も長く使われていないもの(LRU)から取り除く。
+
+    - モデルごとに同時処理数(スロット)を持ち、 HTTP の受付・キューとセッション(会話履歴)は ChatStream で共有する
+      ChatStream はモデルのスロットをリクエストキューに入れる前に確保するため、混んでいるモデルを待つリクエストが
+      ChatStream 全体の同時処理数を占有して、空いているモデルへのリクエストを止めることはない
+    - ChatGenerator と同じ generate(chat_prompt, opts) を持ち、 opts の "model_name" でモデルを選ぶ
+    - セッションのKVキャッシュ・プレフィックスのKVキャッシュなど、単一の model を前提とした機能は使用しない
+    """
+
+    def __init__(self, device=None, max_memory_bytes=None, max_loaded_models=None):
+        """
+        :param device: モデルを実行するデバイス
+        :param max_memory_bytes: 読み込み済のモデルのメモリ使用量の合計の上限。 None の場合は制限しない
+        :param max_loaded_models: 同時に読み込んでおくモデル数の上限。 None の場合は制限しない
+        """
+        self.device = device
+        self.max_memory_bytes = max_memory_bytes
+        self.max_loaded_models = max_loaded_models
+
+        self.entries = collections.OrderedDict()  # 登録名 -> ModelEntry (最後に使われた順。末尾が最新)
+        self.default_model_name = None
+        self.params = {}  # すべてのモデルに共通の生成パラメータ(ChatStream が設定する)
+        self.response_cache = None  # すべてのモデルで共有する ResponseCache (ChatStream が設定する。キーにはモデルの登録名を含む)
+
+        self.condition = None  # モデルが使われなくなったことを待つための asyncio.Condition (イベントループ上で作る)
+
+        self.logger = logging.getLogger('chatstream')  # ChatStream に渡すと ChatStream の logger, eloc に置き換わる
+        self.eloc = EasyLocale({"locale": None})
+
+    def register(self, name, model_loader, chat_prompt_clazz, num_of_concurrent_executions=1, params=None,
+                 memory_bytes=None):
+        """
+        モデルを登録する。モデルはこの時点では読み込まない
+
+        :param name: モデルの登録名。リクエストの "model" で指定する
+        :param model_loader: (model, tokenizer) を返す関数
+        :param chat_prompt_clazz: このモデルのプロンプトを組み立てる ChatPrompt クラス
+        :param num_of_concurrent_executions: このモデルで同時に文章生成するリクエスト数
+        :param params: このモデルだけの生成パラメータ
+        :param memory_bytes: モデルのメモリ使用量の見積もり。 None の場合は読み込んだあとに計測する
+        """
+        if name in self.entries:
+            raise ValueError(f"Model '{name}' is already registered")
+
+        self.entries[name] = ModelEntry(name, model_loader, chat_prompt_clazz,
+                                        num_of_concurrent_executions=num_of_concurrent_executions, params=params,
+                                        memory_bytes=memory_bytes)
+        if self.default_model_name is None:
+            # 最初に登録したモデルを、モデルを指定しないリクエストで使う
+            self.default_model_name = name
+
+    def has_model(self, name):
+        return name is None or name in self.entries
+
+    def get_entry(self, name=None):
+        if name is None:
+            name = self.default_model_name
+        if name not in self.entries:
+            raise ValueError(f"Model '{name}' is not registered")
+        return self.entries[name]
+
+    def get_chat_prompt_clazz(self, name=None):
+        return self.get_entry(name).chat_prompt_clazz
+
+    def get_total_slots(self):
+        """
+        すべてのモデルのスロット数の合計(同時に文章生成しうるリクエスト数)
+        """
+        return sum(entry.max_processing for entry in self.entries.values())
+
+    def get_num_waiting(self):
+        return sum(entry.num_waiting for entry in self.entries.values())
+
+    async def acquire_slot(self, name=None):
+        """
+        モデルのスロットが空くのを待って確保する
+
+        :return: スロットを確保したモデルの ModelEntry
+        """
+        entry = self.get_entry(name)
+        entry.num_waiting += 1
+        try:
+            await entry.slots.acquire()
+        finally:
+            entry.num_waiting -= 1
+        return entry
+
+    def release_slot(self, entry):
+        entry.slots.release()
+
+    def supports_n_best(self):
+        """
+        登録したモデルはいずれもこのプロセスで直接読み込むため、 n 個の回答の生成に対応する
+        """
+        return True
+
+    async def generate(self, chat_prompt, opts={}):
+        """
+        opts の "model_name" で指定したモデル(無指定の場合は最初に登録したモデル)で文章生成する
+
+        そのモデルのスロットが空くのを待ち、読み込まれていなければ読み込んでから、
+        ChatGenerator.generate と同じ形式で yield する。
+        opts の "model_slot_acquired" が True の場合は、呼び出し元がすでにスロットを確保している(解放も呼び出し元が行う)
+        """
+        model_slot_acquired = opts.get("model_slot_acquired", False)
+        if model_slot_acquired:
+            entry = self.get_entry(opts.get("model_name", None))
+        else:
+            entry = await self.acquire_slot(opts.get("model_name", None))
+
+        try:
+            chat_generator = await self.load(entry)
+            entry.num_processing += 1
+            try:
+                async for output in chat_generator.generate(chat_prompt, opts):
+                    yield output
+            finally:
+                entry.num_processing -= 1
+                self.entries.move_to_end(entry.name)
+                await self._notify()
+        finally:
+            if not model_slot_acquired:
+                self.release_slot(entry)
+
+    async def load(self, entry):
+        """
+        モデルが読み込まれていなければ、メモリの上限に収まるよう他のモデルを取り除いてから読み込む
+
+        :return: モデルの ChatGenerator
+        """
+        async with entry.load_lock:
+            self.entries.move_to_end(entry.name)
+            if entry.is_loaded():
+                return entry.chat_generator
+
+            condition = self._get_condition()
+            async with condition:
+                # 取り除けるモデルが無い場合は、他のモデルの文章生成が終わるのを待つ
+                await condition.wait_for(lambda: self._make_room(entry))
+                entry.loading = True
+
+            try:
+                self.logger.info(self.eloc.to_str({
+                    "en": f"Loading model '{entry.name}'",
+                    "ja": f"モデル '{entry.name}' を読み込みます"}))
+
+                # 読み込みの間もイベントループを止めないよう、別スレッドで読み込む
+                start = time.perf_counter()
+                model, tokenizer = await asyncio.get_running_loop().run_in_executor(None, entry.model_loader)
+                load_sec = time.perf_counter() - start
+
+                entry.memory_bytes = get_model_bytes(model)
+                entry.chat_generator = ChatGenerator(model, tokenizer, self.device,
+                                                     merge_dict(self.params, entry.params),
+                                                     response_cache=self.response_cache, model_id=entry.name)
+                entry.num_loads += 1
+
+                self.logger.info(self.eloc.to_str({
+                    "en": f"Loaded model '{entry.name}' ({entry.memory_bytes} bytes) in {load_sec:.1f} sec",
+                    "ja": f"モデル '{entry.name}' ({entry.memory_bytes} バイト) を {load_sec:.1f} 秒で読み込みました"}))
+            finally:
+                entry.loading = False
+
+            # 読み込む前はメモリ使用量が分からなかった場合もあるため、読み込んだあとにもう一度上限に収める
+            self._make_room(entry)
+            return entry.chat_generator
+
+    def unload(self, entry):
+        """
+        モデルを取り除き、メモリを解放する
+        """
+        entry.chat_generator = None
+        entry.num_unloads += 1
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+        self.logger.info(self.eloc.to_str({
+            "en": f"Unloaded model '{entry.name}'",
+            "ja": f"モデル '{entry.name}' を取り除きました"}))
+
+    def get_loaded_memory_bytes(self):
+        return sum(entry.memory_bytes or 0 for entry in self.entries.values() if entry.is_loaded() or entry.loading)
+
+    def get_loads(self):
+        """
+        モデルごとの処理状況
+        """
+        return {
+            "max_memory_bytes": self.max_memory_bytes,
+            "loaded_memory_bytes": self.get_loaded_memory_bytes(),
+            "models": [{
+                "name": entry.name,
+                "loaded": entry.is_loaded(),
+                "processing": entry.num_processing,
+                "waiting": entry.num_waiting,
+                "max_processing": entry.max_processing,
+                "memory_bytes": entry.memory_bytes,
+                "loads": entry.num_loads,
+                "unloads": entry.num_unloads,
+            } for entry in self.entries.values()],
+        }
+
+    def _make_room(self, entry):
+        """
+        entry を読み込んでもメモリ使用量・モデル数の上限に収まるよう、使われていないモデルを古い順に取り除く
+
+        :return: 上限に収まった場合(または entry 以外に読み込み済のモデルが無い場合)は True
+        """
+
+        def other_entries():
+            return [e for e in self.entries.values() if e is not entry and (e.is_loaded() or e.loading)]
+
+        def fits():
+            num_loaded = len(other_entries()) + 1
+            memory_bytes = sum(e.memory_bytes or 0 for e in other_entries()) + (entry.memory_bytes or 0)
+            return ((self.max_loaded_models is None or num_loaded <= self.max_loaded_models) and
+                    (self.max_memory_bytes is None or memory_bytes <= self.max_memory_bytes))
+
+        while not fits():
+            # entries は最後に使われた順に並んでいるので、先頭から使われていないものを探す
+            idle_entries = [e for e in other_entries() if not e.is_in_use()]
+            if not idle_entries:
+                # entry 単体で上限を超える場合は、そのまま読み込む
+                return not other_entries()
+            self.unload(idle_entries[0])
+        return True
+
+    def _get_condition(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        return self.condition
+
+    async def _notify(self):
+        condition = self._get_condition()
+        async with condition:
+            condition.notify_all()
@@ -0,0 +1,241 @@
+import asyncio
+import itertools
+import multiprocessing
+import os
+import threading
+from multiprocessing.connection import wait
+
+import torch
+
+from .chat_core import generate_chat
+
+_END_OF_GENERATION = object()
+
+
+def _model_worker_main(worker_index, model_loader, device, num_threads, request_conn, response_conn):
+    """
+    モデルワーカープロセスのエントリポイント
+
+    モデルのレプリカを1つ読み込み、親プロセスから送られてくる文章生成リクエストを処理する。
+    複数のリクエストを受け付けた場合は、1トークンずつ順番に生成を進める。
+    生成された文章はトークンごとに response_conn 経由で親プロセスに送る
+
+    親プロセスとの間でやりとりするメッセージは (種別, リクエストID, ペイロード) のタプル
+    親→ワーカー: "generate" (params, prompt) / "cancel" / "shutdown"
+    ワーカー→親: "ready" / "output" 生成済の文章 / "end" / "error" エラーメッセージ
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    model, tokenizer = model_loader()
+    response_conn.send(("ready", None, worker_index))
+
+    active_generators = {}  # リクエストID -> 生成中の同期ジェネレータ
+
+    while True:
+        # 生成中のリクエストがなければ次のメッセージが届くまでブロックする
+        while not active_generators or request_conn.poll():
+            kind, request_id, payload = request_conn.recv()
+            if kind == "generate":
+                params, prompt = payload
+                active_generators[request_id] = generate_chat(model, tokenizer, device, params, prompt)
+            elif kind == "cancel":
+                generator = active_generators.pop(request_id, None)
+                if generator is not None:
+                    generator.close()
+            elif kind == "shutdown":
+                return
+
+        for request_id in list(active_generators):
+            generator = active_generators[request_id]
+            try:
+                output = next(generator, _END_OF_GENERATION)
+            except Exception as e:
+                del active_generators[request_id]
+                response_conn.send(("error", request_id, f"{type(e).__name__}: {e}"))
+                continue
+
+            if output is _END_OF_GENERATION:
+                del active_generators[request_id]
+                response_conn.send(("end", request_id, None))
+            else:
+                response_conn.send(("output", request_id, output))
+
+
+class ModelWorker:
+    """
+    ModelWorkerPool が管理するモデルワーカープロセス1つぶんの情報
+    """
+
+    def __init__(self, index, process, request_conn, response_conn, num_threads):
+        self.index = index
+        self.process = process
+        self.request_conn = request_conn  # ワーカーへのリクエスト送信用
+        self.response_conn = response_conn  # ワーカーからの生成結果受信用
+        self.num_threads = num_threads
+        self.request_ids = set()  # 現在このワーカーで処理中のリクエストID
+        self.ready = False
+        self.alive = True
+
+
+class ModelWorkerPool:
+    """
+    モデルのレプリカを持つ複数のワーカープロセスで文章生成を行うワーカープール
+
+    1プロセスに1モデルの構成では、コア数の多い CPU ホストでもほとんどのコアが遊んでしまう。
+    本クラスは K 個のワーカープロセスを起動し、それぞれにモデルのレプリカと CPU スレッドの一部を割り当てる。
+    リクエストは処理中のリクエスト数が最も少ないワーカーに振り分けられ、生成された文章はパイプ経由で
+    親プロセスに送られ、 process_chat と同じ形式で非同期ジェネレータから yield される。
+    """
+
+    def __init__(self, model_loader, device=None, num_workers=2, threads_per_worker=None, start_method="spawn"):
+        """
+        :param model_loader: (model, tokenizer) を返す関数。ワーカープロセスで呼び出されるため pickle 可能なトップレベル関数であること
+        :param device: ワーカープロセスでの実行デバイス
+        :param num_workers: ワーカープロセス数
+        :param threads_per_worker: 各ワーカーの intra-op スレッド数。 None の場合は CPU コア数をワーカー数で等分する
+        :param start_method: multiprocessing の開始方式
+        """
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+
+        self.model_loader = model_loader
+        self.device = device
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.mp_context = multiprocessing.get_context(start_method)
+
+        self.workers = []
+        self.response_queues = {}  # リクエストID -> 生成結果を受け取る asyncio.Queue
+        self.request_id_counter = itertools.count()
+        self.loop = None
+        self.reader_thread = None
+        self.running = False
+
+    def start(self):
+        """
+        ワーカープロセスと、生成結果を受信するスレッドを起動する
+        """
+        if self.running:
+            return
+        self.running = True
+
+        for index in range(self.num_workers):
+            request_recv_conn, request_send_conn = self.mp_context.Pipe(duplex=False)
+            response_recv_conn, response_send_conn = self.mp_context.Pipe(duplex=False)
+            process = self.mp_context.Process(
+                target=_model_worker_main,
+                args=(index, self.model_loader, self.device, self.threads_per_worker,
+                      request_recv_conn, response_send_conn),
+                name=f"chatstream-model-worker-{index}",
+                daemon=True)
+            process.start()
+            self.workers.append(
+                ModelWorker(index, process, request_send_conn, response_recv_conn, self.threads_per_worker))
+
+        self.reader_thread = threading.Thread(target=self._read_responses, name="chatstream-model-worker-reader",
+                                              daemon=True)
+        self.reader_thread.start()
+
+    async def generate(self, params, prompt):
+        """
+        最も空いているワーカーで文章生成を行い、process_chat と同じ形式で生成された文章を逐次 yield する
+
+        :param params: 生成パラメータ(process_chat と同じ)
+        :param prompt: プロンプト文字列、またはトークンIDのリスト
+        """
+        self.loop = asyncio.get_running_loop()
+        self.start()
+
+        worker = self._get_least_loaded_worker()
+        request_id = next(self.request_id_counter)
+        queue = asyncio.Queue()
+        self.response_queues[request_id] = queue
+        worker.request_ids.add(request_id)
+
+        finished = False
+        try:
+            worker.request_conn.send(("generate", request_id, (params, prompt)))
+            while True:
+                kind, payload = await queue.get()
+                if kind == "output":
+                    yield payload
+                elif kind == "end":
+                    finished = True
+                    break
+                else:
+                    finished = True
+                    raise RuntimeError(f"Model worker {worker.index} failed: {payload}")
+        finally:
+            if not finished and worker.alive:
+                # クライアントからの切断などで途中で終了した場合はワーカー側の生成も中止する
+                worker.request_conn.send(("cancel", request_id, None))
+            worker.request_ids.discard(request_id)
+            self.response_queues.pop(request_id, None)
+
+    def _get_least_loaded_worker(self):
+        alive_workers = [worker for worker in self.workers if worker.alive]
+        if not alive_workers:
+            raise RuntimeError("No model worker is alive")
+        return min(alive_workers, key=lambda worker: (len(worker.request_ids), worker.index))
+
+    def _read_responses(self):
+        """
+        ワーカーから届く生成結果を受信し、リクエストごとの asyncio.Queue に振り分ける(受信スレッドで実行)
+        """
+        conn_to_worker = {worker.response_conn: worker for worker in self.workers}
+
+        while self.running and conn_to_worker:
+            for conn in wait(list(conn_to_worker), timeout=0.5):
+                worker = conn_to_worker[conn]
+                try:
+                    kind, request_id, payload = conn.recv()
+                except (EOFError, OSError):
+                    # ワーカープロセスが終了した場合は、処理中のリクエストにエラーを通知する
+                    worker.alive = False
+                    del conn_to_worker[conn]
+                    for request_id in list(worker.request_ids):
+                        self._dispatch(request_id, "error", "worker process exited")
+                    continue
+
+                if kind == "ready":
+                    worker.ready = True
+                else:
+                    self._dispatch(request_id, kind, payload)
+
+    def _dispatch(self, request_id, kind, payload):
+        queue = self.response_queues.get(request_id)
+        if queue is not None and self.loop is not None:
+            self.loop.call_soon_threadsafe(queue.put_nowait, (kind, payload))
+
+    def get_worker_loads(self):
+        """
+        ワーカーごとの処理状況を取得する
+        """
+        return [
+            {
+                "index": worker.index,
+                "pid": worker.process.pid,
+                "ready": worker.ready,
+                "alive": worker.alive,
+                "processing": len(worker.request_ids),
+                "num_threads": worker.num_threads,
+            }
+            for worker in self.workers
+        ]
+
+    def shutdown(self):
+        """
+        すべてのワーカープロセスを終了する
+        """
+        self.running = False
+        for worker in self.workers:
+            if worker.alive:
+                try:
+                    worker.request_conn.send(("shutdown", None, None))
+                except (BrokenPipeError, OSError):
+                    pass
+        for worker in self.workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
@@ -0,0 +1,207 @@
+import heapq
+import itertools
+import threading
+
+from .session_kv_cache import common_prefix_len
+from .util_kv_cache import crop_kv, kv_nbytes, slice_kv, concat_kv_seq
+
+
+class PrefixTreeNode:
+    """
+    PrefixKVCache の radix tree のノード
+
+    親ノードから続くトークンID列(エッジ)と、そのトークンぶんだけのKVキャッシュのブロックを持つ
+    """
+
+    def __init__(self, parent, token_ids, past_key_values):
+        self.parent = parent
+        self.token_ids = token_ids  # このノードが表すトークンID列(タプル)
+        self.past_key_values = past_key_values  # token_ids ぶんのKVキャッシュ ((key, value), ...) バッチサイズは1
+        self.nbytes = kv_nbytes(past_key_values)
+        self.children = {}  # 先頭のトークンID -> 子ノード
+        self.ref_count = 0  # このノードを参照して生成中のリクエスト数。0 でない間は破棄しない
+        self.last_access = 0
+
+
+class PrefixKVCache:
+    """
+    全リクエストで共有する、トークンID列のプレフィックスをキーとしたKVキャッシュ
+
+    同じ ChatPrompt のプリセットを使うセッションは、システムプロンプトやロールの書式など先頭部分が共通であるにもかかわらず、
+    リクエストごとにその部分を prefill している。
+    本クラスは prefill したトークンID列とKVキャッシュを radix tree に格納しておき、
+    新しいリクエストは入力トークンID列と一致する最長のプレフィックスのKVキャッシュを取り出したうえで、
+    残りの部分だけを prefill する。
+
+    - 木のノードがKVキャッシュのブロックとなり、生成中のリクエストが参照しているノードは参照カウントで保護される
+    - 使用メモリが max_memory_bytes を超えた場合、参照されていない葉ノードを最も長く使われていないものから破棄する
+    """
+
+    def __init__(self, max_memory_bytes=256 * 1024 * 1024):
+        """
+        :param max_memory_bytes: KVキャッシュに使用する最大メモリ(バイト数)
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.root = PrefixTreeNode(None, (), ())
+        self.memory_bytes = 0
+        self.num_nodes = 0
+        self.lock = threading.Lock()  # 推論スレッドからも操作されるため
+        self.clock = itertools.count(1)  # LRU 用の論理時刻
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_saved_tokens = 0
+        self.num_requested_tokens = 0
+
+    def match(self, input_ids):
+        """
+        input_ids と一致する最長のプレフィックスのKVキャッシュを取り出す
+
+        次トークンの logits を得るために少なくとも1トークンは prefill する必要があるので、
+        再利用できるのは最大で len(input_ids) - 1 トークンまでとなる。
+        一致した場合は末端のノードの参照カウントを増やすため、生成終了後に release を呼び出すこと
+
+        :param input_ids: これから prefill する入力トークンID列
+        :return: (再利用できるトークン数, KVキャッシュ, 参照しているノード) 一致しない場合は (0, None, None)
+        """
+        with self.lock:
+            self.num_requested_tokens += len(input_ids)
+
+            target_ids = input_ids[:-1]
+            now = next(self.clock)
+            node = self.root
+            pos = 0
+            kv_parts = []
+
+            while pos < len(target_ids):
+                child = node.children.get(target_ids[pos])
+                if child is None:
+                    break
+                match_len = common_prefix_len(child.token_ids, target_ids[pos:])
+                if match_len == len(child.token_ids):
+                    kv_parts.append(child.past_key_values)
+                else:
+                    # エッジの途中まで一致した場合は、一致した部分のKVキャッシュだけを使う
+                    kv_parts.append(crop_kv(child.past_key_values, match_len))
+                child.last_access = now
+                node = child
+                pos += match_len
+                if match_len < len(child.token_ids):
+                    break
+
+            if pos == 0:
+                self.num_misses += 1
+                return 0, None, None
+
+            node.ref_count += 1
+            self.num_hits += 1
+            self.num_saved_tokens += pos
+            return pos, concat_kv_seq(kv_parts), node
+
+    def release(self, node):
+        """
+        match で参照したノードの参照カウントを減らす
+        """
+        if node is None:
+            return
+        with self.lock:
+            node.ref_count -= 1
+            self._evict()
+
+    def insert(self, token_ids, past_key_values):
+        """
+        prefill したトークンID列とそのKVキャッシュを格納する
+
+        すでに格納済の部分は共有し、新しい部分だけをコピーして新しいノードとする
+
+        :param token_ids: prefill したトークンID列
+        :param past_key_values: token_ids ぶんのKVキャッシュ ((key, value), ...) バッチサイズは1
+        """
+        if not token_ids or past_key_values is None:
+            return
+        with self.lock:
+            now = next(self.clock)
+            node = self.root
+            pos = 0
+
+            while pos < len(token_ids):
+                child = node.children.get(token_ids[pos])
+                if child is None:
+                    new_node = PrefixTreeNode(node, tuple(token_ids[pos:]),
+                                              slice_kv(past_key_values, pos, len(token_ids)))
+                    new_node.last_access = now
+                    node.children[token_ids[pos]] = new_node
+                    self.memory_bytes += new_node.nbytes
+                    self.num_nodes += 1
+                    break
+
+                match_len = common_prefix_len(child.token_ids, token_ids[pos:])
+                if match_len < len(child.token_ids):
+                    child = self._split(child, match_len)
+                child.last_access = now
+                node = child
+                pos += match_len
+
+            self._evict()
+
+    def get_stats(self):
+        with self.lock:
+            num_lookups = self.num_hits + self.num_misses
+            return {
+                "num_nodes": self.num_nodes,
+                "memory_bytes": self.memory_bytes,
+                "max_memory_bytes": self.max_memory_bytes,
+                "hits": self.num_hits,
+                "misses": self.num_misses,
+                "hit_rate": self.num_hits / num_lookups if num_lookups > 0 else 0.0,
+                "saved_prefill_tokens": self.num_saved_tokens,
+                "requested_prefill_tokens": self.num_requested_tokens,
+            }
+
+    def _split(self, node, split_len):
+        """
+        ノードのエッジを split_len の位置で分割し、前半部分を表す新しいノードを返す
+        """
+        parent = node.parent
+        mid_node = PrefixTreeNode(parent, node.token_ids[:split_len], slice_kv(node.past_key_values, 0, split_len))
+        mid_node.last_access = node.last_access
+        parent.children[mid_node.token_ids[0]] = mid_node
+
+        self.memory_bytes -= node.nbytes
+        node.past_key_values = slice_kv(node.past_key_values, split_len, len(node.token_ids))
+        node.nbytes = kv_nbytes(node.past_key_values)
+        node.token_ids = node.token_ids[split_len:]
+        node.parent = mid_node
+        mid_node.children[node.token_ids[0]] = node
+        self.memory_bytes += mid_node.nbytes + node.nbytes
+        self.num_nodes += 1
+
+        return mid_node
+
+    def _evict(self):
+        """
+        使用メモリが上限を超えている間、参照されていない葉ノードを最も長く使われていないものから破棄する
+        """
+        if self.memory_bytes <= self.max_memory_bytes:
+            return
+
+        leaves = [(node.last_access, id(node), node) for node in self._iter_nodes()
+                  if not node.children and node.ref_count == 0]
+        heapq.heapify(leaves)
+
+        while self.memory_bytes > self.max_memory_bytes and leaves:
+            _, _, node = heapq.heappop(leaves)
+            parent = node.parent
+            del parent.children[node.token_ids[0]]
+            self.memory_bytes -= node.nbytes
+            self.num_nodes -= 1
+
+            if parent is not self.root and not parent.children and parent.ref_count == 0:
+                heapq.heappush(leaves, (parent.last_access, id(parent), parent))
+
+    def _iter_nodes(self):
+        stack = list(self.root.children.values())
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children.values())
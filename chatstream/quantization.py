@@ -0,0 +1,134 @@
+import time
+import warnings
+
+import torch
+
+QUANTIZATION_METHODS = ("int8_dynamic",)
+
+# 量子化前後の出力のずれを確認するための、固定のプロンプト
+DEFAULT_CHECK_PROMPTS = [
+    "User: Hello, how are you?\nBot:",
+    "User: What is the capital of Japan?\nBot:",
+    "User: Please write a short poem about the sea.\nBot:",
+    "def fibonacci(n):",
+]
+
+
+def get_model_bytes(model):
+    """
+    モデルの重み(state_dict)のバイト数を求める。量子化済の Linear の packed params も含める
+    """
+
+    def get_bytes(value):
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(get_bytes(v) for v in value)
+        return 0
+
+    return sum(get_bytes(value) for value in model.state_dict().values())
+
+
+@torch.no_grad()
+def run_greedy(model, input_ids_list, max_new_tokens, device):
+    """
+    プロンプトごとに greedy で max_new_tokens トークンを生成する
+
+    :return: (プロンプト最終位置の logits のリスト, 生成したトークンIDのリスト, decode の tokens/s)
+    """
+    prompt_logits, generated_ids = [], []
+    num_decoded, decode_sec = 0, 0.0
+
+    for input_ids in input_ids_list:
+        out = model(input_ids=torch.as_tensor([input_ids], device=device), use_cache=True)
+        logits = out.logits[0][-1].float()
+        prompt_logits.append(logits)
+
+        token_ids = []
+        start = time.perf_counter()
+        for idx in range(max_new_tokens):
+            token_id = int(torch.argmax(logits))
+            token_ids.append(token_id)
+            if idx == max_new_tokens - 1:
+                break
+            out = model(input_ids=torch.as_tensor([[token_id]], device=device), past_key_values=out.past_key_values,
+                        use_cache=True)
+            logits = out.logits[0][-1].float()
+            num_decoded += 1
+        decode_sec += time.perf_counter() - start
+        generated_ids.append(token_ids)
+
+    tokens_per_sec = num_decoded / decode_sec if decode_sec > 0 else None
+    return prompt_logits, generated_ids, tokens_per_sec
+
+
+def quantize_model(model, tokenizer, quantization, device="cpu", check_prompts=None, max_new_tokens=8,
+                   min_token_agreement=0.8):
+    """
+    モデルの Linear を量子化し、量子化前後のメモリ使用量・ decode の tokens/s ・出力のずれをまとめたレポートを返す
+
+    量子化前のモデルで固定のプロンプト(check_prompts)を greedy で生成しておき、量子化後のモデルの出力と比較する。
+    重みは in-place で置き換えるため、量子化前のモデルのコピーは保持しない
+
+    :param model: 事前学習済言語モデル(CPU 上にあること)
+    :param tokenizer: トークナイザ
+    :param quantization: 量子化の方式。 "int8_dynamic": Linear の重みを int8 にし、活性は実行時に量子化する
+    :param device: 実行デバイス
+    :param check_prompts: 出力のずれを確認するプロンプトのリスト。 None の場合は DEFAULT_CHECK_PROMPTS
+    :param max_new_tokens: プロンプトごとに生成して比較するトークン数
+    :param min_token_agreement: 生成したトークンの一致率がこれを下回る場合は、レポートの drift.passed を False とする
+    :return: (量子化したモデル, レポート)
+    """
+    if quantization not in QUANTIZATION_METHODS:
+        raise ValueError(f"Unsupported quantization '{quantization}'. Supported: {', '.join(QUANTIZATION_METHODS)}")
+
+    if torch.device(device).type != "cpu":
+        raise ValueError(f"quantization='{quantization}' is only supported on cpu, but device is {device}")
+
+    if check_prompts is None:
+        check_prompts = DEFAULT_CHECK_PROMPTS
+
+    input_ids_list = [tokenizer.encode(prompt) for prompt in check_prompts]
+
+    bytes_before = get_model_bytes(model)
+    logits_before, ids_before, tokens_per_sec_before = run_greedy(model, input_ids_list, max_new_tokens, device)
+
+    with warnings.catch_warnings():
+        # torch.ao.quantization の非推奨の警告は、起動のたびに表示しない
+        warnings.simplefilter("ignore")
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    bytes_after = get_model_bytes(model)
+    logits_after, ids_after, tokens_per_sec_after = run_greedy(model, input_ids_list, max_new_tokens, device)
+
+    # 出力のずれ: プロンプト最終位置の logits の差と、greedy で生成したトークンの一致率
+    max_logit_diff = max(float((before - after).abs().max()) for before, after in zip(logits_before, logits_after))
+    top1_agreement = sum(int(torch.argmax(before) == torch.argmax(after))
+                         for before, after in zip(logits_before, logits_after)) / len(input_ids_list)
+    num_matched = sum(int(before == after)
+                      for seq_before, seq_after in zip(ids_before, ids_after)
+                      for before, after in zip(seq_before, seq_after))
+    token_agreement = num_matched / (len(input_ids_list) * max_new_tokens)
+
+    report = {
+        "method": quantization,
+        "memory": {
+            "model_bytes_before": bytes_before,
+            "model_bytes_after": bytes_after,
+            "reduction_ratio": round(1 - bytes_after / bytes_before, 4),
+        },
+        "tokens_per_sec": {
+            "before": tokens_per_sec_before,
+            "after": tokens_per_sec_after,
+            "speedup": round(tokens_per_sec_after / tokens_per_sec_before, 4)
+            if tokens_per_sec_before and tokens_per_sec_after else None,
+        },
+        "drift": {
+            "num_prompts": len(input_ids_list),
+            "max_logit_diff": max_logit_diff,
+            "top1_agreement": top1_agreement,
+            "token_agreement": token_agreement,
+            "passed": token_agreement >= min_token_agreement,
+        },
+    }
+    return model, report
@@ -7,6 +7,7 @@ import traceback
 from chatstream.access_control.client_role_authorizer_for_browser import ClientRoleAuthorizerForBrowser
 from chatstream.access_control.default_client_role_grant_middleware import CHAT_STREAM_CLIENT_ROLE
 from chatstream.default_finish_token import DEFAULT_FINISH_TOKEN
+from chatstream.model_registry import get_model_slot
 from chatstream.util_create_streaming_response import create_streaming_response
 from chatstream.util_request_id import req_id
 
@@ -33,11 +34,14 @@ class AbstractRequestHandler(ABC):
     def __init__(self):
         self.chat_generator = None
         self.chat_prompt_clazz = None
+        self.model_registry = None  # ModelRegistry を使う場合は、リクエストごとにモデルを選ぶ
+        self.max_num_alternatives = 1  # 1つのリクエストで生成できる回答の数(n)の上限
         self.logger = None
         self.eloc = None
         self.client_role_wrapper = None
 
-    async def generate(self, chat_prompt, chat_generation_finished_callback, request, custom_generation_params, message_id=None):
+    async def generate(self, chat_prompt, chat_generation_finished_callback, request, custom_generation_params, message_id=None,
+                       session_key=None, model_name=None, n=1, output_type="response_text"):
         f"""
         事前学習済言語モデルから逐次生成されたトークンを送出する非同期ジェネレーターを返す
         
@@ -54,17 +58,26 @@ class AbstractRequestHandler(ABC):
         "success" ... 文章生成が無事終了
         "client_disconnected_while_streaming" ... レスポンス送出中にクライアントからの切断またはネットワーク切断が発生した
         "unknown_error" ... 文章生成中に予期せぬエラーが発生した場合
+        :param session_key: 前回のターンのKVキャッシュを再利用するためのキー。会話履歴ごとに一意な値を指定する
+        :param model_name: ModelRegistry を使う場合に、文章生成するモデルの登録名。 None の場合は既定のモデル
+        :param n: 生成する回答の数。 2 以上の場合は1回の prefill から n 個の回答を生成し、 {"alternatives": [...]} の JSON を送出する
+        :param output_type: chat_generator.generate の output_type 。差分だけを送る場合は "updated_text"
         :return:                                 
         """
 
         # chat_generator.generate をラッピングすることで、 CancelledError をキャッチしてコールバックできるようにしている
         try:
             async for tok in self.chat_generator.generate(chat_prompt,
-                                                          {"output_type": "response_text",
+                                                          {"output_type": output_type,
                                                            "post_process_callback": chat_generation_finished_callback,
                                                            # 個々に設定できる生成パラメータ
                                                            "generation_params": custom_generation_params,
-                                                           "message_id": message_id
+                                                           "message_id": message_id,
+                                                           "session_key": session_key,
+                                                           "model_name": model_name,
+                                                           # ChatStream がリクエストキューに入れる前にモデルのスロットを確保済かどうか
+                                                           "model_slot_acquired": get_model_slot(request) is not None,
+                                                           "n": n,
                                                            }):
                 yield tok
         except asyncio.CancelledError:
@@ -84,6 +97,28 @@ class AbstractRequestHandler(ABC):
             # (このエラーは、generator が yield しはじめた場合、上位にあがらない)
             raise e
 
+    def get_chat_prompt_clazz(self, model_name=None):
+        """
+        モデルに対応する ChatPrompt クラスを返す。 ModelRegistry を使わない場合は chat_prompt_clazz
+        """
+        if self.model_registry is not None:
+            return self.model_registry.get_chat_prompt_clazz(model_name)
+        return self.chat_prompt_clazz
+
+    def convert_chat_prompt(self, chat_prompt, chat_prompt_clazz):
+        """
+        会話の途中でモデルが切り替わった場合に、それまでの会話を新しいモデルの ChatPrompt に移しかえる
+        """
+        new_chat_prompt = chat_prompt_clazz()
+        new_chat_prompt.build_initial_prompt(new_chat_prompt)
+        for chat_content in chat_prompt.chat_contents:
+            if chat_prompt.is_requester_role(chat_content.get_role()):
+                new_chat_prompt.add_requester_msg(chat_content.get_message())
+            else:
+                new_chat_prompt.add_responder_msg(chat_content.get_message())
+            new_chat_prompt.chat_contents[-1].set_message_id(chat_content.get_message_id())
+        return new_chat_prompt
+
     def detect_special_command_for_role_promotion(self, request, user_input, streaming_finished_callback):
         """
         ロール昇格のための特殊コマンドが入力されているかどうか確認し、入力されていれば、
@@ -8,6 +8,8 @@ from starlette.responses import JSONResponse
 
 from .request_handler import AbstractRequestHandler
 from ..util_request_id import req_id
+from ..util_server_sent_events import negotiate_stream_format, stream_server_sent_events, SSE_MEDIA_TYPE, \
+    STREAM_FORMAT_SSE, STREAM_FORMATS
 
 
 class SimpleSessionRequestHandler(AbstractRequestHandler):
@@ -54,6 +56,28 @@ class SimpleSessionRequestHandler(AbstractRequestHandler):
             # セッションオブジェクト（辞書オブジェクト）を取得する
             session = session_mgr.get_session()
 
+            if request_body is not None:
+                # request_body が明示的に指定された場合
+
+                self.logger.debug(self.eloc.to_str({
+                    "en": f"{req_id(request)} Since request_body is specified, the request data is retrieved from it. The request may have been intercepted by the Web API front-end.",
+                    "ja": f"{req_id(request)} request_body が指定されているため、そこからリクエストデータを取得します。リクエストが Web API のフロント処理でインターセプトされた可能性があります。"}))
+
+                # request はストリームで提供されるため、どこかで読み取ると consume されてしまう。
+                # そこで、もしどこかでインターセプトしてリクエストされたデータを使いたい場合は
+                # インターセプト元で request_body をキャッシュし、再度指定して chatstream を呼び出すことでrequest が consume されていても処理を先に進めることができる
+                data = json.loads(request_body)
+            else:
+                data = await request.json()
+
+            model_name = data.get("model", None)  # ModelRegistry を使う場合に、文章生成するモデルの登録名
+
+            if self.model_registry is not None and not self.model_registry.has_model(model_name):
+                return await self.return_bad_request_response(request, streaming_finished_callback,
+                                                              f"unknown model '{model_name}'")
+
+            chat_prompt_clazz = self.get_chat_prompt_clazz(model_name)
+
             if session.get("chat_prompt") is None:
                 # chat_prompt がまだセッションに格納されていない場合
 
@@ -61,7 +85,7 @@ class SimpleSessionRequestHandler(AbstractRequestHandler):
                     {"en": f"{req_id(request)} Since chat_prompt does not exist in the session, create a new one.",
                      "ja": f"{req_id(request)} chat_prompt がセッションに存在しないので、新規生成します"}))
 
-                chat_prompt = self.chat_prompt_clazz()  # ChatPrompt をインスタンス化する
+                chat_prompt = chat_prompt_clazz()  # ChatPrompt をインスタンス化する
 
                 chat_prompt.build_initial_prompt(chat_prompt)  # 初期プロンプトを生成する
 
@@ -69,21 +93,48 @@ class SimpleSessionRequestHandler(AbstractRequestHandler):
                 session["chat_prompt"] = chat_prompt
                 session_mgr.save_session()  # .save_session("chat_prompt")
 
+            elif type(session.get("chat_prompt")) is not chat_prompt_clazz:
+                # 会話の途中でプロンプトの形式が異なるモデルに切り替わった場合は、それまでの会話を移しかえる
+
+                self.logger.debug(self.eloc.to_str(
+                    {"en": f"{req_id(request)} The model '{model_name}' uses a different chat_prompt class, so the conversation is moved to it.",
+                     "ja": f"{req_id(request)} モデル '{model_name}' は異なる chat_prompt クラスを使うため、会話を移しかえます"}))
+
+                session["chat_prompt"] = self.convert_chat_prompt(session.get("chat_prompt"), chat_prompt_clazz)
+                session_mgr.save_session()
+
             chat_prompt = session.get("chat_prompt")
 
-            if request_body is not None:
-                # request_body が明示的に指定された場合
+            num_alternatives = data.get("n", 1)  # 生成する回答の数
+            if isinstance(num_alternatives, bool) or not isinstance(num_alternatives, int) \
+                    or not 1 <= num_alternatives <= self.max_num_alternatives:
+                return await self.return_bad_request_response(
+                    request, streaming_finished_callback,
+                    f"'n' must be an integer between 1 and {self.max_num_alternatives}")
+
+            if num_alternatives > 1 and not self.chat_generator.supports_n_best():
+                # モデルワーカープロセス・継続バッチングなど、 n 個の回答を1つのバッチで生成できない構成
+                return await self.return_bad_request_response(
+                    request, streaming_finished_callback,
+                    "'n' > 1 is not supported with model workers or continuous batching")
+
+            # レスポンスのストリームの形式(従来の文章全体を送る形式か、差分だけを送る Server-Sent Events か)
+            stream_format = negotiate_stream_format(request.headers.get("accept"), data)
+            if stream_format is None:
+                return await self.return_bad_request_response(request, streaming_finished_callback,
+                                                              f"'stream_format' must be one of {STREAM_FORMATS}")
+
+            selected_alternative = data.get("selected_alternative", None)  # 前回 n 個生成した回答のうち、選ばれたもの
+            if selected_alternative is not None:
+                # 選ばれた回答を会話履歴に書き戻してから、次の入力を処理する
+                if not isinstance(selected_alternative, dict) or not chat_prompt.select_responder_alternative(
+                        selected_alternative.get("message_id"), selected_alternative.get("index")):
+                    return await self.return_bad_request_response(request, streaming_finished_callback,
+                                                                  "invalid 'selected_alternative'")
 
                 self.logger.debug(self.eloc.to_str({
-                    "en": f"{req_id(request)} Since request_body is specified, the request data is retrieved from it. The request may have been intercepted by the Web API front-end.",
-                    "ja": f"{req_id(request)} request_body が指定されているため、そこからリクエストデータを取得します。リクエストが Web API のフロント処理でインターセプトされた可能性があります。"}))
-
-                # request はストリームで提供されるため、どこかで読み取ると consume されてしまう。
-                # そこで、もしどこかでインターセプトしてリクエストされたデータを使いたい場合は
-                # インターセプト元で request_body をキャッシュし、再度指定して chatstream を呼び出すことでrequest が consume されていても処理を先に進めることができる
-                data = json.loads(request_body)
-            else:
-                data = await request.json()
+                    "en": f"{req_id(request)} Wrote back the selected alternative {selected_alternative} into chat_prompt",
+                    "ja": f"{req_id(request)} 選ばれた回答 {selected_alternative} を chat_prompt に書き戻しました"}))
 
             user_input = data.get("user_input", None)  # ユーザーの入力テキスト
 
@@ -167,14 +218,28 @@ class SimpleSessionRequestHandler(AbstractRequestHandler):
 
             custom_generation_params = session.get("generation_params", None)
             message_id = str(uuid.uuid4())
-            generator = self.generate(chat_prompt, chat_generation_finished_callback, request, custom_generation_params, message_id=message_id)
-
-            streaming_response = StreamingResponse(generator, media_type="text/plain")
+            # Server-Sent Events では、文章全体ではなく新しく生成された差分を受け取る
+            output_type = "updated_text" if stream_format == STREAM_FORMAT_SSE else "response_text"
+            generator = self.generate(chat_prompt, chat_generation_finished_callback, request, custom_generation_params, message_id=message_id,
+                                      session_key=session_mgr.get_session_id(), model_name=model_name,
+                                      n=num_alternatives, output_type=output_type)
 
             # レスポンスヘッダをセットする
             # レスポンスヘッダに生成した最新メッセージ用の message_id を付与する
             headers = {"X-ChatStream-Last-Generated-Message-Id": message_id}
 
+            if stream_format == STREAM_FORMAT_SSE:
+                # 新しく生成された差分だけを Server-Sent Events で送る
+                streaming_response = StreamingResponse(stream_server_sent_events(generator, num_alternatives),
+                                                       media_type=SSE_MEDIA_TYPE)
+                headers["Cache-Control"] = "no-cache"
+                headers["X-Accel-Buffering"] = "no"  # リバースプロキシでイベントがバッファリングされないようにする
+            else:
+                streaming_response = StreamingResponse(generator, media_type="text/plain")
+            if num_alternatives > 1:
+                # レスポンスは n 個の回答をまとめた {"alternatives": [...]} の JSON のストリームとなる
+                headers["X-ChatStream-Num-Alternatives"] = str(num_alternatives)
+
             for key, value in headers.items():
                 streaming_response.headers[key] = value
 
@@ -214,6 +279,15 @@ class SimpleSessionRequestHandler(AbstractRequestHandler):
             content={"error": "internal_server_error", "detail": f"{detail}"}, status_code=500,
             media_type="application/json")
 
+    async def return_bad_request_response(self, request, callback, detail):
+        """
+        Bad Request の応答を生成する(return_internal_server_error_response と同様に、必ずコールバックを返す)
+        """
+        await callback(request, f"bad_request,{detail}")
+        return JSONResponse(
+            content={"error": "bad_request", "detail": f"{detail}"}, status_code=400,
+            media_type="application/json")
+
     def get_bool_from_dict(self, data: dict, key: str) -> bool:
         """
         辞書 dict オブジェクトから、安全に、指定したキーの bool値 を取得する
@@ -9,6 +9,7 @@ def get_resource_usage(opts={}):
 
     Parameters:
     opts (dict): オプション情報を持つ辞書。"num_gpus"と"device"をキーとして含む。
+                 "quantization" にモデルの量子化のレポート(quantize_model の戻り値)を指定すると、返り値にも含める。
 
     Returns:
     dict: CPUとGPUのメモリ使用状況を含む辞書。
@@ -64,6 +65,10 @@ def get_resource_usage(opts={}):
             used = total - unused
             ret["gpus"].append({"index": i, "total_memory": round(total, 2), "used_memory": round(used, 2)})
 
+    # モデルを量子化した場合は、量子化前後のメモリ使用量と tokens/s の差
+    quantization = opts.get("quantization")
+    if quantization is not None:
+        ret["quantization"] = quantization
 
     return ret
 
@@ -0,0 +1,214 @@
+import atexit
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+# この値より temperature が小さい場合は greedy に生成される(sampling_utils と同じ閾値)
+GREEDY_TEMPERATURE = 1e-4
+
+
+def is_deterministic(params):
+    """
+    生成パラメータで文章生成した結果が、同じプロンプトに対して常に同じになるかどうか(greedy に生成されるかどうか)
+    """
+    return float(params.get("temperature", 1.0)) < GREEDY_TEMPERATURE
+
+
+def diff_output(prev, output):
+    """
+    直前の生成済の文章 prev から output への差分 [残す文字数, 追加する文字列] をつくる
+
+    process_chat が yield する文章は、ほとんどの場合直前の文章に追加したものとなるため、差分は追加された部分のみとなる。
+    停止文字列の除去などで直前の文章の末尾が書き換わった場合は、共通の先頭部分を残して以降を置き換える。
+    output が回答のリスト(n 個の回答を生成する場合)は、回答ごとの差分のリストとする
+    """
+    if isinstance(output, list):
+        prevs = prev if prev is not None else [""] * len(output)
+        return [diff_output(prev_text, text) for prev_text, text in zip(prevs, output)]
+
+    prev = prev if prev is not None else ""
+    keep = len(prev) if output.startswith(prev) else len(os.path.commonprefix([prev, output]))
+    return [keep, output[keep:]]
+
+
+def apply_diff(prev, diff):
+    """
+    diff_output でつくった差分を prev に適用して、生成済の文章を復元する
+    """
+    if diff and isinstance(diff[0], list):
+        prevs = prev if prev is not None else [""] * len(diff)
+        return [apply_diff(prev_text, text_diff) for prev_text, text_diff in zip(prevs, diff)]
+
+    keep, append = diff
+    return (prev or "")[:keep] + append
+
+
+class ResponseRecorder:
+    """
+    逐次 yield される生成済の文章を、直前の文章からの差分の並びとして記録する
+
+    生成済の文章全体をそのまま並べて保持すると、保持する文字数が文章の長さの2乗に比例するため、差分だけを保持する
+    """
+
+    def __init__(self):
+        self.diffs = []
+        self.prev = None
+
+    def append(self, output):
+        self.diffs.append(diff_output(self.prev, output))
+        self.prev = output
+
+
+def replay_diffs(diffs):
+    """
+    ResponseRecorder で記録した差分の並びから、生成済の文章を逐次 yield しなおす
+    """
+    prev = None
+    for diff in diffs:
+        prev = apply_diff(prev, diff)
+        yield prev
+
+
+class ResponseCacheEntry:
+    """
+    1つのプロンプトに対して生成した、逐次出力の差分の並び
+    """
+
+    def __init__(self, diffs, created_at):
+        self.diffs = diffs  # ResponseRecorder で記録した、 process_chat が yield した文章の差分の並び
+        self.created_at = created_at
+
+
+class ResponseCache:
+    """
+    greedy に生成した文章を、モデル・プロンプト・生成パラメータが完全に一致するリクエストに使いまわすキャッシュ
+
+    テンプレート化された分類の質問などを temperature=0 で繰り返し送ってくるエージェントは、毎回同じ文章を生成させることになる。
+    本クラスは生成し終えた文章の逐次出力の差分の並びを、モデルID・プロンプト・実際に使う生成パラメータのハッシュをキーに保持し、
+    同じキーのリクエストでは推論を行わずに、保持している逐次出力を同じストリームとして送出しなおす。
+
+    エントリ数が max_entries を超えた場合は最も長く使われていないものから破棄し、 ttl 秒を過ぎたエントリは使わずに破棄する。
+    file_path を指定した場合は、エントリを JSON ファイルに書き出し、サーバーの再起動後も使いまわす。
+    書き出しはイベントループを止めないよう、 put から save_interval 秒後にまとめて別スレッドで行う
+    (プロセスの終了時には書き出していないエントリを flush する)
+    """
+
+    def __init__(self, max_entries=256, ttl=None, file_path=None, save_interval=1.0):
+        """
+        :param max_entries: 保持する最大エントリ数
+        :param ttl: エントリの有効期間(秒)。 None の場合は期限なし
+        :param file_path: エントリを書き出す JSON ファイルのパス。 None の場合はメモリ上にのみ保持する
+        :param save_interval: put してからファイルに書き出すまでの秒数。この間の put はまとめて1回で書き出す
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.file_path = file_path
+        self.save_interval = save_interval
+
+        self.entries = collections.OrderedDict()  # キー -> ResponseCacheEntry (最も長く使われていないものが先頭)
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # ファイルの書き出しを1つずつ行うためのロック
+        self.save_timer = None  # 書き出しを予約している threading.Timer
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evicted = 0
+
+        if file_path is not None:
+            self._load()
+            atexit.register(self.flush)
+
+    def create_key(self, model_id, prompt, params):
+        """
+        モデルID・プロンプト(組み立て済のプロンプト文字列、またはトークンIDのリスト)・生成パラメータからキーをつくる
+
+        プロンプトはトークン化しなおさずにそのままハッシュする
+        """
+        source = json.dumps({"model_id": model_id, "prompt": prompt, "params": params},
+                            sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+    def _is_expired(self, entry, now):
+        return self.ttl is not None and now - entry.created_at > self.ttl
+
+    def get(self, key):
+        """
+        キーに対応する逐次出力の差分の並び(replay_diffs で逐次出力に戻す)を返す。無い場合や期限切れの場合は None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._is_expired(entry, time.time()):
+                del self.entries[key]
+                self.num_evicted += 1
+                entry = None
+
+            if entry is None:
+                self.num_misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.num_hits += 1
+            return entry.diffs
+
+    def put(self, key, diffs):
+        """
+        最後まで生成し終えた逐次出力の差分の並び(ResponseRecorder.diffs)を保持する
+        """
+        with self.lock:
+            self.entries[key] = ResponseCacheEntry(diffs, time.time())
+            self.entries.move_to_end(key)
+            self._evict()
+            if self.file_path is not None and self.save_timer is None:
+                self.save_timer = threading.Timer(self.save_interval, self.flush)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+
+    def _evict(self):
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if self._is_expired(entry, now)]:
+            del self.entries[key]
+            self.num_evicted += 1
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.num_evicted += 1
+
+    def _load(self):
+        if not os.path.exists(self.file_path):
+            return
+        with open(self.file_path, encoding="utf-8") as f:
+            data = json.load(f)
+        for key, entry in data.items():
+            self.entries[key] = ResponseCacheEntry(entry["diffs"], entry["created_at"])
+        self._evict()
+
+    def flush(self):
+        """
+        予約している書き出しがあれば、すぐにファイルに書き出す
+        """
+        with self.save_lock:
+            with self.lock:
+                if self.save_timer is None:
+                    return
+                self.save_timer.cancel()
+                self.save_timer = None
+                # エントリは書き換えないため、ロック中は参照を集めるだけにして、 JSON の書き出しはロックの外で行う
+                data = {key: {"diffs": entry.diffs, "created_at": entry.created_at}
+                        for key, entry in self.entries.items()}
+
+            # 書き出しの途中で止まってもファイルが壊れないよう、一時ファイルに書いてから置き換える
+            tmp_path = f"{self.file_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.file_path)
+
+    def get_stats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.num_hits,
+            "misses": self.num_misses,
+            "evicted": self.num_evicted,
+        }
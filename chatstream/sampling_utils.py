@@ -1,5 +1,7 @@
 import torch
 
+from .logits_processor import build_logits_processors, sample_from_logits, TokenCounts
+
 
 def sampling(logits, k=None, p=None, temperature=1.0, past_tokens=None, penalty=None, penalty_method="multiplicative"):
     """
@@ -21,62 +23,105 @@ def sampling(logits, k=None, p=None, temperature=1.0, past_tokens=None, penalty=
     Returns:
         token_id (int): The sampled token ID.
     """
+    # Apply the penalty, temperature, top-k and top-p as one vectorized pipeline
+    # ペナルティ・temperature・top-k・top-p をベクトル化したパイプラインとして適用する
+    processors = build_logits_processors(temperature=temperature, top_k=k, top_p=p, repetition_penalty=penalty,
+                                         repetition_penalty_method=penalty_method)
 
-
-
-    # Apply a penalty to the logits of past tokens
-    # 過去のトークンのlogitsにペナルティを適用
+    token_counts = None
     if penalty is not None and past_tokens is not None:
-        # Check if logits contain any abnormal values
-        if torch.any(torch.isnan(logits)) or torch.any(torch.isinf(logits)):
-            print("Logits contain NaN or Inf values. Replacing with very large / small numbers.")
-            logits = torch.where(torch.isnan(logits), torch.full_like(logits, 0), logits)
-            logits = torch.where(torch.isinf(logits) & (logits > 0),
-                                 torch.full_like(logits, torch.finfo(logits.dtype).max),
-                                 logits)
-            logits = torch.where(torch.isinf(logits) & (logits < 0),
-                                 torch.full_like(logits, torch.finfo(logits.dtype).min),
-                                 logits)
-
-        if not isinstance(penalty, (int, float)):
-            raise ValueError(f"penalty should be a scalar value, but got {penalty}({type(penalty)})")
-        if penalty_method == "multiplicative":
-            for token in past_tokens:
-                logits[token] *= penalty
-        elif penalty_method == "subtractive":
-            for token_id in set(past_tokens):
-                logits[token_id] -= penalty
-
-    # Apply top-k sampling
-    # top-kサンプリングを適用
-    if k is not None:
-        top_k = torch.topk(logits, k)
-        top_k_indices = top_k.indices
-        top_k_values = top_k.values
-        # Adjust with Softmax with temperature
-        # very nice article below
-        # https://shivammehta25.github.io/posts/temperature-in-language-models-open-ai-whisper-probabilistic-machine-learning/
-        probabilities = torch.softmax(top_k_values / temperature, dim=-1)  # Apply temperature scaling
-        choice = torch.multinomial(probabilities, num_samples=1)
-        token_id = int(top_k_indices[choice])
-        return token_id
-
-    # Apply top-p (nucleus) sampling
-    # top-p（nucleus）サンプリングを適用
-    if p is not None:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probs = torch.cumsum(torch.softmax(sorted_logits / temperature, dim=-1),
-                                        dim=-1)  # Apply temperature scaling
-
-        sorted_indices_to_remove = cumulative_probs > p
-        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
-
-        logits[sorted_indices] = sorted_indices_to_remove.type(logits.dtype) * -1e10
+        token_counts = TokenCounts(past_tokens).get(logits.shape[-1], logits.device).unsqueeze(0)
+
+    logits = processors(logits.unsqueeze(0), token_counts)
 
     # Generate a token ID from the (possibly modified) distribution of logits
     # （可能な場合は修正された）logitsの分布からトークンIDを生成
-    probabilities = torch.softmax(logits / temperature, dim=-1)  # Apply temperature scaling
-    token_id = int(torch.multinomial(probabilities, num_samples=1))
+    return int(sample_from_logits(logits)[0])
+
+
+def batched_sampling(logits, temperature=1.0, k=None, p=None, num_candidates=256):
+    """
+    Samples one token ID per row from a batch of logits, with per-row temperature, top-k and top-p.
+
+    バッチの logits から行ごとにトークンIDを1つずつサンプリングする。temperature, top-k, top-p は行ごとに指定できる。
+
+    top-k と top-p の双方が指定された場合は、top-k で絞り込んだ候補に top-p を適用する。
+    語彙全体をソートしないよう、先に torch.topk で候補(top-k、または top-p のみの場合は num_candidates 個)を選び、
+    その中で累積確率による打ち切りを行う。top-p のみの行で、候補の累積確率が p に届かない場合だけ語彙全体をソートする。
+
+    Args:
+        logits (torch.Tensor): The logits to sample from. [batch, vocab_size]
+        temperature (float or torch.Tensor): The temperature (scalar or [batch]). Rows below 1e-4 are decoded greedily.
+        k (int or torch.Tensor, optional): top-k (scalar or [batch]). None or 0 disables it.
+        p (float or torch.Tensor, optional): top-p (scalar or [batch]). None or 1.0 disables it.
+        num_candidates (int): The number of candidates selected before the top-p cut when only top-p is given.
+
+    Returns:
+        token_ids (torch.Tensor): The sampled token IDs. [batch]
+    """
+    batch_size, vocab_size = logits.shape
+    device = logits.device
+
+    def as_row_tensor(value, default, dtype):
+        if value is None:
+            value = default
+        if isinstance(value, torch.Tensor):
+            return value.to(device=device, dtype=dtype).view(-1).expand(batch_size)
+        return torch.full((batch_size,), value, dtype=dtype, device=device)
+
+    temperature = as_row_tensor(temperature, 1.0, logits.dtype)
+    top_k = as_row_tensor(k, 0, torch.long)
+    top_p = as_row_tensor(p, 1.0, logits.dtype)
+
+    # temperature が 0 に近い行は greedy にする
+    is_greedy = temperature < 1e-4
+    greedy_token_ids = torch.argmax(logits, dim=-1)
+    if bool(is_greedy.all()):
+        return greedy_token_ids
+
+    logits = logits / torch.where(is_greedy, torch.ones_like(temperature), temperature).view(-1, 1)
+
+    has_top_k = (top_k > 0) & (top_k < vocab_size)
+    has_top_p = top_p < 1.0
+    if not bool(has_top_k.any()) and not bool(has_top_p.any()):
+        token_ids = torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1).view(-1)
+        return torch.where(is_greedy, greedy_token_ids, token_ids)
+
+    # 行ごとに残す候補の数。top-k の無い行は語彙全体
+    row_k = torch.where(has_top_k, top_k, torch.full_like(top_k, vocab_size))
+
+    if bool((has_top_p & ~has_top_k).any()):
+        # top-p のみの行は、まず num_candidates 個の候補で打ち切れるか試す
+        num_selected = min(vocab_size, max(int(row_k[has_top_k].max()) if bool(has_top_k.any()) else 0,
+                                           num_candidates))
+    else:
+        num_selected = int(row_k.max())
+
+    while True:
+        # 部分ソートで候補を選ぶ(降順)
+        values, indices = torch.topk(logits, num_selected, dim=-1)
+        positions = torch.arange(num_selected, device=device).view(1, -1)
+        values = values.masked_fill(positions >= row_k.view(-1, 1), float("-inf"))
+
+        if not bool(has_top_p.any()):
+            break
+
+        # top-k のある行は候補内で、無い行は語彙全体で確率を正規化する
+        log_normalizer = torch.where(has_top_k, torch.logsumexp(values, dim=-1), torch.logsumexp(logits, dim=-1))
+        cumulative_probs = torch.cumsum(torch.exp(values - log_normalizer.view(-1, 1)), dim=-1)
+
+        if num_selected < vocab_size and bool((has_top_p & ~has_top_k & (cumulative_probs[:, -1] < top_p)).any()):
+            # 候補の中で累積確率が p に届かなかったので、語彙全体をソートしてやり直す
+            num_selected = vocab_size
+            continue
+
+        # 累積確率が p を超えた候補の次から外す(先頭の候補は必ず残す)
+        remove = cumulative_probs > top_p.view(-1, 1)
+        remove[:, 1:] = remove[:, :-1].clone()
+        remove[:, 0] = False
+        values = values.masked_fill(remove & has_top_p.view(-1, 1), float("-inf"))
+        break
 
-    return token_id
+    choices = torch.multinomial(torch.softmax(values, dim=-1), num_samples=1)
+    token_ids = indices.gather(-1, choices).view(-1)
+    return torch.where(is_greedy, greedy_token_ids, token_ids)
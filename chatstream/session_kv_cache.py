@@ -0,0 +1,231 @@
+import collections
+import hashlib
+import os
+import threading
+
+import torch
+
+from .util_kv_cache import crop_kv, kv_nbytes
+
+TIER_DEVICE = "device"  # 推論デバイスのメモリ(hot)
+TIER_HOST = "host"  # CPU の RAM (warm)
+TIER_DISK = "disk"  # メモリマップするファイル(cold)
+
+
+def common_prefix_len(token_ids_a, token_ids_b):
+    """
+    2つのトークンID列の先頭から一致している長さを求める
+    """
+    max_len = min(len(token_ids_a), len(token_ids_b))
+    for idx in range(max_len):
+        if token_ids_a[idx] != token_ids_b[idx]:
+            return idx
+    return max_len
+
+
+class SessionKVEntry:
+    """
+    1セッションぶんのKVキャッシュと、そのKVキャッシュが表すトークンID列
+    """
+
+    def __init__(self, token_ids, past_key_values):
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values  # ((key, value), ...) ディスクに退避している間は None
+        self.nbytes = kv_nbytes(past_key_values)
+        self.device = past_key_values[0][0].device  # 復元先のデバイス
+        self.tier = TIER_DEVICE
+        self.file_path = None  # ディスクに退避している場合のファイルパス
+
+
+class SessionKVCache:
+    """
+    セッションごとに、前回のターンで生成し終えた時点のKVキャッシュを保持する
+
+    毎ターン create_prompt() で会話履歴全体のプロンプトを作り直して prefill すると、
+    前回のターンですでに計算済の会話履歴ぶんの prefill が無駄になる。
+    本クラスは前回のターンのKVキャッシュとそのトークンID列をセッションごとに保持しておき、
+    次のターンでは入力トークンID列と先頭から一致している部分のKVキャッシュを再利用する。
+    これにより、新しいユーザーメッセージとロール名のぶんだけを prefill すればよくなる。
+
+    会話履歴の編集や切り詰めでトークンID列が変わった場合は、一致している部分までしか再利用しないため、
+    古いKVキャッシュが誤って使われることはない。
+
+    【KVキャッシュの退避について】
+    ほとんどのセッションは次のメッセージまで数分間アイドル状態となるため、KVキャッシュを3段階の階層で保持する。
+    推論デバイスのメモリ(device)の使用量が max_device_bytes を超えた場合は、最も長く使われていないセッションから
+    CPU の RAM (host) に移し、 host が max_host_bytes を超えた場合は offload_dir 以下のファイルに書き出す。
+    退避したKVキャッシュは、そのセッションの次のリクエストが来たときに推論デバイスに戻す(ファイルはメモリマップして読み込む)
+    """
+
+    def __init__(self, max_sessions=64, max_device_bytes=None, max_host_bytes=None, offload_dir=None,
+                 max_disk_bytes=None):
+        """
+        :param max_sessions: KVキャッシュを保持する最大セッション数。超えた場合は最も長く使われていないものから破棄する
+        :param max_device_bytes: 推論デバイスのメモリに保持するKVキャッシュの最大バイト数。 None の場合は制限しない
+        :param max_host_bytes: CPU の RAM に退避するKVキャッシュの最大バイト数。 None の場合は制限しない
+        :param offload_dir: RAM からあふれたKVキャッシュを書き出すディレクトリ。 None の場合はファイルに書き出さずに破棄する
+        :param max_disk_bytes: ファイルに書き出すKVキャッシュの最大バイト数。 None の場合は制限しない
+        """
+        self.max_sessions = max_sessions
+        self.max_bytes = {TIER_DEVICE: max_device_bytes, TIER_HOST: max_host_bytes, TIER_DISK: max_disk_bytes}
+        self.offload_dir = offload_dir
+        if offload_dir is not None:
+            os.makedirs(offload_dir, exist_ok=True)
+
+        self.entries = collections.OrderedDict()  # セッションキー -> SessionKVEntry (最も長く使われていないものが先頭)
+        self.tier_bytes = {TIER_DEVICE: 0, TIER_HOST: 0, TIER_DISK: 0}
+        self.lock = threading.Lock()  # 推論スレッドからも操作されるため
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_reused_tokens = 0
+        self.num_offloads = 0
+        self.num_restores = 0
+
+    def take(self, session_key, input_ids):
+        """
+        セッションのKVキャッシュのうち、 input_ids と先頭から一致する部分を取り出す
+
+        取り出したKVキャッシュは生成中に拡張されるため、キャッシュからは取り除かれる。
+        次トークンの logits を得るために少なくとも1トークンは prefill する必要があるので、
+        再利用できるのは最大で len(input_ids) - 1 トークンまでとなる
+
+        :param session_key: セッションを識別するキー
+        :param input_ids: これから prefill する入力トークンID列
+        :return: (再利用できるトークン数, KVキャッシュ) 再利用できない場合は (0, None)
+        """
+        with self.lock:
+            entry = self._pop_entry(session_key)
+
+            reuse_len = 0
+            if entry is not None:
+                reuse_len = min(common_prefix_len(entry.token_ids, input_ids), len(input_ids) - 1)
+
+            if reuse_len <= 0:
+                self.num_misses += 1
+                self._discard(entry)
+                return 0, None
+
+            self.num_hits += 1
+            self.num_reused_tokens += reuse_len
+            return reuse_len, self._restore(entry, reuse_len)
+
+    def put(self, session_key, token_ids, past_key_values):
+        """
+        生成し終えた時点のKVキャッシュを保存する
+
+        :param session_key: セッションを識別するキー
+        :param token_ids: KVキャッシュに含まれているトークンID列
+        :param past_key_values: KVキャッシュ ((key, value), ...) バッチサイズは1
+        """
+        if session_key is None or past_key_values is None:
+            return
+        with self.lock:
+            self._discard(self._pop_entry(session_key))
+
+            entry = SessionKVEntry(list(token_ids), past_key_values)
+            self.entries[session_key] = entry
+            self.tier_bytes[TIER_DEVICE] += entry.nbytes
+
+            while len(self.entries) > self.max_sessions:
+                _, oldest = self.entries.popitem(last=False)
+                self.tier_bytes[oldest.tier] -= oldest.nbytes
+                self._discard(oldest)
+
+            self._offload()
+
+    def invalidate(self, session_key):
+        """
+        セッションのKVキャッシュを破棄する(コンテクストのクリア時など)
+        """
+        with self.lock:
+            self._discard(self._pop_entry(session_key))
+
+    def get_stats(self):
+        with self.lock:
+            num_sessions_per_tier = collections.Counter(entry.tier for entry in self.entries.values())
+            return {
+                "num_sessions": len(self.entries),
+                "memory_bytes": self.tier_bytes[TIER_DEVICE] + self.tier_bytes[TIER_HOST],
+                "hits": self.num_hits,
+                "misses": self.num_misses,
+                "reused_tokens": self.num_reused_tokens,
+                "offloads": self.num_offloads,
+                "restores": self.num_restores,
+                "tiers": {tier: {"num_sessions": num_sessions_per_tier[tier], "bytes": self.tier_bytes[tier]}
+                          for tier in (TIER_DEVICE, TIER_HOST, TIER_DISK)},
+            }
+
+    def _pop_entry(self, session_key):
+        entry = self.entries.pop(session_key, None)
+        if entry is not None:
+            self.tier_bytes[entry.tier] -= entry.nbytes
+        return entry
+
+    def _discard(self, entry):
+        if entry is not None:
+            self._delete_file(entry)
+
+    def _offload(self):
+        """
+        各階層の使用量が上限を超えている間、最も長く使われていないセッションのKVキャッシュを下の階層に移す
+        """
+        for tier, next_tier in ((TIER_DEVICE, TIER_HOST), (TIER_HOST, TIER_DISK), (TIER_DISK, None)):
+            max_bytes = self.max_bytes[tier]
+            if max_bytes is None:
+                continue
+            for session_key, entry in list(self.entries.items()):
+                if self.tier_bytes[tier] <= max_bytes:
+                    break
+                if entry.tier != tier:
+                    continue
+
+                self.tier_bytes[tier] -= entry.nbytes
+                if next_tier == TIER_HOST:
+                    entry.past_key_values = tuple((key.to("cpu"), value.to("cpu"))
+                                                  for key, value in entry.past_key_values)
+                elif next_tier == TIER_DISK and self.offload_dir is not None:
+                    self._write_file(session_key, entry)
+                else:
+                    # これより下の階層が無いので破棄する
+                    del self.entries[session_key]
+                    self._delete_file(entry)
+                    continue
+
+                entry.tier = next_tier
+                self.tier_bytes[next_tier] += entry.nbytes
+                self.num_offloads += 1
+
+    def _restore(self, entry, seq_len):
+        """
+        KVキャッシュの先頭から seq_len までを推論デバイスに戻す
+        """
+        if entry.tier == TIER_DEVICE:
+            return crop_kv(entry.past_key_values, seq_len)
+
+        self.num_restores += 1
+        if entry.tier == TIER_HOST:
+            return tuple((key.to(entry.device), value.to(entry.device))
+                         for key, value in crop_kv(entry.past_key_values, seq_len))
+
+        # ファイルはメモリマップして読み込み、必要な部分だけを推論デバイスにコピーする
+        tensors = torch.load(entry.file_path, mmap=True, weights_only=True)
+        past_key_values = tuple((key.to(entry.device, copy=True), value.to(entry.device, copy=True))
+                                for key, value in crop_kv(tensors, seq_len))
+        del tensors
+        self._delete_file(entry)
+        return past_key_values
+
+    def _write_file(self, session_key, entry):
+        file_name = hashlib.sha1(str(session_key).encode("utf-8")).hexdigest() + ".pt"
+        entry.file_path = os.path.join(self.offload_dir, file_name)
+        torch.save([[key.contiguous(), value.contiguous()] for key, value in entry.past_key_values], entry.file_path)
+        entry.past_key_values = None
+
+    def _delete_file(self, entry):
+        if entry.file_path is not None:
+            try:
+                os.remove(entry.file_path)
+            except OSError:
+                pass
+            entry.file_path = None
@@ -0,0 +1,345 @@
+import collections
+import math
+import threading
+
+import torch
+
+from .chat_core import sample_next_token
+from .logits_processor import build_logits_processors
+from .util_kv_cache import crop_kv, from_legacy_kv, to_legacy_kv, kv_seq_len
+
+
+class SpeculativeDecodingStats:
+    """
+    1リクエストぶんの投機的デコーディングの統計
+    """
+
+    def __init__(self):
+        self.num_proposed = 0  # ドラフトモデルが提案したトークン数
+        self.num_accepted = 0  # 提案したトークンのうち、メインモデルの検証で受理されたトークン数
+        self.num_verifications = 0  # メインモデルで検証した回数(= decode でのメインモデルの forward 回数)
+        self.num_generated = 0  # 生成したトークン数
+
+    def to_dict(self):
+        return {
+            "proposed": self.num_proposed,
+            "accepted": self.num_accepted,
+            "acceptance_rate": self.num_accepted / self.num_proposed if self.num_proposed > 0 else None,
+            "verifications": self.num_verifications,
+            "generated": self.num_generated,
+        }
+
+
+class SpeculativeDecoder:
+    """
+    小さなドラフトモデルでトークンを先読みし、メインモデルの1回の forward でまとめて検証する投機的デコーディング
+
+    CPU で 3B クラスのモデルを動かす場合、1トークンごとのメインモデルの forward がレイテンシの大半を占める。
+    本クラスは以下を繰り返すことで、メインモデルの forward 1回あたりに複数トークンを生成する。
+
+    1. ドラフトモデルで num_speculative_tokens 個のトークンを逐次サンプリングする
+    2. 直前のトークンと提案されたトークンをメインモデルに1回の forward で入力し、各位置の分布を得る
+    3. 提案されたトークンを先頭から rejection sampling で検証し、受理された連続部分と、
+       棄却された位置で修正分布 max(0, p - q) からサンプリングしたトークン(すべて受理された場合はメインモデルの次の分布から
+       サンプリングしたトークン)を採用する
+
+    検証はメインモデルの分布 p とドラフトモデルの分布 q をそれぞれ同じ生成設定(temperature, top-k, top-p, 繰り返しペナルティ)で
+    加工したうえで行うため、生成されるトークンの分布はメインモデルだけで生成した場合と変わらない。
+    temperature が 0 に近い場合(greedy)は、メインモデルの argmax と一致する提案だけを受理する。
+
+    先読みするトークン数は、受理率の移動平均から期待される受理数に合わせて、リクエスト中に増減させる
+    """
+
+    def __init__(self, draft_model, draft_tokenizer=None, tokenizer=None, num_speculative_tokens=4,
+                 min_speculative_tokens=1, max_speculative_tokens=8, num_recent_requests=16):
+        """
+        :param draft_model: ドラフトモデル(メインモデルと語彙を共有する小さなモデル)
+        :param draft_tokenizer: ドラフトモデルのトークナイザ。メインモデルのトークナイザと語彙が異なる場合はエラーとする
+        :param tokenizer: メインモデルのトークナイザ(draft_tokenizer との語彙の確認用)
+        :param num_speculative_tokens: 1回に先読みするトークン数の初期値
+        :param min_speculative_tokens: 先読みするトークン数の下限
+        :param max_speculative_tokens: 先読みするトークン数の上限
+        :param num_recent_requests: get_stats で返す直近のリクエストの統計の件数
+        """
+        if draft_tokenizer is not None and tokenizer is not None and draft_tokenizer is not tokenizer:
+            if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+                raise ValueError("draft_tokenizer must share the vocabulary of the main tokenizer")
+
+        self.draft_model = draft_model
+        self.draft_device = next(draft_model.parameters()).device if draft_model is not None else None
+        self.num_speculative_tokens = num_speculative_tokens
+        self.min_speculative_tokens = min_speculative_tokens
+        self.max_speculative_tokens = max_speculative_tokens
+
+        self.total_stats = SpeculativeDecodingStats()
+        self.recent_requests = collections.deque(maxlen=num_recent_requests)  # 直近のリクエストの統計
+        self.lock = threading.Lock()  # 推論スレッドからも操作されるため
+
+    @torch.no_grad()
+    def generate(self, model, device, config, input_ids, token_counts, output_builder):
+        """
+        投機的デコーディングで文章を生成し、1トークン生成するごとに生成済の文章を yield する同期ジェネレータ
+
+        :param model: メインモデル
+        :param device: メインモデルの実行デバイス
+        :param config: create_generation_config で作成した生成設定
+        :param input_ids: プロンプトのトークンID(コンテクストサイズで切り詰め済)
+        :param token_counts: これまでのトークンIDの出現回数(繰り返しペナルティを使わない場合は None)
+        :param output_builder: ChatOutputBuilder
+        """
+        stats = SpeculativeDecodingStats()
+        num_speculative_tokens = self.num_speculative_tokens
+        acceptance_rate = None  # 受理率の移動平均
+
+        token_ids = list(input_ids)
+
+        try:
+            # メインモデルでプロンプトを prefill する(ドラフトモデルは最初の先読みのときに prefill する)
+            out = model(input_ids=torch.as_tensor([token_ids], device=device), use_cache=True)
+            target_kv = to_legacy_kv(out.past_key_values)
+            vocab_size = out.logits.shape[-1]
+            draft_kv = None
+
+            token_id = sample_next_token(out.logits[0][-1], config, token_counts, device)
+            new_token_ids = [token_id]
+
+            while True:
+                for token_id in new_token_ids:
+                    token_ids.append(token_id)
+                    if token_counts is not None:
+                        token_counts.add(token_id)
+                    stats.num_generated += 1
+                    finished = output_builder.append(token_id)
+                    yield output_builder.text
+                    if finished:
+                        return
+
+                # 検証では提案したトークンに加えて必ず1トークン生成されるため、その1トークンぶんは先読みしない
+                num_remaining = config["max_new_tokens"] - output_builder.num_generated
+                num_proposals = max(0, min(num_speculative_tokens, num_remaining - 1))
+
+                base_counts = token_counts.get(vocab_size, device) if token_counts is not None else None
+
+                proposed_ids, draft_probs, draft_kv = self._propose(token_ids, draft_kv, num_proposals, config,
+                                                                    base_counts, vocab_size, device)
+
+                # 直前のトークンと提案されたトークンを1回の forward で検証する
+                out = model(input_ids=torch.as_tensor([token_ids[-1:] + proposed_ids], device=device),
+                            past_key_values=from_legacy_kv(target_kv), use_cache=True)
+                target_kv = to_legacy_kv(out.past_key_values)
+                target_probs = self._get_probabilities(out.logits[0], config,
+                                                       self._get_counts(base_counts, proposed_ids, vocab_size))
+
+                new_token_ids = self._verify(proposed_ids, draft_probs, target_probs)
+                num_accepted = len(new_token_ids) - 1
+
+                stats.num_verifications += 1
+                stats.num_proposed += len(proposed_ids)
+                stats.num_accepted += num_accepted
+
+                # 棄却されたトークンぶんのKVキャッシュを取り除く(最後に採用したトークンはまだどちらにも入力していない)
+                num_cached = len(token_ids) + num_accepted
+                target_kv = crop_kv(target_kv, num_cached)
+                if draft_kv is not None:
+                    draft_kv = crop_kv(draft_kv, min(num_cached, kv_seq_len(draft_kv)))
+
+                if proposed_ids:
+                    num_speculative_tokens, acceptance_rate = self._adapt(num_accepted / len(proposed_ids),
+                                                                          acceptance_rate)
+        finally:
+            self._record(stats)
+
+    def get_stats(self):
+        """
+        全リクエストの合計と、直近のリクエストごとの統計を返す
+        """
+        with self.lock:
+            return {
+                **self.total_stats.to_dict(),
+                "recent_requests": [stats.to_dict() for stats in self.recent_requests],
+            }
+
+    def _propose(self, token_ids, draft_kv, num_proposals, config, base_counts, vocab_size, device):
+        """
+        ドラフトモデルで num_proposals 個のトークンを逐次サンプリングする
+
+        :return: (提案したトークンIDのリスト, 各位置のドラフトモデルの分布のリスト, ドラフトモデルのKVキャッシュ)
+        """
+        proposed_ids = []
+        draft_probs = []
+        input_ids = token_ids[kv_seq_len(draft_kv):]  # ドラフトモデルにまだ入力していないトークン
+
+        for _ in range(num_proposals):
+            out = self.draft_model(input_ids=torch.as_tensor([input_ids], device=self.draft_device),
+                                   past_key_values=from_legacy_kv(draft_kv), use_cache=True)
+            draft_kv = to_legacy_kv(out.past_key_values)
+
+            # 検証でメインモデルの分布と比較するため、分布はメインモデルのデバイスで求める
+            logits = self._fit_vocab(out.logits[0, -1:].to(device), vocab_size)
+            probs = self._get_probabilities(logits, config, self._get_counts(base_counts, proposed_ids, vocab_size,
+                                                                             last_only=True))[0]
+            token_id = int(torch.multinomial(probs, num_samples=1))
+
+            proposed_ids.append(token_id)
+            draft_probs.append(probs)
+            input_ids = [token_id]
+
+        return proposed_ids, draft_probs, draft_kv
+
+    def _verify(self, proposed_ids, draft_probs, target_probs):
+        """
+        提案されたトークンを rejection sampling で検証する
+
+        :param proposed_ids: 提案されたトークンID
+        :param draft_probs: 各位置のドラフトモデルの分布のリスト
+        :param target_probs: 各位置のメインモデルの分布 [len(proposed_ids) + 1, vocab_size]
+        :return: 採用するトークンID(受理されたトークンと、その次にサンプリングしたトークン)
+        """
+        new_token_ids = []
+        for idx, token_id in enumerate(proposed_ids):
+            p = target_probs[idx]
+            q = draft_probs[idx]
+
+            # min(1, p / q) の確率で受理する
+            if float(torch.rand(())) * float(q[token_id]) < float(p[token_id]):
+                new_token_ids.append(token_id)
+                continue
+
+            # 棄却した位置では、修正分布 max(0, p - q) からサンプリングする
+            residual = torch.clamp(p - q, min=0)
+            if float(residual.sum()) <= 0:
+                residual = p
+            new_token_ids.append(int(torch.multinomial(residual / residual.sum(), num_samples=1)))
+            return new_token_ids
+
+        # すべて受理された場合は、メインモデルの次の位置の分布からもう1トークンサンプリングする
+        new_token_ids.append(int(torch.multinomial(target_probs[len(proposed_ids)], num_samples=1)))
+        return new_token_ids
+
+    def _adapt(self, observed_rate, acceptance_rate):
+        """
+        受理率の移動平均から、次に先読みするトークン数を決める
+
+        1トークンあたりの受理率が a のとき、連続して受理されるトークン数の期待値は a / (1 - a) となる
+        """
+        if acceptance_rate is None:
+            acceptance_rate = observed_rate
+        else:
+            acceptance_rate = 0.7 * acceptance_rate + 0.3 * observed_rate
+
+        if acceptance_rate >= 1.0:
+            expected = self.max_speculative_tokens
+        else:
+            expected = math.ceil(acceptance_rate / (1.0 - acceptance_rate))
+        num_speculative_tokens = max(self.min_speculative_tokens, min(self.max_speculative_tokens, expected))
+        return num_speculative_tokens, acceptance_rate
+
+    def _record(self, stats):
+        with self.lock:
+            self.total_stats.num_proposed += stats.num_proposed
+            self.total_stats.num_accepted += stats.num_accepted
+            self.total_stats.num_verifications += stats.num_verifications
+            self.total_stats.num_generated += stats.num_generated
+            self.recent_requests.append(stats)
+
+    @staticmethod
+    def _fit_vocab(logits, vocab_size):
+        """
+        ドラフトモデルの logits をメインモデルの語彙サイズに揃える(埋め込みのパディングで語彙サイズが異なる場合がある)
+        """
+        draft_vocab_size = logits.shape[-1]
+        if draft_vocab_size > vocab_size:
+            return logits[..., :vocab_size]
+        if draft_vocab_size < vocab_size:
+            return torch.nn.functional.pad(logits, (0, vocab_size - draft_vocab_size), value=float("-inf"))
+        return logits
+
+    @staticmethod
+    def _get_counts(base_counts, proposed_ids, vocab_size, last_only=False):
+        """
+        各位置でのトークンの出現回数(これまでのトークン + その位置までに提案されたトークン)を求める
+
+        :return: [len(proposed_ids) + 1, vocab_size] last_only=True の場合は最後の位置のみ [1, vocab_size]
+        """
+        if base_counts is None:
+            return None
+        proposed = torch.as_tensor(proposed_ids, dtype=torch.long, device=base_counts.device)
+        one_hot = torch.nn.functional.one_hot(proposed, vocab_size).to(base_counts.dtype)
+        if last_only:
+            return (base_counts + one_hot.sum(dim=0)).unsqueeze(0)
+        cumulative = torch.cat([torch.zeros_like(base_counts).unsqueeze(0), one_hot.cumsum(dim=0)])
+        return base_counts.unsqueeze(0) + cumulative
+
+    @staticmethod
+    def _get_probabilities(logits, config, token_counts):
+        """
+        logits [n, vocab_size] を生成設定で加工し、サンプリングに使う分布 [n, vocab_size] にする
+
+        greedy の場合は argmax の位置のみ 1 となる分布とする(sample_next_token と同様に繰り返しペナルティは適用しない)
+        """
+        logits = logits.float()
+        if config["temperature"] < 1e-4:
+            return torch.nn.functional.one_hot(torch.argmax(logits, dim=-1), logits.shape[-1]).float()
+
+        processors = build_logits_processors(
+            temperature=config["temperature"], top_k=config["top_k"], top_p=config["top_p"],
+            repetition_penalty=config["repetition_penalty"],
+            repetition_penalty_method=config["repetition_penalty_method"])
+        return torch.softmax(processors(logits, token_counts), dim=-1)
+
+
+class PromptLookupDecoder(SpeculativeDecoder):
+    """
+    ドラフトモデルを使わず、これまでのトークンID列から先読みするトークンを探す投機的デコーディング(prompt lookup decoding)
+
+    チャットの応答では、会話履歴に含まれるコードや名前などをそのまま書き写すことが多い。
+    本クラスは直近の n-gram と一致する箇所を、プロンプト(会話履歴)と生成済のトークンID列から探し、
+    その続きのトークンを提案として、メインモデルの1回の forward でまとめて検証する。
+
+    提案は確定的(提案したトークンの確率が 1 の分布)として SpeculativeDecoder と同じ rejection sampling で検証するため、
+    生成されるトークンの分布はメインモデルだけで生成した場合と変わらない
+    """
+
+    def __init__(self, max_ngram_size=3, min_ngram_size=1, num_speculative_tokens=10, max_speculative_tokens=10,
+                 num_recent_requests=16):
+        """
+        :param max_ngram_size: 照合する n-gram の最大長。長いものから順に探す
+        :param min_ngram_size: 照合する n-gram の最小長
+        :param num_speculative_tokens: 1回に提案するトークン数の初期値
+        :param max_speculative_tokens: 1回に提案するトークン数の上限
+        :param num_recent_requests: get_stats で返す直近のリクエストの統計の件数
+        """
+        super().__init__(None, num_speculative_tokens=num_speculative_tokens,
+                         max_speculative_tokens=max_speculative_tokens, num_recent_requests=num_recent_requests)
+        self.max_ngram_size = max_ngram_size
+        self.min_ngram_size = min_ngram_size
+
+    def _propose(self, token_ids, draft_kv, num_proposals, config, base_counts, vocab_size, device):
+        proposed_ids = find_ngram_continuation(token_ids, num_proposals, self.max_ngram_size, self.min_ngram_size)
+        draft_probs = [torch.nn.functional.one_hot(torch.as_tensor(token_id, device=device), vocab_size).float()
+                       for token_id in proposed_ids]
+        return proposed_ids, draft_probs, None
+
+
+def find_ngram_continuation(token_ids, num_tokens, max_ngram_size=3, min_ngram_size=1):
+    """
+    末尾の n-gram と一致する箇所をトークンID列の中から探し、その続きのトークンIDを返す
+
+    n-gram は長いものから順に試し、一致する箇所が複数ある場合は最も後ろ(直近)のものを使う
+
+    :param token_ids: これまでのトークンID列(プロンプトと生成済のトークン)
+    :param num_tokens: 返す続きのトークン数の上限
+    :return: 続きのトークンIDのリスト。一致する箇所が無い場合は空のリスト
+    """
+    if num_tokens <= 0:
+        return []
+
+    tokens = torch.as_tensor(token_ids, dtype=torch.long)
+    for ngram_size in range(min(max_ngram_size, len(token_ids) - 1), min_ngram_size - 1, -1):
+        # 末尾の n-gram 自身を除いた、すべての位置の n-gram [len - ngram_size, ngram_size]
+        windows = tokens[:-1].unfold(0, ngram_size, 1)
+        matches = (windows == tokens[-ngram_size:]).all(dim=1).nonzero().view(-1)
+        if len(matches) > 0:
+            start = int(matches[-1]) + ngram_size
+            return token_ids[start:start + num_tokens]
+    return []
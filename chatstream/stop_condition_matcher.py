@@ -0,0 +1,105 @@
+class StopConditionMatcher:
+    """
+    文章生成の停止条件（停止文字列・停止トークン）を逐次判定する
+
+    停止文字列は Aho-Corasick オートマトンにまとめ、新たに生成された文字列(差分)だけを入力する。
+    これにより、停止文字列の数や生成済の文章の長さによらず、1文字あたり一定のコストで判定できる。
+
+    また、停止文字列の先頭部分と一致している途中の文字列(例えば停止文字列 "\\n<" に対する "\\n")は、
+    停止文字列かどうか確定するまで出力を保留する。
+    """
+
+    def __init__(self, stop_strs=None, stop_token_ids=None):
+        """
+        :param stop_strs: 停止文字列のリスト
+        :param stop_token_ids: 停止トークンIDのリスト
+        """
+        self.stop_token_ids = set(stop_token_ids or [])
+
+        # オートマトンの状態ごとの 遷移(goto) / 失敗遷移(fail) / 深さ(=状態が表す文字列の長さ) / 一致する停止文字列の最大長
+        self.goto = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.match_len = [0]
+
+        for stop_str in stop_strs or []:
+            if stop_str:
+                self._add_pattern(stop_str)
+        self._build_fail_links()
+
+        self.state = 0
+        self.pending_text = ""  # 停止文字列の途中かもしれないため、出力を保留している文字列
+
+    def is_stop_token(self, token_id):
+        return token_id in self.stop_token_ids
+
+    def put(self, text):
+        """
+        新たに生成された文字列を入力し、出力してよい文字列と、停止文字列が見つかったかどうかを返す
+
+        停止文字列が見つかった場合、出力してよい文字列は停止文字列の直前までとなる
+
+        :param text: 新たに生成された文字列(差分)
+        :return: (出力してよい文字列, 停止文字列が見つかったかどうか)
+        """
+        pending_text = self.pending_text
+        for idx, char in enumerate(text):
+            self.state = self._next_state(self.state, char)
+            match_len = self.match_len[self.state]
+            if match_len > 0:
+                # 停止文字列の直前までを出力して停止する
+                pending_text += text[:idx + 1]
+                self.pending_text = ""
+                return pending_text[:len(pending_text) - match_len], True
+
+        pending_text += text
+
+        # 停止文字列の先頭と一致している末尾の文字列だけ保留し、それより前は出力してよい
+        num_hold = self.depth[self.state]
+        safe_len = len(pending_text) - num_hold
+        self.pending_text = pending_text[safe_len:]
+        return pending_text[:safe_len], False
+
+    def flush(self):
+        """
+        保留している文字列を返す（停止文字列が見つからないまま生成が終了したときに呼び出す）
+        """
+        pending_text = self.pending_text
+        self.pending_text = ""
+        self.state = 0
+        return pending_text
+
+    def _add_pattern(self, pattern):
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.depth.append(self.depth[state] + 1)
+                self.match_len.append(0)
+                self.goto[state][char] = next_state
+            state = next_state
+        self.match_len[state] = max(self.match_len[state], len(pattern))
+
+    def _build_fail_links(self):
+        queue = list(self.goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for char, next_state in self.goto[state].items():
+                self.fail[next_state] = self._next_state(self.fail[state], char)
+                # 失敗遷移先で一致する停止文字列も、この状態で一致したものとして扱う
+                self.match_len[next_state] = max(self.match_len[next_state], self.match_len[self.fail[next_state]])
+                queue.append(next_state)
+
+    def _next_state(self, state, char):
+        while True:
+            next_state = self.goto[state].get(char)
+            if next_state is not None:
+                return next_state
+            if state == 0:
+                return 0
+            state = self.fail[state]
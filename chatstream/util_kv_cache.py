@@ -0,0 +1,126 @@
+import torch
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # transformers < 4.36
+    DynamicCache = None
+
+
+def to_legacy_kv(past_key_values):
+    """
+    モデルが返した past_key_values を ((key, value), ...) 形式のタプルに変換する
+
+    transformers のバージョンによって past_key_values はタプルの場合と Cache オブジェクトの場合があるため、
+    ChatStream 内部ではレイヤーごとの (key, value) のタプルに揃えて扱う。
+    key, value の shape は [batch, num_heads, seq_len, head_dim]
+
+    :param past_key_values: モデルが返した past_key_values
+    :return: ((key, value), ...) のタプル
+    """
+    if past_key_values is None:
+        return None
+    if hasattr(past_key_values, "layers"):
+        # transformers >= 4.54 の Cache オブジェクト
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return tuple((layer[0], layer[1]) for layer in past_key_values)
+
+
+def from_legacy_kv(legacy_kv, like=None):
+    """
+    ((key, value), ...) 形式のタプルを、モデルに入力できる past_key_values に変換する
+
+    :param legacy_kv: ((key, value), ...) のタプル
+    :param like: モデルが以前に返した past_key_values 。タプルだった場合はタプルのまま返す
+    :return: モデルに入力できる past_key_values
+    """
+    if legacy_kv is None:
+        return None
+    if isinstance(like, tuple) or DynamicCache is None:
+        return legacy_kv
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(legacy_kv):
+        cache.update(key, value, layer_idx)
+    return cache
+
+
+def kv_seq_len(legacy_kv):
+    """
+    KVキャッシュが保持しているトークン数（パディング含む）を取得する
+    """
+    if not legacy_kv:
+        return 0
+    return legacy_kv[0][0].shape[-2]
+
+
+def kv_nbytes(legacy_kv):
+    """
+    KVキャッシュが使用しているメモリのバイト数を取得する
+    """
+    if not legacy_kv:
+        return 0
+    return sum(key.element_size() * key.nelement() + value.element_size() * value.nelement()
+               for key, value in legacy_kv)
+
+
+def left_pad_kv(legacy_kv, pad_len):
+    """
+    KVキャッシュのシーケンス方向の先頭に pad_len ぶんのゼロを詰める
+    """
+    if pad_len <= 0:
+        return legacy_kv
+    return tuple((torch.nn.functional.pad(key, (0, 0, pad_len, 0)),
+                  torch.nn.functional.pad(value, (0, 0, pad_len, 0)))
+                 for key, value in legacy_kv)
+
+
+def concat_kv(legacy_kvs):
+    """
+    シーケンス長の揃った複数のKVキャッシュをバッチ方向に連結する
+    """
+    return tuple((torch.cat([kv[layer_idx][0] for kv in legacy_kvs], dim=0),
+                  torch.cat([kv[layer_idx][1] for kv in legacy_kvs], dim=0))
+                 for layer_idx in range(len(legacy_kvs[0])))
+
+
+def select_kv(legacy_kv, indices):
+    """
+    KVキャッシュからバッチ方向に indices の行だけを取り出す
+    """
+    index = torch.as_tensor(indices, dtype=torch.long, device=legacy_kv[0][0].device)
+    return tuple((key.index_select(0, index), value.index_select(0, index)) for key, value in legacy_kv)
+
+
+def trim_kv_left(legacy_kv, trim_len):
+    """
+    KVキャッシュのシーケンス方向の先頭 trim_len ぶんを取り除く
+    """
+    if trim_len <= 0:
+        return legacy_kv
+    return tuple((key[:, :, trim_len:, :], value[:, :, trim_len:, :]) for key, value in legacy_kv)
+
+
+def crop_kv(legacy_kv, seq_len):
+    """
+    KVキャッシュのシーケンス方向を先頭から seq_len までに切り詰める
+    """
+    return tuple((key[:, :, :seq_len, :], value[:, :, :seq_len, :]) for key, value in legacy_kv)
+
+
+def slice_kv(legacy_kv, start, end):
+    """
+    KVキャッシュのシーケンス方向の [start, end) を、元のテンソルとメモリを共有しないコピーとして取り出す
+    """
+    return tuple((key[:, :, start:end, :].clone(), value[:, :, start:end, :].clone()) for key, value in legacy_kv)
+
+
+def concat_kv_seq(legacy_kvs):
+    """
+    複数のKVキャッシュをシーケンス方向に連結する
+    """
+    if len(legacy_kvs) == 1:
+        return legacy_kvs[0]
+    return tuple((torch.cat([kv[layer_idx][0] for kv in legacy_kvs], dim=-2),
+                  torch.cat([kv[layer_idx][1] for kv in legacy_kvs], dim=-2))
+                 for layer_idx in range(len(legacy_kvs[0])))
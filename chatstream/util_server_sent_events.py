@@ -0,0 +1,76 @@
+import json
+
+from chatstream.chat_process import RewrittenText
+
+SSE_MEDIA_TYPE = "text/event-stream"
+
+STREAM_FORMAT_CUMULATIVE = "cumulative"  # 生成済の文章全体 + DEFAULT_FINISH_TOKEN を毎回送る(従来の形式)
+STREAM_FORMAT_SSE = "sse"  # 新しく生成された差分だけを Server-Sent Events で送る
+
+STREAM_FORMATS = [STREAM_FORMAT_CUMULATIVE, STREAM_FORMAT_SSE]
+
+
+def negotiate_stream_format(accept_header, data):
+    """
+    レスポンスのストリームの形式を決める
+
+    リクエストの "stream_format" が指定されている場合はそれを、無い場合は Accept ヘッダに text/event-stream を含むときに "sse" とする。
+    どちらも無い場合は従来どおり "cumulative"
+
+    :param accept_header: リクエストの Accept ヘッダ
+    :param data: リクエストの JSON
+    :return: "cumulative" または "sse" 。 "stream_format" が不正な場合は None
+    """
+    stream_format = data.get("stream_format", None)
+    if stream_format is not None:
+        return stream_format if stream_format in STREAM_FORMATS else None
+
+    if accept_header is not None and SSE_MEDIA_TYPE in accept_header:
+        return STREAM_FORMAT_SSE
+    return STREAM_FORMAT_CUMULATIVE
+
+
+def format_sse_event(data, event=None):
+    """
+    Server-Sent Events の1イベントぶんの文字列をつくる(改行を含むデータは複数の data: 行に分ける)
+    """
+    lines = []
+    if event is not None:
+        lines.append(f"event: {event}")
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+async def stream_server_sent_events(async_generator, num_alternatives=1):
+    """
+    新しく生成された差分の文章を逐次 yield する非同期ジェネレータ(ChatGenerator.generate の output_type="updated_text")を、
+    Server-Sent Events のストリームに変換する
+
+    従来の形式はトークンごとに文章全体を送るため、送出するバイト数とクライアントでの処理量が文章の長さの2乗に比例する。
+    本形式は以下のイベントを送る。
+
+    - (イベント名なし) data: 新しく生成された差分の文章
+    - event: alternatives ... n 個の回答を生成する場合の、回答ごとの差分の文章の {"alternatives": [...]} の JSON
+    - event: replace ... 生成済の文章の末尾が書き換わり(RewrittenText)、差分で表せない場合の、生成済の文章全体(n 個の場合は {"alternatives": [...]} の JSON)
+    - event: end ... 文章生成が正常に終了した
+    - event: error ... 文章生成中にエラーが発生した
+
+    :param async_generator: output_type="updated_text" の文章を yield する非同期ジェネレータ
+    :param num_alternatives: 生成する回答の数(リクエストの n)
+    """
+    try:
+        async for chunk in async_generator:
+            if isinstance(chunk, RewrittenText):
+                yield format_sse_event(chunk, event="replace")
+            elif num_alternatives > 1:
+                yield format_sse_event(chunk, event="alternatives")
+            elif chunk:
+                yield format_sse_event(chunk)
+    except Exception:
+        # エラーのコールバックは呼び出し元のジェネレータで済んでいるため、クライアントにエラーを知らせて終える
+        yield format_sse_event(json.dumps({"error": "internal_server_error"}), event="error")
+        return
+    finally:
+        await async_generator.aclose()
+
+    yield format_sse_event("", event="end")
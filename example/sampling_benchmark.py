@@ -0,0 +1,63 @@
+"""
+サンプリングのマイクロベンチマーク
+
+行ごとに sampling() を呼ぶ場合と、 batched_sampling() でバッチ全体を1回でサンプリングする場合の1ステップあたりの時間を比較する
+語彙サイズは rinna (32000) と RedPajama (50432) 相当
+"""
+
+import argparse
+import time
+
+import torch
+
+from chatstream.sampling_utils import sampling, batched_sampling
+
+VOCAB_SIZES = {"rinna": 32000, "redpajama": 50432}
+
+
+def measure(fn, num_iterations):
+    fn()  # ウォームアップ
+    start = time.perf_counter()
+    for _ in range(num_iterations):
+        fn()
+    return (time.perf_counter() - start) / num_iterations * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--top_k", type=int, default=50)
+    parser.add_argument("--top_p", type=float, default=0.9)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+
+    settings = {
+        "top-k + top-p": (args.top_k, args.top_p),
+        "top-p only": (None, args.top_p),
+        "top-k only": (args.top_k, None),
+    }
+
+    print(f"{'model':<10} {'batch':>5} {'setting':<14} {'sampling() ms':>14} {'batched ms':>11} {'speedup':>8}")
+    for model_name, vocab_size in VOCAB_SIZES.items():
+        for batch_size in args.batch_sizes:
+            logits = torch.randn(batch_size, vocab_size) * 5
+
+            for setting_name, (k, p) in settings.items():
+                def run_per_row():
+                    for row in range(batch_size):
+                        sampling(logits[row], k=k, p=p, temperature=args.temperature)
+
+                def run_batched():
+                    batched_sampling(logits, temperature=args.temperature, k=k, p=p)
+
+                per_row_ms = measure(run_per_row, args.iterations)
+                batched_ms = measure(run_batched, args.iterations)
+                print(f"{model_name:<10} {batch_size:>5} {setting_name:<14} {per_row_ms:>14.3f} {batched_ms:>11.3f} "
+                      f"{per_row_ms / batched_ms:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
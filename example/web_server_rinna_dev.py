@@ -19,24 +19,33 @@ device = torch.device("cuda")
 # model_path = 'rinna/japanese-gpt-neox-3.6b-instruction-ppo'
 model_path = 'rinna/japanese-gpt-neox-3.6b-instruction-sft'
 
-# model = LoadTime(name=model_path, hf=True,
-#                  fn=lambda: AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float16))()
 
-model = LoadTime(name=model_path, hf=True,
-                 fn=lambda: AutoModelForCausalLM.from_pretrained(model_path))()  # , torch_dtype=torch.bfloat16
+def load_model():
+    """
+    モデルとトークナイザを読み込む。サーバーの起動をブロックしないよう、 ChatStream がバックグラウンドで呼び出す
+    """
+    # model = LoadTime(name=model_path, hf=True,
+    #                  fn=lambda: AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float16))()
 
-# model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float16)
+    model = LoadTime(name=model_path, hf=True,
+                     fn=lambda: AutoModelForCausalLM.from_pretrained(model_path))()  # , torch_dtype=torch.bfloat16
 
-tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
+    # model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float16)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
+
+    if device.type == 'cuda' and num_gpus == 1:
+        model.to(device)
+
+    return model, tokenizer
 
-if device.type == 'cuda' and num_gpus == 1:
-    model.to(device)
 
 chat_stream = ChatStream(
     num_of_concurrent_executions=2,
     max_queue_size=5,
-    model=model,
-    tokenizer=tokenizer,
+    model_loader=load_model,
+    load_model_in_background=True,  # Load the model after the server starts. Until ready, chat requests get 503 with Retry-After
+    warmup_prompt_lengths=[32, 256, 896],  # Warm up with representative prompt lengths before accepting requests
     num_gpus=num_gpus,
     device=device,
     chat_prompt_clazz=ChatPrompt,
@@ -0,0 +1,83 @@
+import pytest
+import torch
+from transformers import GPTNeoXConfig, GPTNeoXForCausalLM
+
+from chatstream import ChatPromptTogetherRedPajamaINCITEChat
+
+
+class CharTokenizer:
+    """
+    テスト用の文字単位トークナイザ
+    印字可能な ASCII 文字を 1 文字 1 トークンとして扱う。トークンID 0 は eos
+    """
+
+    eos_token_id = 0
+    bos_token_id = 0
+
+    def __init__(self):
+        self.vocab_size = 96
+
+    def encode(self, text, add_special_tokens=True):
+        return [ord(c) - 31 if 32 <= ord(c) <= 126 else 1 for c in text]
+
+    def __call__(self, text):
+        class _Encoded:
+            pass
+
+        encoded = _Encoded()
+        encoded.input_ids = self.encode(text)
+        return encoded
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        return "".join("" if token_id == 0 else chr(int(token_id) + 31) for token_id in token_ids)
+
+    def convert_ids_to_tokens(self, token_ids):
+        return [self.decode([token_id]) for token_id in token_ids]
+
+
+async def collect(async_generator):
+    """
+    非同期ジェネレータの出力をすべてリストにして返す
+    """
+    outputs = []
+    async for output in async_generator:
+        outputs.append(output)
+    return outputs
+
+
+async def last_output(async_generator):
+    """
+    非同期ジェネレータを最後まで回し、最後の出力を返す
+    """
+    output = None
+    async for output in async_generator:
+        pass
+    return output
+
+
+def create_chat_prompt(user_input="Who is Alan Turing"):
+    """
+    user_input を1つだけ持つ、応答待ちのチャットプロンプトを作る
+    """
+    chat_prompt = ChatPromptTogetherRedPajamaINCITEChat()
+    chat_prompt.add_requester_msg(user_input)
+    chat_prompt.add_responder_msg(None)
+    return chat_prompt
+
+
+@pytest.fixture(scope="session")
+def char_tokenizer():
+    return CharTokenizer()
+
+
+@pytest.fixture(scope="session")
+def tiny_model():
+    """
+    テスト用のランダム重みの小さな GPT-NeoX モデル
+    """
+    torch.manual_seed(0)
+    config = GPTNeoXConfig(vocab_size=96, hidden_size=32, num_hidden_layers=2, num_attention_heads=4,
+                           intermediate_size=64, max_position_embeddings=512)
+    model = GPTNeoXForCausalLM(config)
+    model.eval()
+    return model
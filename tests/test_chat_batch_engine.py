@@ -0,0 +1,94 @@
+import asyncio
+
+from chatstream.chat_batch_engine import ChatBatchEngine
+from chatstream.chat_core import process_chat
+
+from conftest import collect
+
+GREEDY_PARAMS = {"temperature": 0.0, "max_new_tokens": 12, "context_len": 256}
+
+
+def test_batched_generation_matches_process_chat(tiny_model, char_tokenizer):
+    prompts = ["Hello, how are you?", "Hi", "A much longer prompt than the others."]
+
+    async def run():
+        expected = [await collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), prompt))
+                    for prompt in prompts]
+
+        engine = ChatBatchEngine(tiny_model, char_tokenizer, "cpu", max_batch_size=3)
+        actual = await asyncio.gather(
+            *[collect(engine.generate(dict(GREEDY_PARAMS), prompt)) for prompt in prompts])
+        return expected, actual, engine
+
+    expected, actual, engine = asyncio.run(run())
+
+    assert actual == expected
+    assert engine.get_num_running() == 0
+    assert engine.past_key_values is None
+
+
+def test_sequences_join_and_leave_between_steps(tiny_model, char_tokenizer):
+    long_params = dict(GREEDY_PARAMS, max_new_tokens=20, stop_ids=[])
+    short_params = dict(GREEDY_PARAMS, max_new_tokens=3, stop_ids=[])
+
+    async def run():
+        expected_long = await collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(long_params),
+                                                   "a longer request"))
+        expected_short = await collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(short_params), "short"))
+
+        engine = ChatBatchEngine(tiny_model, char_tokenizer, "cpu", max_batch_size=2)
+        long_generator = engine.generate(dict(long_params), "a longer request")
+
+        # 長いリクエストの生成途中で短いリクエストが参加し、先に終了する
+        actual_long = [await long_generator.__anext__() for _ in range(5)]
+        rest_long, actual_short = await asyncio.gather(
+            collect(long_generator), collect(engine.generate(dict(short_params), "short")))
+        return expected_long, expected_short, actual_long + rest_long, actual_short
+
+    expected_long, expected_short, actual_long, actual_short = asyncio.run(run())
+    assert actual_long == expected_long
+    assert actual_short == expected_short
+
+
+def test_cancelled_sequence_is_removed(tiny_model, char_tokenizer):
+    async def run():
+        engine = ChatBatchEngine(tiny_model, char_tokenizer, "cpu", max_batch_size=2)
+        generator = engine.generate(dict(GREEDY_PARAMS, max_new_tokens=50, stop_ids=[]), "cancel me")
+        await generator.__anext__()
+        await generator.aclose()
+        other = await collect(engine.generate(dict(GREEDY_PARAMS), "other"))
+        return engine, other
+
+    engine, other = asyncio.run(run())
+    assert len(other) > 0
+    assert engine.get_num_running() == 0
+
+
+def test_chunked_prefill_interleaves_with_decode(tiny_model, char_tokenizer):
+    long_prompt = "A very long message from a user with a long history. " * 4
+    params = dict(GREEDY_PARAMS, max_new_tokens=20, stop_ids=[])
+
+    async def run():
+        expected_short = await collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(params), "short"))
+        expected_long = await collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(params), long_prompt))
+
+        engine = ChatBatchEngine(tiny_model, char_tokenizer, "cpu", max_batch_size=2, prefill_chunk_size=16,
+                                 max_tokens_per_step=17)
+        short_generator = engine.generate(dict(params), "short")
+        actual_short = [await short_generator.__anext__()]
+
+        # 長いプロンプトの prefill 中も、短いリクエストはステップごとに1トークンずつ生成される
+        long_task = asyncio.ensure_future(collect(engine.generate(dict(params), long_prompt)))
+        num_prefill_steps = 0
+        while len(actual_short) < len(expected_short):
+            actual_short.append(await short_generator.__anext__())
+            if engine.prefilling_sequences:
+                num_prefill_steps += 1
+        actual_long = await long_task
+        return expected_short, expected_long, actual_short, actual_long, num_prefill_steps, engine
+
+    expected_short, expected_long, actual_short, actual_long, num_prefill_steps, engine = asyncio.run(run())
+    assert actual_short == expected_short
+    assert actual_long == expected_long
+    assert num_prefill_steps >= len(long_prompt) // 16 - 1
+    assert engine.get_num_running() == 0
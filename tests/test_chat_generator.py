@@ -0,0 +1,39 @@
+import asyncio
+
+from chatstream.chat_core import process_chat
+from chatstream.chat_process import ChatGenerator
+from chatstream.default_finish_token import DEFAULT_FINISH_TOKEN
+
+from conftest import collect, create_chat_prompt
+
+GREEDY_PARAMS = {"temperature": 0.0, "max_new_tokens": 10, "context_len": 256}
+
+
+def test_response_text_is_generated_text_only(tiny_model, char_tokenizer):
+    chat_prompt = create_chat_prompt()
+    generator = ChatGenerator(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS))
+
+    async def run():
+        generated = await collect(process_chat(tiny_model, char_tokenizer, "cpu",
+                                               dict(GREEDY_PARAMS, stop_strs=chat_prompt.get_stop_strs()),
+                                               chat_prompt.create_prompt()))
+        outputs = await collect(generator.generate(chat_prompt, {"output_type": "response_text"}))
+        return generated, outputs
+
+    generated, outputs = asyncio.run(run())
+
+    expected_response = generated[-1].strip()
+    assert outputs[-2] == expected_response + DEFAULT_FINISH_TOKEN
+    assert chat_prompt.get_responder_last_msg() == expected_response
+    assert chat_prompt.create_prompt().startswith("<human>: Who is Alan Turing\n<bot>:")
+
+
+def test_prompt_built_from_token_ids(tiny_model, char_tokenizer):
+    async def run(build_prompt_from_token_ids):
+        chat_prompt = create_chat_prompt()
+        generator = ChatGenerator(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS),
+                                  build_prompt_from_token_ids=build_prompt_from_token_ids)
+        return await collect(generator.generate(chat_prompt, {"output_type": "response_text"}))
+
+    # CharTokenizer ではメッセージごとにトークン化しても結果が変わらない
+    assert asyncio.run(run(True)) == asyncio.run(run(False))
@@ -97,3 +97,122 @@ def test_last_responder_message(chat_prompt):
     In this test case, we expect it to be 'He is a nice guy'.
     """
     assert chat_prompt.get_responder_last_msg() == "He is a nice guy"
+
+
+def test_create_prompt_drops_oldest_whole_turns(char_tokenizer):
+    """
+    When max_tokens is given, the oldest whole turns are dropped while the system prompt is kept
+    """
+    chat_prompt = ChatPrompt()
+    chat_prompt.set_system("System.\n")
+    chat_prompt.add_requester_msg("first question")
+    chat_prompt.add_responder_msg("first answer")
+    chat_prompt.add_requester_msg("second question")
+    chat_prompt.add_responder_msg("second answer")
+    chat_prompt.add_requester_msg("third")
+    chat_prompt.add_responder_msg(None)
+
+    latest = "<human>: third\n<bot>:"
+    second_turn = "<human>: second question\n<bot>: second answer\n"
+    budget = len("System.\n") + len(second_turn) + len(latest)
+
+    # CharTokenizer は1文字1トークン
+    prompt = chat_prompt.create_prompt({"tokenizer": char_tokenizer, "max_tokens": budget})
+    assert prompt == "System.\n" + second_turn + latest
+
+    prompt = chat_prompt.create_prompt({"tokenizer": char_tokenizer, "max_tokens": budget - 1})
+    assert prompt == "System.\n" + latest
+
+    # 最新のターンは収まらなくても残す
+    prompt = chat_prompt.create_prompt({"tokenizer": char_tokenizer, "max_tokens": 1})
+    assert prompt == "System.\n" + latest
+
+
+def test_token_counts_are_cached_per_message(char_tokenizer):
+    """
+    Token counts are reused for unchanged messages and recounted after an edit
+    """
+
+    class CountingTokenizer:
+        def __init__(self):
+            self.encoded = []
+
+        def encode(self, text, add_special_tokens=True):
+            self.encoded.append(text)
+            return char_tokenizer.encode(text, add_special_tokens)
+
+    tokenizer = CountingTokenizer()
+    chat_prompt = ChatPrompt()
+    chat_prompt.add_requester_msg("Who is Alan Turing")
+    chat_prompt.add_responder_msg("He is a nice guy")
+
+    chat_prompt.create_prompt({"tokenizer": tokenizer, "max_tokens": 1000})
+    assert len(tokenizer.encoded) == 2
+    chat_prompt.create_prompt({"tokenizer": tokenizer, "max_tokens": 1000})
+    assert len(tokenizer.encoded) == 2
+
+    chat_prompt.set_responder_last_msg("He was a mathematician")
+    chat_prompt.create_prompt({"tokenizer": tokenizer, "max_tokens": 1000})
+    assert tokenizer.encoded[-1] == "<bot>: He was a mathematician\n"
+
+
+def test_create_prompt_input_ids_reuses_cached_token_ids(char_tokenizer):
+    """
+    The prompt is assembled from token ids cached per message, and edited messages are re-encoded
+    """
+
+    class CountingTokenizer:
+        def __init__(self):
+            self.encoded = []
+
+        def encode(self, text, add_special_tokens=True):
+            self.encoded.append(text)
+            return char_tokenizer.encode(text, add_special_tokens)
+
+    tokenizer = CountingTokenizer()
+    chat_prompt = ChatPrompt()
+    chat_prompt.set_system("System.\n")
+    chat_prompt.add_requester_msg("Who is Alan Turing")
+    chat_prompt.add_responder_msg("He is a nice guy")
+    chat_prompt.add_requester_msg("More")
+    chat_prompt.add_responder_msg(None)
+
+    input_ids = chat_prompt.create_prompt_input_ids(tokenizer)
+    assert input_ids == char_tokenizer.encode(chat_prompt.create_prompt())
+    assert len(tokenizer.encoded) == 5
+
+    # 次のターンでは、新しいメッセージと更新されたメッセージだけをトークン化する
+    chat_prompt.set_responder_last_msg("OK")
+    chat_prompt.add_requester_msg("Thanks")
+    chat_prompt.add_responder_msg(None)
+    input_ids = chat_prompt.create_prompt_input_ids(tokenizer)
+    assert input_ids == char_tokenizer.encode(chat_prompt.create_prompt())
+    assert tokenizer.encoded[5:] == ["<bot>: OK\n", "<human>: Thanks\n", "<bot>:"]
+
+
+def test_create_prompt_input_ids_not_in_chat_mode(char_tokenizer):
+    chat_prompt = ChatPrompt()
+    chat_prompt.set_chat_mode_enabled(False)
+    chat_prompt.add_requester_msg("Who is Alan Turing")
+    assert chat_prompt.create_prompt_input_ids(char_tokenizer) is None
+
+
+def test_cached_token_ids_are_not_reused_with_another_tokenizer(char_tokenizer):
+    """
+    A conversation moved to a model with another tokenizer is re-encoded with that tokenizer
+    """
+
+    class ShiftedTokenizer:
+        def encode(self, text, add_special_tokens=True):
+            return [token_id + 1 for token_id in char_tokenizer.encode(text, add_special_tokens)]
+
+    chat_prompt = ChatPrompt()
+    chat_prompt.set_system("System.\n")
+    chat_prompt.add_requester_msg("Who is Alan Turing")
+    chat_prompt.add_responder_msg(None)
+
+    assert chat_prompt.create_prompt_input_ids(char_tokenizer) == char_tokenizer.encode(chat_prompt.create_prompt())
+
+    shifted_tokenizer = ShiftedTokenizer()
+    assert chat_prompt.create_prompt_input_ids(shifted_tokenizer) == shifted_tokenizer.encode(
+        chat_prompt.create_prompt())
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from chatstream.chat_batch_engine import ChatBatchEngine
+from chatstream.chat_core import process_chat
+from chatstream.compiled_decode import CompiledDecoder
+
+from conftest import collect
+
+# テストでは Python のコード生成を行わない eager backend でコンパイルする
+GREEDY_PARAMS = {"temperature": 0.0, "max_new_tokens": 12, "context_len": 128, "stop_ids": []}
+
+
+def test_compiled_decode_matches_process_chat(tiny_model, char_tokenizer):
+    prompt = "User: hello\nBot:"
+    decoder = CompiledDecoder(tiny_model, max_cache_len=128, backend="eager")
+
+    async def run():
+        expected = await collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), prompt))
+        actual = await collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), prompt,
+                                            compiled_decoder=decoder))
+        # 使い終わった StaticCache は次のリクエストで再利用する
+        again = await collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), prompt,
+                                           compiled_decoder=decoder))
+        return expected, actual, again
+
+    expected, actual, again = asyncio.run(run())
+    assert actual == expected
+    assert again == expected
+    assert decoder.get_stats()["compiled_steps"] == 2 * (GREEDY_PARAMS["max_new_tokens"] - 1)
+    assert len(decoder.free_caches[1]) == 1
+
+
+def test_batched_compiled_decode_with_join_and_leave(tiny_model, char_tokenizer):
+    long_params = dict(GREEDY_PARAMS, max_new_tokens=20)
+    short_params = dict(GREEDY_PARAMS, max_new_tokens=3)
+    decoder = CompiledDecoder(tiny_model, max_cache_len=128, batch_size_buckets=(1, 2, 4), backend="eager")
+
+    async def run():
+        expected_long = await collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(long_params),
+                                                   "a longer request"))
+        expected_short = await collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(short_params), "short"))
+
+        engine = ChatBatchEngine(tiny_model, char_tokenizer, "cpu", max_batch_size=3, compiled_decoder=decoder)
+        long_generator = engine.generate(dict(long_params), "a longer request")
+
+        # バッチへの参加・離脱のたびに、バケットの StaticCache へ書き込み直す
+        actual_long = [await long_generator.__anext__() for _ in range(5)]
+        rest_long, actual_short, actual_third = await asyncio.gather(
+            collect(long_generator), collect(engine.generate(dict(short_params), "short")),
+            collect(engine.generate(dict(short_params), "short")))
+        return expected_long, expected_short, actual_long + rest_long, actual_short, actual_third
+
+    expected_long, expected_short, actual_long, actual_short, actual_third = asyncio.run(run())
+    assert actual_long == expected_long
+    assert actual_short == expected_short
+    assert actual_third == expected_short
+    assert decoder.get_stats()["compiled_steps"] > 0
+
+
+def test_warmup_measures_each_bucket(tiny_model):
+    decoder = CompiledDecoder(tiny_model, max_cache_len=64, batch_size_buckets=(1, 2), backend="eager")
+    benchmark = decoder.warmup(num_steps=4)
+
+    assert sorted(benchmark) == [1, 2]
+    assert all(result["eager_tokens_per_sec"] > 0 and result["compiled_tokens_per_sec"] > 0
+               for result in benchmark.values())
+    assert sorted(decoder.get_stats()["benchmark"]) == ["1", "2"]
+    assert decoder.get_bucket(3) is None
+
+
+def test_old_static_cache_api_is_rejected(tiny_model, monkeypatch):
+    class OldStaticCache:
+        # early_initialization やレイヤーごとのKVキャッシュが無い、古い transformers の StaticCache
+        def __init__(self, config, max_batch_size=1, max_cache_len=None, **kwargs):
+            pass
+
+    monkeypatch.setattr("chatstream.compiled_decode.StaticCache", OldStaticCache)
+
+    with pytest.raises(ValueError, match="early_initialization"):
+        CompiledDecoder(tiny_model, max_cache_len=64)
@@ -0,0 +1,129 @@
+import asyncio
+from types import SimpleNamespace
+
+from chatstream import ChatStream
+from chatstream.chat_process import ChatGenerator
+from chatstream.disconnect_watcher import DisconnectWatcher, is_client_disconnected
+
+from conftest import collect, create_chat_prompt
+
+GREEDY_PARAMS = {"temperature": 0.0, "max_new_tokens": 16, "context_len": 256}
+
+
+class FakeRequest:
+    """
+    クライアントの切断を任意のタイミングで起こせるリクエスト
+    """
+
+    def __init__(self):
+        self.state = SimpleNamespace()
+        self.messages = asyncio.Queue()
+        self.num_receiving = 0  # 同時に receive() を待っている数
+
+    async def body(self):
+        return b'{"user_input": "hello"}'
+
+    async def receive(self):
+        self.num_receiving += 1
+        try:
+            return await self.messages.get()
+        finally:
+            self.num_receiving -= 1
+
+    def disconnect(self):
+        self.messages.put_nowait({"type": "http.disconnect"})
+
+
+def test_watcher_marks_disconnected_requests():
+    watcher = DisconnectWatcher()
+    notified = []
+
+    async def run():
+        connected, disconnected, unwatched = FakeRequest(), FakeRequest(), FakeRequest()
+        for request in [connected, disconnected, unwatched]:
+            watcher.watch(request, notified.append)
+        await asyncio.sleep(0)
+
+        # 1つのリクエストの receive() を待つのは1か所だけ
+        assert [request.num_receiving for request in [connected, disconnected, unwatched]] == [1, 1, 1]
+
+        # 監視を終えたリクエストの receive() は取り消され、メッセージは StreamingResponse が読む
+        watcher.unwatch(unwatched)
+        await asyncio.sleep(0)
+        assert unwatched.num_receiving == 0
+        unwatched.disconnect()
+
+        disconnected.disconnect()
+        await asyncio.sleep(0.01)
+        return connected, disconnected, unwatched
+
+    connected, disconnected, unwatched = asyncio.run(run())
+
+    assert notified == [disconnected]
+    assert is_client_disconnected(disconnected)
+    assert not is_client_disconnected(connected)
+    assert not is_client_disconnected(unwatched)
+    assert watcher.get_stats() == {"watching": 1, "disconnected": 1, "removed_from_queue": 0}
+
+
+def test_cancelled_stream_stops_generation(tiny_model, char_tokenizer):
+    generator = ChatGenerator(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS))
+    num_forwards = []
+    handle = tiny_model.register_forward_hook(lambda module, args, output: num_forwards.append(1))
+
+    async def run():
+        await collect(generator.generate(create_chat_prompt(), {"output_type": "response_text"}))
+        num_forwards_without_cancel = len(num_forwards)
+        num_forwards.clear()
+
+        # StreamingResponse がクライアントの切断を検出すると、ストリームを送出しているタスクを取り消す
+        outputs = []
+
+        async def stream():
+            async for output in generator.generate(create_chat_prompt(), {"output_type": "response_text"}):
+                outputs.append(output)
+                if len(outputs) == 2:
+                    asyncio.current_task().cancel()
+
+        task = asyncio.create_task(stream())
+        await asyncio.gather(task, return_exceptions=True)
+        return num_forwards_without_cancel, outputs
+
+    try:
+        num_forwards_without_cancel, outputs = asyncio.run(run())
+    finally:
+        handle.remove()
+
+    assert len(outputs) == 2
+    assert len(num_forwards) < num_forwards_without_cancel
+
+
+def test_disconnected_request_is_skipped_in_request_queue(monkeypatch):
+    chat_stream = ChatStream(use_mock_response=True, watch_client_disconnect=True)
+    chat_stream.verify_role_for_api = lambda request, api_name: None
+    messages = []
+
+    async def run():
+        # キューワーカーを起動しないので、リクエストはリクエストキューで待ち続ける
+        request = FakeRequest()
+        task = asyncio.create_task(chat_stream.handle_chat_stream_request(
+            request, callback=lambda req, message: messages.append(message)))
+        await asyncio.sleep(0.01)
+        assert chat_stream.request_queue.qsize() == 1
+
+        # 切断したリクエストはすぐに応答し、キューには残して取り出したときに読み飛ばす
+        request.disconnect()
+        response = await asyncio.wait_for(task, timeout=1)
+        assert chat_stream.request_queue.qsize() == 1
+
+        # 読み飛ばさずに処理しようとすると失敗する
+        monkeypatch.setattr(chat_stream.request_handler, "process_request", None)
+        worker = asyncio.create_task(chat_stream.queue_worker())
+        await asyncio.sleep(0.01)
+        worker.cancel()
+        return response
+
+    assert asyncio.run(run()) is None
+    assert chat_stream.request_queue.qsize() == 0
+    assert messages == ["client_disconnected_before_streaming"]
+    assert chat_stream.disconnect_watcher.get_stats()["removed_from_queue"] == 1
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+
+import torch
+
+from chatstream import ChatStream
+from chatstream.chat_core import process_chat
+from chatstream.execution_slots import ExecutionSlotPool, partition_cpus
+
+from conftest import collect
+
+GREEDY_PARAMS = {"temperature": 0.0, "max_new_tokens": 8, "context_len": 256}
+
+
+def test_partition_cpus():
+    assert partition_cpus([0, 1, 2, 3, 4, 5, 6, 7], 2, 4) == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    assert partition_cpus([0, 1, 2, 3, 4, 5], 2, 2) == [[0, 1], [2, 3]]
+
+    # コアが足りない場合はピン留めしない
+    assert partition_cpus([0, 1], 2, 2) is None
+
+
+def test_concurrent_generations_run_on_separate_slots(tiny_model, char_tokenizer):
+    pool = ExecutionSlotPool(2, threads_per_slot=1)
+    thread_names = []
+    handle = tiny_model.register_forward_hook(lambda module, args, output: thread_names.append(
+        threading.current_thread().name))
+
+    async def run():
+        expected = await collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), "Hello"))
+        thread_names.clear()
+        actual = await asyncio.gather(*[
+            collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), "Hello", executor=pool))
+            for _ in range(2)])
+        num_threads = await pool.run(torch.get_num_threads)
+        return expected, actual, num_threads
+
+    try:
+        expected, actual, num_threads = asyncio.run(run())
+    finally:
+        handle.remove()
+        pool.shutdown()
+
+    assert actual == [expected, expected]
+    assert num_threads == 1
+
+    # 2つの文章生成はそれぞれ別のスロットのスレッドで最後まで実行される
+    assert {name.rsplit("_", 1)[0] for name in thread_names} == {"chatstream-slot-0", "chatstream-slot-1"}
+    assert [slot["generations"] for slot in pool.get_stats()["slots"]] == [1, 1]
+    assert not any(slot["busy"] for slot in pool.get_stats()["slots"])
+
+
+def test_benchmark_compares_with_shared_thread_pool(tiny_model):
+    pool = ExecutionSlotPool(2, threads_per_slot=1)
+    try:
+        result = pool.benchmark(tiny_model, prompt_len=4, max_new_tokens=4)
+    finally:
+        pool.shutdown()
+
+    assert result["shared_pool_tokens_per_sec"] > 0
+    assert result["slots_tokens_per_sec"] > 0
+    assert pool.get_stats()["benchmark"] == result
+
+
+def test_shared_pool_baseline_uses_original_thread_count(tiny_model):
+    num_threads_before = torch.get_num_threads()
+    torch.set_num_threads(3)
+    pool = ExecutionSlotPool(2, threads_per_slot=1)
+    baseline_num_threads = []
+    handle = tiny_model.register_forward_hook(lambda module, args, output: baseline_num_threads.append(
+        torch.get_num_threads()) if not threading.current_thread().name.startswith("chatstream-slot") else None)
+
+    try:
+        pool.benchmark(tiny_model, prompt_len=4, max_new_tokens=2)
+        assert set(baseline_num_threads) == {3}
+        assert asyncio.run(pool.run(torch.get_num_threads)) == 1
+    finally:
+        handle.remove()
+        pool.shutdown()
+        num_threads_after_shutdown = torch.get_num_threads()
+        torch.set_num_threads(num_threads_before)
+
+    # スロットが変更したプロセス全体の intra-op スレッド数は shutdown で元に戻る
+    assert num_threads_after_shutdown == 3
+
+
+def test_queue_worker_teardown_shuts_down_execution_slots(tiny_model, char_tokenizer):
+    num_threads_before = torch.get_num_threads()
+    torch.set_num_threads(3)
+    chat_stream = ChatStream(model=tiny_model, tokenizer=char_tokenizer, device="cpu", num_of_concurrent_executions=2,
+                             use_execution_slots=True, threads_per_execution_slot=1)
+    pool = chat_stream.execution_slot_pool
+
+    async def run():
+        queue_worker_task = asyncio.create_task(chat_stream.queue_worker())
+        assert await pool.run(torch.get_num_threads) == 1
+        queue_worker_task.cancel()
+        await queue_worker_task
+
+    try:
+        asyncio.run(run())
+        num_threads_after_teardown = torch.get_num_threads()
+    finally:
+        torch.set_num_threads(num_threads_before)
+
+    # キューワーカーの終了時にスロットのスレッドを止め、 intra-op スレッド数を元に戻す
+    assert num_threads_after_teardown == 3
+    assert chat_stream.execution_slot_pool is None
+    assert all(slot.executor._shutdown for slot in pool.slots)
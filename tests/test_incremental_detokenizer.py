@@ -0,0 +1,88 @@
+from chatstream.incremental_detokenizer import IncrementalDetokenizer
+
+
+class ByteFallbackTokenizer:
+    """
+    1バイト1トークンのトークナイザ。マルチバイト文字は複数トークンに分割される
+    """
+    eos_token_id = 256
+
+    def encode(self, text):
+        return list(text.encode("utf-8"))
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        return bytes(token_id for token_id in token_ids if token_id != self.eos_token_id).decode(
+            "utf-8", errors="replace")
+
+
+class SentencePieceLikeTokenizer:
+    """
+    "▁" を空白として扱い、デコード結果の先頭の空白を落とす SentencePiece 風のトークナイザ
+    """
+    eos_token_id = 0
+
+    def __init__(self):
+        self.pieces = ["</s>", "▁Hello", "▁world", "▁foo", "bar", "▁baz", "<NL>"]
+
+    def encode(self, pieces):
+        return [self.pieces.index(piece) for piece in pieces]
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        pieces = [self.pieces[token_id] for token_id in token_ids
+                  if not (skip_special_tokens and token_id == self.eos_token_id)]
+        text = "".join(pieces).replace("▁", " ")
+        return text[1:] if text.startswith(" ") else text
+
+
+def test_multibyte_characters_are_held_until_complete():
+    tokenizer = ByteFallbackTokenizer()
+    prompt_ids = tokenizer.encode("ユーザー: 挨拶して<NL>システム: ")
+    detokenizer = IncrementalDetokenizer(tokenizer, prompt_ids)
+
+    deltas = [detokenizer.put(token_id) for token_id in tokenizer.encode("こんにちは、世界")]
+
+    assert all("�" not in delta for delta in deltas)
+    assert [delta for delta in deltas if delta] == list("こんにちは、世界")
+    assert detokenizer.text == "こんにちは、世界"
+
+
+def test_leading_space_of_first_generated_piece_is_kept():
+    tokenizer = SentencePieceLikeTokenizer()
+    prompt_ids = tokenizer.encode(["▁Hello", "▁world"])
+    generated_ids = tokenizer.encode(["▁foo", "bar", "▁baz"])
+    detokenizer = IncrementalDetokenizer(tokenizer, prompt_ids)
+
+    deltas = [detokenizer.put(token_id) for token_id in generated_ids]
+
+    full_text = tokenizer.decode(prompt_ids + generated_ids)
+    assert "".join(deltas) == full_text[len(tokenizer.decode(prompt_ids)):]
+    assert deltas == [" foo", "bar", " baz"]
+
+
+def test_special_tokens_are_skipped():
+    tokenizer = SentencePieceLikeTokenizer()
+    detokenizer = IncrementalDetokenizer(tokenizer, tokenizer.encode(["▁Hello"]))
+
+    assert detokenizer.put(tokenizer.encode(["▁foo"])[0]) == " foo"
+    assert detokenizer.put(tokenizer.eos_token_id) == ""
+    assert detokenizer.flush() == ""
+    assert detokenizer.text == " foo"
+
+
+def test_flush_returns_incomplete_character():
+    tokenizer = ByteFallbackTokenizer()
+    detokenizer = IncrementalDetokenizer(tokenizer)
+
+    assert detokenizer.put("あ".encode("utf-8")[0]) == ""
+    assert detokenizer.flush() == "�"
+
+
+def test_decode_window_does_not_grow_with_output_length():
+    tokenizer = ByteFallbackTokenizer()
+    detokenizer = IncrementalDetokenizer(tokenizer, tokenizer.encode("prompt " * 100))
+
+    for token_id in tokenizer.encode("long answer " * 100):
+        detokenizer.put(token_id)
+
+    assert detokenizer.text == "long answer " * 100
+    assert len(detokenizer.token_ids) <= 2
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+
+from chatstream.chat_batch_engine import ChatBatchEngine
+from chatstream.chat_core import process_chat
+from chatstream.inference_executor import InferenceExecutor
+
+from conftest import collect
+
+GREEDY_PARAMS = {"temperature": 0.0, "max_new_tokens": 8, "context_len": 256}
+
+
+def record_forward_threads(model):
+    thread_names = []
+    handle = model.register_forward_hook(lambda module, args, output: thread_names.append(
+        threading.current_thread().name))
+    return thread_names, handle
+
+
+def test_process_chat_runs_forward_on_inference_thread(tiny_model, char_tokenizer):
+    executor = InferenceExecutor()
+    thread_names, handle = record_forward_threads(tiny_model)
+    try:
+        expected = asyncio.run(collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), "Hello")))
+        thread_names.clear()
+        actual = asyncio.run(collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), "Hello",
+                                                  executor=executor)))
+    finally:
+        handle.remove()
+        executor.shutdown()
+
+    assert actual == expected
+    assert thread_names and all(name.startswith("chatstream-inference") for name in thread_names)
+
+
+def test_batch_engine_runs_steps_on_inference_thread(tiny_model, char_tokenizer):
+    executor = InferenceExecutor()
+    thread_names, handle = record_forward_threads(tiny_model)
+
+    async def run():
+        expected = await collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), "Hi there"))
+        thread_names.clear()
+        engine = ChatBatchEngine(tiny_model, char_tokenizer, "cpu", max_batch_size=2, executor=executor)
+        actual = await collect(engine.generate(dict(GREEDY_PARAMS), "Hi there"))
+        return expected, actual
+
+    try:
+        expected, actual = asyncio.run(run())
+    finally:
+        handle.remove()
+        executor.shutdown()
+
+    assert actual == expected
+    assert thread_names and all(name.startswith("chatstream-inference") for name in thread_names)
+
+
+def test_event_loop_is_not_blocked_during_forward():
+    executor = InferenceExecutor()
+    release_forward = threading.Event()
+
+    def slow_forward():
+        # イベントループ側の処理が進むまで forward が終わらない
+        return release_forward.wait(timeout=5)
+
+    async def run():
+        forward = asyncio.ensure_future(executor.run(slow_forward))
+        await asyncio.sleep(0.01)
+        release_forward.set()  # イベントループが動いているのでここに到達できる
+        return await forward
+
+    try:
+        assert asyncio.run(run()) is True
+    finally:
+        executor.shutdown()
@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+import torch
+
+from chatstream.chat_batch_engine import ChatBatchEngine
+from chatstream.chat_core import process_chat
+from chatstream.kv_block_manager import KVBlockManager, KVBlockTable, KVCacheOutOfBlocksError
+
+from conftest import last_output
+
+GREEDY_PARAMS = {"temperature": 0.0, "max_new_tokens": 10, "context_len": 256, "stop_ids": []}
+
+
+def make_kv(values):
+    # 各位置の値を values にした ((key, value), ...) 2レイヤー [1, 2, len, 3]
+    tensor = torch.as_tensor(values, dtype=torch.float32).view(1, 1, -1, 1).expand(1, 2, -1, 3).clone()
+    return tuple((tensor.clone(), -tensor.clone()) for _ in range(2))
+
+
+def kv_values(legacy_kv, row=0):
+    return [int(value) for value in legacy_kv[0][0][row, 0, :, 0]]
+
+
+def make_manager(num_blocks=4, block_size=2):
+    return KVBlockManager(num_layers=2, num_kv_heads=2, head_dim=3, num_blocks=num_blocks, block_size=block_size)
+
+
+def test_write_and_gather_with_left_padding():
+    manager = make_manager()
+    table_a = KVBlockTable()
+    table_b = KVBlockTable()
+    manager.write(table_a, make_kv([1, 2, 3]))
+    manager.write(table_b, make_kv([7]))
+    manager.write(table_b, make_kv([7, 8]), start=1)
+
+    past_key_values, attention_mask = manager.gather([table_a, table_b])
+    assert kv_values(past_key_values, 0) == [1, 2, 3]
+    assert kv_values(past_key_values, 1) == [0, 7, 8]
+    assert attention_mask.tolist() == [[1, 1, 1], [0, 1, 1]]
+    assert past_key_values[1][1][0, 1, 2, 2] == -3
+    assert manager.get_num_free_blocks() == 1
+
+
+def test_fork_copies_shared_block_on_write():
+    manager = make_manager()
+    table = KVBlockTable()
+    manager.write(table, make_kv([1, 2, 3]))
+
+    forked = manager.fork(table)
+    assert manager.get_num_free_blocks() == 2
+
+    # 共有中の途中まで埋まったブロックに書き込むときだけコピーされる
+    manager.write(forked, make_kv([9]))
+    manager.write(table, make_kv([4]))
+    assert manager.get_num_free_blocks() == 1
+    assert kv_values(manager.gather([table])[0]) == [1, 2, 3, 4]
+    assert kv_values(manager.gather([forked])[0]) == [1, 2, 3, 9]
+
+    manager.free(table)
+    manager.free(forked)
+    assert manager.get_num_free_blocks() == 4
+
+
+def test_out_of_blocks():
+    manager = make_manager(num_blocks=2)
+    table = KVBlockTable()
+    with pytest.raises(KVCacheOutOfBlocksError):
+        manager.write(table, make_kv([1, 2, 3, 4, 5]))
+    assert table.num_tokens == 0
+    assert manager.get_num_free_blocks() == 2
+
+
+def test_from_model_sizes_pool_by_bytes(tiny_model):
+    # tiny_model は 2レイヤー、4ヘッド x 8次元、float32 なので 1トークンあたり 2 * 2 * 4 * 8 * 4 = 512 バイト
+    manager = KVBlockManager.from_model(tiny_model, 512 * 16 * 10, block_size=16)
+    assert manager.num_blocks == 10
+    assert manager.get_stats()["max_tokens"] == 160
+
+
+def test_process_chat_with_paged_kv_cache(tiny_model, char_tokenizer):
+    manager = KVBlockManager.from_model(tiny_model, 512 * 4 * 64, block_size=4)
+    prompt = "User: hello\nBot:"
+
+    async def run(kv_block_manager):
+        return await last_output(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), prompt,
+                                              kv_block_manager=kv_block_manager))
+
+    assert asyncio.run(run(manager)) == asyncio.run(run(None))
+    assert manager.get_num_free_blocks() == manager.num_blocks
+
+
+def test_batch_engine_with_paged_kv_cache(tiny_model, char_tokenizer):
+    prompts = ["Hello, how are you?", "Hi", "A much longer prompt than the others."]
+
+    async def run(kv_block_manager):
+        engine = ChatBatchEngine(tiny_model, char_tokenizer, "cpu", max_batch_size=3,
+                                 kv_block_manager=kv_block_manager)
+        return await asyncio.gather(*[last_output(engine.generate(dict(GREEDY_PARAMS), prompt))
+                                      for prompt in prompts])
+
+    expected = asyncio.run(run(None))
+
+    manager = KVBlockManager.from_model(tiny_model, 512 * 4 * 64, block_size=4)
+    assert asyncio.run(run(manager)) == expected
+    assert manager.get_num_free_blocks() == manager.num_blocks
+
+    # 2シーケンスぶんしか保持できない場合は、ブロックが空くまで3つ目の参加を待たせる
+    manager = KVBlockManager.from_model(tiny_model, 512 * 4 * 20, block_size=4)
+    assert asyncio.run(run(manager)) == expected
+    assert manager.get_num_free_blocks() == manager.num_blocks
+
+
+def test_from_model_reserves_the_forward_working_set(tiny_model):
+    # 16トークンのコンテクスト1個は 512 * 16 バイト。プール1個ぶんと作業領域2個ぶんで3個ぶんが必要
+    context_bytes = 512 * 16
+    manager = KVBlockManager.from_model(tiny_model, context_bytes * 10, block_size=4, context_len=16)
+
+    assert manager.num_blocks == 3 * 4
+    stats = manager.get_stats()
+    assert stats["working_set_bytes"] == 2 * 3 * context_bytes
+    assert manager.num_blocks * 4 * 512 + stats["working_set_bytes"] <= context_bytes * 10
+
+    assert KVBlockManager.from_model(tiny_model, context_bytes * 2, block_size=4, context_len=16).num_blocks == 0
@@ -0,0 +1,129 @@
+import math
+
+import pytest
+import torch
+
+from chatstream.logits_processor import LogitsProcessor, TokenCounts, RepetitionPenaltyProcessor, TopKProcessor, TopPProcessor, \
+    build_logits_processors, sample_from_logits
+from chatstream.chat_core import create_generation_config, sample_next_tokens
+from chatstream.sampling_utils import sampling, batched_sampling
+
+
+def test_token_counts_incremental():
+    token_counts = TokenCounts([1, 2, 2])
+    token_counts.add(3)
+    assert token_counts.get(5, "cpu").tolist() == [0, 1, 2, 1, 0]
+
+    token_counts.add(2)
+    assert token_counts.get(5, "cpu").tolist() == [0, 1, 3, 1, 0]
+
+
+def test_multiplicative_penalty_matches_loop():
+    logits = torch.tensor([1.0, -2.0, 3.0, 0.5])
+    past_tokens = [0, 2, 2]
+
+    expected = logits.clone()
+    for token in past_tokens:
+        expected[token] *= 1.5
+
+    counts = TokenCounts(past_tokens).get(4, "cpu").unsqueeze(0)
+    actual = RepetitionPenaltyProcessor(1.5, "multiplicative")(logits.unsqueeze(0), counts)
+    assert torch.allclose(actual[0], expected)
+
+
+def test_subtractive_penalty_once_per_token_and_nan():
+    logits = torch.tensor([[1.0, float("nan"), 3.0, float("inf")]])
+    counts = torch.tensor([[2, 0, 1, 0]])
+
+    actual = RepetitionPenaltyProcessor(0.5, "subtractive")(logits, counts)
+    assert actual[0, :3].tolist() == [0.5, 0.0, 2.5]
+    assert actual[0, 3] == torch.finfo(torch.float32).max
+
+
+def test_penalty_per_sequence_in_batch():
+    logits = torch.ones(2, 3)
+    counts = torch.tensor([[1, 0, 0], [0, 2, 0]])
+
+    actual = RepetitionPenaltyProcessor(torch.tensor([2.0, 3.0]))(logits, counts)
+    assert actual.tolist() == [[2.0, 1.0, 1.0], [1.0, 9.0, 1.0]]
+
+
+def test_top_k_per_sequence():
+    logits = torch.tensor([[4.0, 3.0, 2.0, 1.0], [1.0, 2.0, 3.0, 4.0]])
+
+    actual = TopKProcessor(torch.tensor([1, 3]))(logits, None)
+    assert torch.isinf(actual).tolist() == [[False, True, True, True], [True, False, False, False]]
+
+
+def test_top_p_keeps_nucleus():
+    probabilities = torch.tensor([[0.5, 0.3, 0.15, 0.05]])
+
+    actual = TopPProcessor(0.7)(probabilities.log(), None)
+    assert torch.isinf(actual).tolist() == [[False, False, True, True]]
+
+
+def test_pipeline_samples_within_top_k():
+    torch.manual_seed(0)
+    processors = build_logits_processors(temperature=0.7, top_k=2, top_p=0.9, repetition_penalty=1.2)
+    logits = torch.tensor([[5.0, 4.0, 3.0, 2.0]]).repeat(64, 1)
+
+    token_ids = sample_from_logits(processors(logits, torch.zeros(64, 4, dtype=torch.long)))
+    assert set(token_ids.tolist()) <= {0, 1}
+
+
+def test_sampling_with_penalty():
+    torch.manual_seed(0)
+    logits = torch.tensor([math.log(0.9), math.log(0.1), -1e9])
+
+    # 出現済のトークン0に強いペナルティをかけるとトークン1が選ばれる
+    token_id = sampling(logits, k=None, p=None, past_tokens=[0], penalty=1e9, penalty_method="subtractive")
+    assert token_id == 1
+
+
+def test_batched_sampling_per_row_settings():
+    torch.manual_seed(0)
+    logits = torch.tensor([[5.0, 4.0, 3.0, 2.0, 1.0]]).repeat(3, 1)
+
+    # 行0: greedy, 行1: top-k=2, 行2: top-k=3 と top-p=0.5 の組み合わせ
+    token_ids = torch.stack([
+        batched_sampling(logits, temperature=torch.tensor([0.0, 1.0, 1.0]), k=torch.tensor([0, 2, 3]),
+                         p=torch.tensor([1.0, 1.0, 0.5]))
+        for _ in range(64)])
+    assert set(token_ids[:, 0].tolist()) == {0}
+    assert set(token_ids[:, 1].tolist()) == {0, 1}
+    assert set(token_ids[:, 2].tolist()) == {0}
+
+
+def test_batched_sampling_top_p_falls_back_to_full_sort():
+    torch.manual_seed(0)
+    # 分布が平らなので、候補 2 個では累積確率が p に届かず語彙全体をソートする
+    logits = torch.zeros(1, 8)
+    logits[0, 7] = 0.1
+
+    token_ids = {int(batched_sampling(logits, k=None, p=0.8, num_candidates=2)[0]) for _ in range(200)}
+    assert len(token_ids) > 2
+    assert len(token_ids) <= 7
+
+
+def test_sample_next_tokens_matches_single_row_penalty(char_tokenizer):
+    torch.manual_seed(0)
+    greedy_config = create_generation_config({"temperature": 0.0, "use_repetition_penalty": True,
+                                              "repetition_penalty": 1e9}, char_tokenizer)
+    penalty_config = create_generation_config(
+        {"temperature": 1.0, "top_k_value": 2, "use_repetition_penalty": True, "repetition_penalty": 1e9,
+         "repetition_penalty_method": "subtractive"},
+        char_tokenizer)
+    logits = torch.tensor([[5.0, 4.0, 3.0, -1e9], [5.0, 4.0, 3.0, -1e9]])
+
+    # greedy の行にはペナルティをかけず、もう一方の行は出現済のトークン0を避ける
+    token_ids = sample_next_tokens(logits, [greedy_config, penalty_config], [None, TokenCounts([0])], "cpu")
+    assert token_ids[0] == 0
+    assert token_ids[1] in (1, 2)
+
+
+def test_logits_processor_requires_call():
+    class IncompleteProcessor(LogitsProcessor):
+        pass
+
+    with pytest.raises(TypeError):
+        IncompleteProcessor()
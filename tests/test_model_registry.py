@@ -0,0 +1,131 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import torch
+from transformers import GPTNeoXConfig, GPTNeoXForCausalLM
+
+from chatstream import ChatStream, ChatPromptTogetherRedPajamaINCITEChat, ChatPromptRinnaJapaneseGPTNeoxInst
+from chatstream.model_registry import ModelRegistry
+from chatstream.request_handler.simple_session_request_handler import SimpleSessionRequestHandler
+from chatstream.quantization import get_model_bytes
+
+from conftest import collect, create_chat_prompt
+
+GREEDY_PARAMS = {"temperature": 0.0, "max_new_tokens": 6, "context_len": 128}
+
+
+def make_loader(char_tokenizer, seed):
+    def load():
+        torch.manual_seed(seed)
+        config = GPTNeoXConfig(vocab_size=96, hidden_size=32, num_hidden_layers=2, num_attention_heads=4,
+                               intermediate_size=64, max_position_embeddings=512)
+        model = GPTNeoXForCausalLM(config)
+        model.eval()
+        return model, char_tokenizer
+
+    return load
+
+
+def test_models_are_loaded_lazily_and_evicted_lru(char_tokenizer):
+    model_bytes = get_model_bytes(make_loader(char_tokenizer, 0)()[0])
+
+    # 1モデルぶんのメモリしかないので、別のモデルを使うと前のモデルが取り除かれる
+    registry = ModelRegistry(device="cpu", max_memory_bytes=model_bytes)
+    registry.params = dict(GREEDY_PARAMS)
+    registry.register("a", make_loader(char_tokenizer, 0), ChatPromptTogetherRedPajamaINCITEChat)
+    registry.register("b", make_loader(char_tokenizer, 1), ChatPromptTogetherRedPajamaINCITEChat,
+                      params={"max_new_tokens": 3})
+
+    assert not any(model["loaded"] for model in registry.get_loads()["models"])
+
+    async def run():
+        await collect(registry.generate(create_chat_prompt("hello"), {"output_type": "response_text"}))
+        assert registry.get_entry("a").is_loaded()
+
+        await collect(registry.generate(create_chat_prompt("hello"), {"output_type": "response_text", "model_name": "b"}))
+        assert registry.get_entry("b").is_loaded()
+        assert not registry.get_entry("a").is_loaded()
+
+    asyncio.run(run())
+
+    loads = {model["name"]: model for model in registry.get_loads()["models"]}
+    assert loads["a"]["unloads"] == 1
+    assert loads["b"]["loads"] == 1
+    assert registry.get_loaded_memory_bytes() == model_bytes
+    assert registry.get_entry("b").chat_generator.params["max_new_tokens"] == 3
+
+
+def test_model_in_use_is_not_evicted(char_tokenizer):
+    registry = ModelRegistry(device="cpu", max_loaded_models=1)
+    registry.params = dict(GREEDY_PARAMS, max_new_tokens=20, stop_ids=[])
+    registry.register("a", make_loader(char_tokenizer, 0), ChatPromptTogetherRedPajamaINCITEChat)
+    registry.register("b", make_loader(char_tokenizer, 1), ChatPromptTogetherRedPajamaINCITEChat)
+
+    async def run():
+        generator_a = registry.generate(create_chat_prompt("hello"), {"output_type": "response_text"})
+        await generator_a.__anext__()
+
+        # a の生成中は a を取り除けないので、 b は a の生成が終わってから読み込まれる
+        task_b = asyncio.create_task(collect(registry.generate(create_chat_prompt("hello"), {"model_name": "b"})))
+        await asyncio.sleep(0.05)
+        assert registry.get_entry("a").is_loaded()
+        assert not registry.get_entry("b").is_loaded()
+
+        await collect(generator_a)
+        await task_b
+        assert registry.get_entry("b").is_loaded()
+        assert not registry.get_entry("a").is_loaded()
+
+    asyncio.run(run())
+
+
+def test_conversation_moves_to_other_prompt_class():
+    chat_prompt = ChatPromptTogetherRedPajamaINCITEChat()
+    chat_prompt.add_requester_msg("hello")
+    chat_prompt.add_responder_msg("hi")
+    chat_prompt.set_responder_last_msg_id("message-1")
+
+    converted = SimpleSessionRequestHandler().convert_chat_prompt(chat_prompt, ChatPromptRinnaJapaneseGPTNeoxInst)
+
+    assert isinstance(converted, ChatPromptRinnaJapaneseGPTNeoxInst)
+    assert converted.get_requester_last_msg() == "hello"
+    assert converted.get_responder_last_msg() == "hi"
+    assert converted.find_chat_content_by_message_id("message-1").get_message() == "hi"
+
+
+class FakeRequest:
+    def __init__(self, model_name):
+        self.state = SimpleNamespace()
+        self.model_name = model_name
+
+    async def body(self):
+        return json.dumps({"user_input": "hello", "model": self.model_name}).encode()
+
+
+def test_requests_for_busy_model_do_not_block_other_models(char_tokenizer):
+    registry = ModelRegistry(device="cpu")
+    registry.register("a", make_loader(char_tokenizer, 0), ChatPromptTogetherRedPajamaINCITEChat)
+    registry.register("b", make_loader(char_tokenizer, 1), ChatPromptTogetherRedPajamaINCITEChat,
+                      num_of_concurrent_executions=2)
+    chat_stream = ChatStream(model_registry=registry, num_of_concurrent_executions=1)
+    chat_stream.verify_role_for_api = lambda request, api_name: None
+
+    # 全体の同時処理数はモデルのスロット数の合計
+    assert chat_stream.num_of_concurrent_executions == 3
+
+    async def run():
+        # キューワーカーを起動しないので、キューに入ったリクエストはそこで待ち続ける
+        tasks = [asyncio.create_task(chat_stream.handle_chat_stream_request(FakeRequest(name)))
+                 for name in ["a", "a", "b"]]
+        await asyncio.sleep(0.05)
+
+        # 2つめの a はモデルのスロットを待ち、リクエストキューにも全体の同時処理数にも入らない
+        assert registry.get_entry("a").num_waiting == 1
+        assert chat_stream.request_queue.qsize() == 2
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(run())
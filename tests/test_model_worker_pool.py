@@ -0,0 +1,51 @@
+import asyncio
+
+import torch
+from transformers import GPTNeoXConfig, GPTNeoXForCausalLM
+
+from chatstream.chat_core import process_chat
+from chatstream.model_worker_pool import ModelWorkerPool
+from conftest import CharTokenizer
+
+from conftest import collect
+
+GREEDY_PARAMS = {"temperature": 0.0, "max_new_tokens": 8, "context_len": 256}
+
+
+def load_tiny_model():
+    # ワーカープロセス側で呼び出されるため、テストプロセスと同じ重みになるよう seed を固定して生成する
+    torch.manual_seed(0)
+    config = GPTNeoXConfig(vocab_size=96, hidden_size=32, num_hidden_layers=2, num_attention_heads=4,
+                           intermediate_size=64, max_position_embeddings=512)
+    model = GPTNeoXForCausalLM(config)
+    model.eval()
+    return model, CharTokenizer()
+
+
+def test_requests_are_dispatched_to_least_loaded_workers():
+    model, tokenizer = load_tiny_model()
+    prompts = ["Hello", "How are you?", "Good morning"]
+
+    pool = ModelWorkerPool(load_tiny_model, device="cpu", num_workers=2, threads_per_worker=1)
+
+    async def run():
+        expected = [await collect(process_chat(model, tokenizer, "cpu", dict(GREEDY_PARAMS), prompt))
+                    for prompt in prompts]
+
+        generators = [pool.generate(dict(GREEDY_PARAMS), prompt) for prompt in prompts]
+        # 最初の出力を受け取った時点では、3件のリクエストが2つのワーカーに振り分けられている
+        first_outputs = [await generator.__anext__() for generator in generators]
+        loads = pool.get_worker_loads()
+        rest_outputs = await asyncio.gather(*[collect(generator) for generator in generators])
+        actual = [[first] + rest for first, rest in zip(first_outputs, rest_outputs)]
+        return expected, actual, loads
+
+    try:
+        expected, actual, loads = asyncio.run(run())
+    finally:
+        pool.shutdown()
+
+    assert actual == expected
+    assert sorted(load["processing"] for load in loads) == [1, 2]
+    assert all(load["num_threads"] == 1 for load in loads)
+    assert all(load["processing"] == 0 for load in pool.get_worker_loads())
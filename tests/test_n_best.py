@@ -0,0 +1,169 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from chatstream import ChatStream, ChatPromptTogetherRedPajamaINCITEChat as ChatPrompt
+from chatstream.chat_core import process_chat, process_chat_n_best
+from chatstream.chat_process import ChatGenerator
+from chatstream.default_finish_token import DEFAULT_FINISH_TOKEN
+from chatstream.kv_block_manager import KVBlockManager
+from chatstream.request_handler.simple_session_request_handler import SimpleSessionRequestHandler
+from chatstream.session_kv_cache import SessionKVCache
+
+from conftest import collect, create_chat_prompt
+
+GREEDY_PARAMS = {"temperature": 0.0, "max_new_tokens": 8, "context_len": 256}
+SAMPLING_PARAMS = {"temperature": 1.0, "top_k": 0, "top_p": 1.0, "max_new_tokens": 8, "context_len": 256}
+
+
+def parse_alternatives(text):
+    if text.endswith(DEFAULT_FINISH_TOKEN):
+        text = text[:-len(DEFAULT_FINISH_TOKEN)]
+    return json.loads(text)["alternatives"]
+
+
+def test_greedy_alternatives_match_single_generation(tiny_model, char_tokenizer):
+    async def run():
+        expected = await collect(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), "Hello"))
+        actual = await collect(process_chat_n_best(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), "Hello", 3))
+        return expected, actual
+
+    expected, actual = asyncio.run(run())
+
+    assert actual[-1] == [expected[-1]] * 3
+
+
+def test_prompt_is_prefilled_once(tiny_model, char_tokenizer):
+    input_shapes = []
+    handle = tiny_model.register_forward_hook(
+        lambda module, args, kwargs, output: input_shapes.append(tuple(kwargs["input_ids"].shape)), with_kwargs=True)
+
+    try:
+        outputs = asyncio.run(collect(process_chat_n_best(tiny_model, char_tokenizer, "cpu", dict(SAMPLING_PARAMS),
+                                                          "Hello", 4)))
+    finally:
+        handle.remove()
+
+    # prefill はプロンプト全体を1回だけ、 decode は n 本をまとめて1トークンずつ
+    assert input_shapes[0] == (1, len("Hello"))
+    assert all(shape[0] <= 4 and shape[1] == 1 for shape in input_shapes[1:])
+    assert len(outputs[-1]) == 4
+
+
+def test_alternatives_are_stored_and_selectable(tiny_model, char_tokenizer):
+    generator = ChatGenerator(tiny_model, char_tokenizer, "cpu", dict(SAMPLING_PARAMS))
+    chat_prompt = create_chat_prompt()
+
+    outputs = asyncio.run(collect(generator.generate(chat_prompt, {"output_type": "response_text", "n": 3,
+                                                                   "message_id": "m1"})))
+
+    assert outputs[-1].endswith(DEFAULT_FINISH_TOKEN)
+    alternatives = json.loads(outputs[-1][:-len(DEFAULT_FINISH_TOKEN)])["alternatives"]
+    assert len(alternatives) == 3
+
+    # 会話履歴には最初の回答が入り、選んだ回答を書き戻せる
+    assert chat_prompt.get_responder_last_msg() == alternatives[0]
+    assert chat_prompt.select_responder_alternative("m1", 2)
+    assert chat_prompt.get_responder_last_msg() == alternatives[2]
+
+    assert not chat_prompt.select_responder_alternative("m1", 3)
+    assert not chat_prompt.select_responder_alternative("unknown", 0)
+
+
+def test_output_types_match_single_answer_path(tiny_model, char_tokenizer):
+    generator = ChatGenerator(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS))
+
+    async def run():
+        tuples = await collect(generator.generate(create_chat_prompt(), {"n": 2}))
+        updated = await collect(generator.generate(create_chat_prompt(), {"output_type": "updated_text", "n": 2}))
+        return tuples, updated
+
+    tuples, updated = asyncio.run(run())
+
+    # output_type が無指定の場合は n=1 と同じく (response_text, updated_text, pos) のタプル
+    assert all(isinstance(output, tuple) and len(output) == 3 for output in tuples)
+    assert [output[2] for output in tuples][0] == "begin" and tuples[-1][2] == "end"
+
+    # updated_text は回答ごとの差分で、つなげると生成済の文章全体になる
+    deltas = [parse_alternatives(output) for output in updated]
+    assert ["".join(texts) for texts in zip(*deltas)] == parse_alternatives(tuples[-1][0])
+
+
+def test_session_kv_cache_is_reused(tiny_model, char_tokenizer):
+    session_kv_cache = SessionKVCache()
+    input_shapes = []
+    handle = tiny_model.register_forward_hook(
+        lambda module, args, kwargs, output: input_shapes.append(tuple(kwargs["input_ids"].shape)), with_kwargs=True)
+
+    async def run(prompt):
+        return await collect(process_chat_n_best(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), prompt, 2,
+                                                 session_kv_cache=session_kv_cache, session_key="s1"))
+
+    try:
+        asyncio.run(run("Hello"))
+        input_shapes.clear()
+        asyncio.run(run("Hello there"))
+    finally:
+        handle.remove()
+
+    # 2回目はプロンプトのうち前回 prefill していない部分だけを prefill する
+    assert input_shapes[0] == (1, len(" there"))
+
+
+class FakeSessionManager:
+    def __init__(self):
+        self.session = {}
+
+    def get_session(self):
+        return self.session
+
+    def save_session(self):
+        pass
+
+    def get_session_id(self):
+        return "s1"
+
+
+class FakeRequest:
+    def __init__(self, data):
+        self.state = SimpleNamespace(session=FakeSessionManager())
+        self.headers = {}
+        self.data = data
+
+    async def json(self):
+        return self.data
+
+
+def test_unsupported_configuration_is_rejected():
+    chat_stream = ChatStream(use_mock_response=True, chat_prompt_clazz=ChatPrompt,
+                             request_handler=SimpleSessionRequestHandler())
+    messages = []
+
+    async def callback(request, message):
+        messages.append(message)
+
+    response = asyncio.run(chat_stream.request_handler.process_request(
+        FakeRequest({"user_input": "hello", "n": 2}), None, callback))
+
+    # n 個の回答を生成できない構成では、黙って1個にせず 400 を返す
+    assert response.status_code == 400
+    assert messages[0].startswith("bad_request")
+
+
+def test_prompt_blocks_are_forked_with_paged_kv_cache(tiny_model, char_tokenizer):
+    manager = KVBlockManager.from_model(tiny_model, 512 * 4 * 64, block_size=4)
+    num_forks = []
+    fork = manager.fork
+    manager.fork = lambda table: num_forks.append(1) or fork(table)
+
+    async def run(kv_block_manager):
+        return await collect(process_chat_n_best(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), "Hello", 3,
+                                                 kv_block_manager=kv_block_manager))
+
+    expected = asyncio.run(run(None))
+    actual = asyncio.run(run(manager))
+
+    # プロンプトのブロックテーブルを n 本に fork し、生成し終えたらすべてのブロックを解放する
+    assert actual == expected
+    assert len(num_forks) == 3
+    assert manager.get_num_free_blocks() == manager.num_blocks
@@ -0,0 +1,118 @@
+import asyncio
+
+import torch
+
+from chatstream.chat_batch_engine import ChatBatchEngine
+from chatstream.chat_core import process_chat
+from chatstream.prefix_kv_cache import PrefixKVCache
+
+from conftest import last_output
+
+GREEDY_PARAMS = {"temperature": 0.0, "max_new_tokens": 8, "context_len": 256, "stop_ids": []}
+
+SYSTEM_PROMPT = "System: You are a helpful assistant.\n"
+
+
+def make_kv(token_ids):
+    # 各位置の値をトークンIDにしておき、取り出したKVキャッシュがどのトークンのものか確かめられるようにする
+    values = torch.as_tensor(token_ids, dtype=torch.float32).view(1, 1, -1, 1).expand(1, 2, -1, 4)
+    return tuple((values.clone(), values.clone()) for _ in range(2))
+
+
+def kv_token_ids(legacy_kv):
+    return [int(value) for value in legacy_kv[0][0][0, 0, :, 0]]
+
+
+def test_match_longest_prefix_and_split():
+    cache = PrefixKVCache()
+    cache.insert([1, 2, 3, 4], make_kv([1, 2, 3, 4]))
+    cache.insert([1, 2, 5, 6], make_kv([1, 2, 5, 6]))
+
+    # [1, 2] のノードが分割されて共有される
+    assert cache.get_stats()["num_nodes"] == 3
+
+    reuse_len, kv, node = cache.match([1, 2, 5, 6, 7])
+    assert reuse_len == 4
+    assert kv_token_ids(kv) == [1, 2, 5, 6]
+    cache.release(node)
+
+    # エッジの途中まで一致する場合
+    reuse_len, kv, node = cache.match([1, 2, 3, 9])
+    assert reuse_len == 3
+    assert kv_token_ids(kv) == [1, 2, 3]
+    cache.release(node)
+
+    assert cache.match([9, 1]) == (0, None, None)
+
+    stats = cache.get_stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+    assert stats["saved_prefill_tokens"] == 7
+
+
+def test_match_leaves_at_least_one_token_to_prefill():
+    cache = PrefixKVCache()
+    cache.insert([1, 2, 3], make_kv([1, 2, 3]))
+
+    reuse_len, kv, node = cache.match([1, 2, 3])
+    assert reuse_len == 2
+    cache.release(node)
+
+
+def test_lru_eviction_skips_referenced_nodes():
+    node_bytes = 2 * 2 * (2 * 2 * 4 * 4)  # 2トークンぶんのノード(2レイヤー x key,value x [1, 2, 2, 4] の float32)
+    cache = PrefixKVCache(max_memory_bytes=node_bytes * 2)
+    cache.insert([1, 2], make_kv([1, 2]))
+    cache.insert([3, 4], make_kv([3, 4]))
+
+    # [1, 2] は参照中なので、容量を超えても [3, 4] が先に破棄される
+    _, _, node = cache.match([1, 2, 9])
+    cache.insert([5, 6], make_kv([5, 6]))
+    assert cache.match([3, 4, 9])[0] == 0
+    assert cache.get_stats()["memory_bytes"] <= node_bytes * 2
+
+    cache.release(node)
+    cache.insert([7, 8], make_kv([7, 8]))
+    assert cache.get_stats()["num_nodes"] == 2
+
+
+def test_process_chat_with_prefix_cache(tiny_model, char_tokenizer):
+    prompts = [SYSTEM_PROMPT + "User: hello\nBot:", SYSTEM_PROMPT + "User: good morning\nBot:"]
+
+    async def run(prefix_kv_cache):
+        return [await last_output(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), prompt,
+                                               prefix_kv_cache=prefix_kv_cache))
+                for prompt in prompts]
+
+    expected = asyncio.run(run(None))
+
+    prefix_kv_cache = PrefixKVCache()
+    actual = asyncio.run(run(prefix_kv_cache))
+
+    assert actual == expected
+    stats = prefix_kv_cache.get_stats()
+    assert stats["hits"] == 1
+    assert stats["saved_prefill_tokens"] == len(SYSTEM_PROMPT + "User: ")
+    assert all(node.ref_count == 0 for node in prefix_kv_cache._iter_nodes())
+
+
+def test_batch_engine_with_prefix_cache(tiny_model, char_tokenizer):
+    prompts = [SYSTEM_PROMPT + "User: hi\nBot:", SYSTEM_PROMPT + "User: how are you?\nBot:",
+               SYSTEM_PROMPT + "User: bye\nBot:"]
+
+    async def run(prefix_kv_cache):
+        engine = ChatBatchEngine(tiny_model, char_tokenizer, "cpu", max_batch_size=2,
+                                 prefix_kv_cache=prefix_kv_cache)
+        first = await last_output(engine.generate(dict(GREEDY_PARAMS), prompts[0]))
+        rest = await asyncio.gather(*[last_output(engine.generate(dict(GREEDY_PARAMS), prompt))
+                                      for prompt in prompts[1:]])
+        return [first] + rest
+
+    expected = asyncio.run(run(None))
+
+    prefix_kv_cache = PrefixKVCache()
+    actual = asyncio.run(run(prefix_kv_cache))
+
+    assert actual == expected
+    assert prefix_kv_cache.get_stats()["hits"] == 2
+    assert all(node.ref_count == 0 for node in prefix_kv_cache._iter_nodes())
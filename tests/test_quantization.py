@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+import torch
+from transformers import GPTNeoXConfig, GPTNeoXForCausalLM
+
+from chatstream.chat_core import process_chat
+from chatstream.quantization import quantize_model, get_model_bytes
+from chatstream.resource_usage import get_resource_usage
+
+from conftest import last_output
+
+CHECK_PROMPTS = ["User: hello\nBot:", "User: how are you?\nBot:"]
+
+
+def make_model():
+    # tiny_model は他のテストと共有しているため、 in-place で量子化しても良いモデルを別に作る
+    torch.manual_seed(0)
+    config = GPTNeoXConfig(vocab_size=96, hidden_size=32, num_hidden_layers=2, num_attention_heads=4,
+                           intermediate_size=64, max_position_embeddings=512)
+    model = GPTNeoXForCausalLM(config)
+    model.eval()
+    return model
+
+
+def test_int8_dynamic_quantization_report(char_tokenizer):
+    model = make_model()
+    bytes_before = get_model_bytes(model)
+
+    model, report = quantize_model(model, char_tokenizer, "int8_dynamic", check_prompts=CHECK_PROMPTS,
+                                   max_new_tokens=4)
+
+    assert isinstance(model.gpt_neox.layers[0].mlp.dense_h_to_4h, torch.ao.nn.quantized.dynamic.Linear)
+    assert report["memory"]["model_bytes_before"] == bytes_before
+    assert report["memory"]["model_bytes_after"] < bytes_before
+    assert report["tokens_per_sec"]["before"] > 0 and report["tokens_per_sec"]["after"] > 0
+    assert report["drift"]["num_prompts"] == len(CHECK_PROMPTS)
+    assert 0.0 <= report["drift"]["token_agreement"] <= 1.0
+
+    # 量子化したモデルでもそのまま文章生成できる
+    params = {"temperature": 0.0, "max_new_tokens": 8, "context_len": 128, "stop_ids": []}
+    output = asyncio.run(last_output(process_chat(model, char_tokenizer, "cpu", params, "User: hi\nBot:")))
+    assert isinstance(output, str) and len(output) > 0
+
+    assert get_resource_usage({"num_gpus": 0, "device": "cpu", "quantization": report})["quantization"] == report
+
+
+def test_unsupported_quantization(char_tokenizer):
+    with pytest.raises(ValueError):
+        quantize_model(make_model(), char_tokenizer, "int4")
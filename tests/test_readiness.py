@@ -0,0 +1,88 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+from chatstream import ChatStream, ChatPromptTogetherRedPajamaINCITEChat
+
+
+def create_chat_stream(loader, **kwargs):
+    chat_stream = ChatStream(model_loader=loader, load_model_in_background=True, device="cpu",
+                             chat_prompt_clazz=ChatPromptTogetherRedPajamaINCITEChat, max_new_tokens=4,
+                             context_len=128, **kwargs)
+    # ロールの検証はこのテストの対象外
+    chat_stream.verify_role_for_api = lambda request, api_name: None
+    return chat_stream
+
+
+def create_request():
+    # セッションを持たないリクエスト
+    return SimpleNamespace(state=SimpleNamespace())
+
+
+def test_model_is_loaded_and_warmed_up_in_background(tiny_model, char_tokenizer):
+    loaded = threading.Event()
+
+    def loader():
+        loaded.wait(timeout=10)
+        return tiny_model, char_tokenizer
+
+    chat_stream = create_chat_stream(loader, warmup_prompt_lengths=[4, 32], warmup_max_new_tokens=2)
+    assert chat_stream.readiness == "loading"
+    assert chat_stream.chat_generator is None
+
+    async def run():
+        await chat_stream.start_queue_worker()
+
+        # 読み込み中のリクエストは 503 と Retry-After で断る
+        response = await chat_stream.handle_chat_stream_request(create_request())
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "10"
+
+        loaded.set()
+        assert await chat_stream.wait_until_ready() == "ready"
+        chat_stream.queue_worker_task.cancel()
+
+        load = (await chat_stream.handle_get_load_request(create_request()))["chatstream_workers"][0]
+        assert load["readiness"] == "ready"
+        assert set(load["readiness_stats"]["warmup_sec"]) == {"4", "32"}
+        assert load["readiness_stats"]["load_sec"] >= 0
+
+    asyncio.run(run())
+    assert chat_stream.is_ready()
+    assert chat_stream.chat_generator.model is tiny_model
+
+
+def test_warmup_prompt_has_requested_length(tiny_model, char_tokenizer):
+    chat_stream = ChatStream(model=tiny_model, tokenizer=char_tokenizer, device="cpu", warmup_prompt_lengths=[16])
+
+    # 同期で読み込んだ場合も、ウォームアップが終わるまでは ready にならない
+    assert chat_stream.readiness == "warming_up"
+    assert len(chat_stream.chat_generator.create_warmup_prompt(100)) == 100
+
+
+def test_queued_requests_get_503_when_loading_fails():
+    loaded = threading.Event()
+
+    def loader():
+        loaded.wait(timeout=10)
+        raise RuntimeError("model not found")
+
+    chat_stream = create_chat_stream(loader, queue_requests_until_ready=True, not_ready_retry_after=3)
+
+    async def run():
+        await chat_stream.start_queue_worker()
+
+        # 準備ができるまでキューで待たせる
+        task = asyncio.create_task(chat_stream.handle_chat_stream_request(create_request()))
+        await asyncio.sleep(0.05)
+        assert not task.done()
+
+        loaded.set()
+        response = await task
+        chat_stream.queue_worker_task.cancel()
+        return response
+
+    response = asyncio.run(run())
+    assert chat_stream.readiness == "failed"
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "3"
@@ -0,0 +1,117 @@
+import asyncio
+
+from chatstream.chat_process import ChatGenerator
+from chatstream.response_cache import ResponseCache, ResponseRecorder, replay_diffs
+
+from conftest import collect, create_chat_prompt
+
+GREEDY_PARAMS = {"temperature": 0.0, "max_new_tokens": 8, "context_len": 256}
+
+
+def test_greedy_response_is_replayed_without_running_the_model(tiny_model, char_tokenizer):
+    response_cache = ResponseCache()
+    generator = ChatGenerator(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), response_cache=response_cache)
+    num_forwards = []
+    handle = tiny_model.register_forward_hook(lambda module, args, output: num_forwards.append(1))
+
+    try:
+        first = asyncio.run(collect(generator.generate(create_chat_prompt("Is this review positive"), {"output_type": "response_text"})))
+        num_forwards.clear()
+        chat_prompt = create_chat_prompt("Is this review positive")
+        second = asyncio.run(collect(generator.generate(chat_prompt, {"output_type": "response_text"})))
+    finally:
+        handle.remove()
+
+    assert second == first
+    assert num_forwards == []
+    assert chat_prompt.get_responder_last_msg() is not None
+    assert response_cache.get_stats() == {"entries": 1, "hits": 1, "misses": 1, "evicted": 0}
+
+
+def test_sampled_generations_are_not_cached(tiny_model, char_tokenizer):
+    response_cache = ResponseCache()
+    params = dict(GREEDY_PARAMS, temperature=0.7)
+    generator = ChatGenerator(tiny_model, char_tokenizer, "cpu", params, response_cache=response_cache)
+
+    asyncio.run(collect(generator.generate(create_chat_prompt("Is this review positive"), {"output_type": "response_text"})))
+
+    assert response_cache.get_stats()["entries"] == 0
+
+
+def test_key_depends_on_model_prompt_and_params():
+    response_cache = ResponseCache()
+    key = response_cache.create_key("model-a", "<human>: hi", GREEDY_PARAMS)
+
+    assert key == response_cache.create_key("model-a", "<human>: hi", dict(GREEDY_PARAMS))
+    assert key != response_cache.create_key("model-b", "<human>: hi", GREEDY_PARAMS)
+    assert key != response_cache.create_key("model-a", "<human>: hello", GREEDY_PARAMS)
+    assert key != response_cache.create_key("model-a", "<human>: hi", dict(GREEDY_PARAMS, max_new_tokens=9))
+    assert response_cache.create_key("model-a", [1, 2, 3], GREEDY_PARAMS) != \
+           response_cache.create_key("model-a", [1, 2, 4], GREEDY_PARAMS)
+
+
+def test_prompt_is_not_tokenized_to_create_the_key(tiny_model, char_tokenizer, monkeypatch):
+    num_encodes = []
+    encode = char_tokenizer.encode
+    monkeypatch.setattr(char_tokenizer, "encode", lambda *args, **kwargs: num_encodes.append(1) or encode(*args, **kwargs))
+
+    def count_encodes(response_cache):
+        generator = ChatGenerator(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), response_cache=response_cache)
+        num_encodes.clear()
+        asyncio.run(collect(generator.generate(create_chat_prompt("Is this review positive"), {"output_type": "response_text"})))
+        return len(num_encodes)
+
+    # キャッシュを使う場合も、キーのためにトークン化しなおさない
+    assert count_encodes(ResponseCache()) == count_encodes(None)
+
+
+def test_only_diffs_are_recorded():
+    outputs = ["He", "Hell", "Hello wor", "Hello"]
+    recorder = ResponseRecorder()
+    for output in outputs:
+        recorder.append(output)
+
+    # 追加された部分だけを保持し、末尾が書き換わった場合は共通の先頭部分を残す
+    assert recorder.diffs == [[0, "He"], [2, "ll"], [4, "o wor"], [5, ""]]
+    assert list(replay_diffs(recorder.diffs)) == outputs
+
+    alternatives = [["A", "B"], ["Ab", "B"]]
+    recorder = ResponseRecorder()
+    for output in alternatives:
+        recorder.append(output)
+    assert list(replay_diffs(recorder.diffs)) == alternatives
+
+
+def test_lru_and_ttl_eviction(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("chatstream.response_cache.time.time", lambda: now[0])
+
+    response_cache = ResponseCache(max_entries=2, ttl=60)
+    response_cache.put("a", [[0, "A"]])
+    response_cache.put("b", [[0, "B"]])
+    assert response_cache.get("a") == [[0, "A"]]
+
+    # 最も長く使われていない b が破棄される
+    response_cache.put("c", [[0, "C"]])
+    assert response_cache.get("b") is None
+    assert response_cache.get("c") == [[0, "C"]]
+
+    # 期限切れのエントリは使わない
+    now[0] += 61
+    assert response_cache.get("a") is None
+    assert response_cache.get_stats()["evicted"] == 2
+
+
+def test_entries_survive_restart_with_backing_file(tmp_path):
+    file_path = str(tmp_path / "response_cache.json")
+    response_cache = ResponseCache(file_path=file_path, save_interval=60)
+    response_cache.put("a", [[0, "He"], [2, "llo"]])
+    response_cache.put("b", [[0, "Hi"]])
+
+    # put のたびには書き出さず、まとめて書き出す
+    assert not (tmp_path / "response_cache.json").exists()
+    response_cache.flush()
+
+    restarted = ResponseCache(file_path=file_path)
+    assert list(replay_diffs(restarted.get("a"))) == ["He", "Hello"]
+    assert restarted.get("b") == [[0, "Hi"]]
@@ -0,0 +1,105 @@
+import asyncio
+import json
+
+from chatstream.chat_process import ChatGenerator, RewrittenText
+from chatstream.default_finish_token import DEFAULT_FINISH_TOKEN
+from chatstream.util_server_sent_events import negotiate_stream_format, format_sse_event, stream_server_sent_events
+
+from conftest import collect, create_chat_prompt
+
+GREEDY_PARAMS = {"temperature": 0.0, "max_new_tokens": 16, "context_len": 256}
+
+
+async def iterate(items, error=None):
+    for item in items:
+        yield item
+    if error is not None:
+        raise error
+
+
+def parse_events(stream):
+    events = []
+    for block in "".join(stream).split("\n\n")[:-1]:
+        event, data = "message", []
+        for line in block.split("\n"):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data.append(line[len("data: "):])
+        events.append((event, "\n".join(data)))
+    return events
+
+
+def test_negotiate_stream_format():
+    assert negotiate_stream_format(None, {}) == "cumulative"
+    assert negotiate_stream_format("*/*", {}) == "cumulative"
+    assert negotiate_stream_format("text/event-stream", {}) == "sse"
+
+    # リクエストの指定が Accept ヘッダより優先される
+    assert negotiate_stream_format("text/event-stream", {"stream_format": "cumulative"}) == "cumulative"
+    assert negotiate_stream_format(None, {"stream_format": "sse"}) == "sse"
+    assert negotiate_stream_format(None, {"stream_format": "delta"}) is None
+
+
+def test_multiline_data_is_split_into_data_lines():
+    assert format_sse_event("a\nb", event="replace") == "event: replace\ndata: a\ndata: b\n\n"
+
+
+def test_only_deltas_are_sent(tiny_model, char_tokenizer):
+    generator = ChatGenerator(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS))
+
+    async def run():
+        cumulative = await collect(generator.generate(create_chat_prompt(), {"output_type": "response_text"}))
+        sse = await collect(stream_server_sent_events(
+            generator.generate(create_chat_prompt(), {"output_type": "updated_text"})))
+        return cumulative, sse
+
+    cumulative, sse = asyncio.run(run())
+    events = parse_events(sse)
+
+    assert events[-1] == ("end", "")
+    assert all(event == "message" for event, _ in events[:-1])
+    assert "".join(data for _, data in events[:-1]) == cumulative[-1][:-len(DEFAULT_FINISH_TOKEN)]
+    assert len("".join(sse)) < len("".join(cumulative))
+
+
+def test_updated_text_is_rewritten_only_when_not_appended(tiny_model, char_tokenizer, monkeypatch):
+    async def fake_process_chat(*args, **kwargs):
+        for text in ["He", "Hello", "Hi", "Hi there"]:
+            yield text
+
+    monkeypatch.setattr("chatstream.chat_process.process_chat", fake_process_chat)
+    generator = ChatGenerator(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS))
+
+    outputs = asyncio.run(collect(generator.generate(create_chat_prompt(), {"output_type": "updated_text"})))
+
+    # 最後は未出力の差分が無いので空文字列(最後の差分をくりかえさない)
+    assert outputs == ["He", "llo", "Hi", " there", ""]
+    assert [isinstance(output, RewrittenText) for output in outputs] == [False, False, True, False, False]
+
+
+def test_replace_and_error_events():
+    chunks = ["He", "llo", RewrittenText("Hi"), ""]
+    events = parse_events(asyncio.run(collect(stream_server_sent_events(iterate(chunks, RuntimeError())))))
+
+    assert events == [("message", "He"), ("message", "llo"), ("replace", "Hi"),
+                      ("error", json.dumps({"error": "internal_server_error"}))]
+
+
+def test_alternatives_deltas(tiny_model, char_tokenizer):
+    generator = ChatGenerator(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS))
+
+    async def run():
+        final = await collect(generator.generate(create_chat_prompt(), {"output_type": "response_text", "n": 2}))
+        sse = await collect(stream_server_sent_events(
+            generator.generate(create_chat_prompt(), {"output_type": "updated_text", "n": 2}), num_alternatives=2))
+        return final, sse
+
+    final, sse = asyncio.run(run())
+    events = parse_events(sse)
+
+    assert events[-1] == ("end", "")
+    assert all(event == "alternatives" for event, _ in events[:-1])
+    deltas = [json.loads(data)["alternatives"] for _, data in events[:-1]]
+    assert ["".join(texts) for texts in zip(*deltas)] == \
+           json.loads(final[-1][:-len(DEFAULT_FINISH_TOKEN)])["alternatives"]
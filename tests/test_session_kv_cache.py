@@ -0,0 +1,162 @@
+import asyncio
+
+import torch
+
+from chatstream.chat_batch_engine import ChatBatchEngine
+from chatstream.chat_core import process_chat
+from chatstream.session_kv_cache import SessionKVCache, common_prefix_len
+
+from conftest import last_output
+
+GREEDY_PARAMS = {"temperature": 0.0, "max_new_tokens": 8, "context_len": 256, "stop_ids": []}
+
+
+def make_kv(seq_len):
+    return tuple((torch.zeros(1, 2, seq_len, 4), torch.zeros(1, 2, seq_len, 4)) for _ in range(2))
+
+
+def test_common_prefix_len():
+    assert common_prefix_len([1, 2, 3], [1, 2, 4]) == 2
+    assert common_prefix_len([1, 2], [1, 2, 3]) == 2
+    assert common_prefix_len([], [1]) == 0
+
+
+def test_take_reuses_matching_prefix_only():
+    cache = SessionKVCache()
+    cache.put("s", [1, 2, 3, 4], make_kv(4))
+
+    reuse_len, kv = cache.take("s", [1, 2, 9, 9, 9])
+    assert reuse_len == 2
+    assert kv[0][0].shape[-2] == 2
+
+    # 取り出したエントリはキャッシュから取り除かれる
+    assert cache.take("s", [1, 2, 9]) == (0, None)
+    assert cache.get_stats()["hits"] == 1
+    assert cache.get_stats()["misses"] == 1
+
+
+def test_take_leaves_at_least_one_token_to_prefill():
+    cache = SessionKVCache()
+    cache.put("s", [1, 2, 3], make_kv(3))
+
+    reuse_len, kv = cache.take("s", [1, 2, 3])
+    assert reuse_len == 2
+
+
+def test_lru_eviction_and_invalidate():
+    cache = SessionKVCache(max_sessions=2)
+    cache.put("a", [1, 2], make_kv(2))
+    cache.put("b", [1, 2], make_kv(2))
+    cache.put("c", [1, 2], make_kv(2))
+    assert list(cache.entries.keys()) == ["b", "c"]
+
+    cache.invalidate("b")
+    stats = cache.get_stats()
+    assert stats["num_sessions"] == 1
+    assert stats["memory_bytes"] == 2 * 2 * (2 * 2 * 4 * 4)
+
+
+def test_process_chat_reuses_previous_turn(tiny_model, char_tokenizer):
+    async def run(session_kv_cache):
+        first_prompt = "User: hello\nBot:"
+        first = await last_output(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS), first_prompt,
+                                               session_kv_cache=session_kv_cache, session_key="s"))
+        second_prompt = first_prompt + first + "\nUser: again\nBot:"
+        second = await last_output(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS),
+                                                second_prompt, session_kv_cache=session_kv_cache, session_key="s"))
+        return first, second
+
+    expected = asyncio.run(run(None))
+
+    session_kv_cache = SessionKVCache()
+    actual = asyncio.run(run(session_kv_cache))
+
+    assert actual == expected
+    stats = session_kv_cache.get_stats()
+    assert stats["hits"] == 1
+    assert stats["reused_tokens"] >= len("User: hello\nBot:")
+    assert stats["num_sessions"] == 1
+
+
+def test_batch_engine_reuses_previous_turn(tiny_model, char_tokenizer):
+    async def run(session_kv_cache):
+        engine = ChatBatchEngine(tiny_model, char_tokenizer, "cpu", max_batch_size=2,
+                                 session_kv_cache=session_kv_cache)
+        first_prompt = "User: hi\nBot:"
+        first = await last_output(engine.generate(dict(GREEDY_PARAMS), first_prompt, session_key="s"))
+
+        # 別のリクエストと同じバッチで生成し、左パディングされた行からもKVキャッシュを保存できることを確かめる
+        second_prompt = first_prompt + first + "\nUser: again\nBot:"
+        second, other = await asyncio.gather(
+            last_output(engine.generate(dict(GREEDY_PARAMS), second_prompt, session_key="s")),
+            last_output(engine.generate(dict(GREEDY_PARAMS, max_new_tokens=3),
+                                        "A much longer prompt than the others in this batch.")))
+        third_prompt = second_prompt + second + "\nUser: more\nBot:"
+        third = await last_output(engine.generate(dict(GREEDY_PARAMS), third_prompt, session_key="s"))
+        return first, second, other, third
+
+    expected = asyncio.run(run(None))
+
+    session_kv_cache = SessionKVCache()
+    actual = asyncio.run(run(session_kv_cache))
+
+    assert actual == expected
+    assert session_kv_cache.get_stats()["hits"] == 2
+
+
+def test_offload_to_host_and_disk(tmp_path):
+    entry_bytes = 2 * 2 * (2 * 2 * 4 * 4)  # make_kv(2) のバイト数
+    cache = SessionKVCache(max_device_bytes=entry_bytes, max_host_bytes=entry_bytes, offload_dir=str(tmp_path))
+    for session_key in ["a", "b", "c"]:
+        cache.put(session_key, [1, 2], make_kv(2))
+
+    # 最も長く使われていない "a" がファイルに、 "b" が RAM に退避される
+    assert [cache.entries[key].tier for key in ["a", "b", "c"]] == ["disk", "host", "device"]
+    assert len(list(tmp_path.iterdir())) == 1
+    stats = cache.get_stats()
+    assert stats["offloads"] == 3
+    assert stats["tiers"]["disk"] == {"num_sessions": 1, "bytes": entry_bytes}
+
+    # 次のリクエストが来たときにファイルから復元される
+    reuse_len, kv = cache.take("a", [1, 2, 3])
+    assert reuse_len == 2
+    assert kv[1][1].shape == (1, 2, 2, 4)
+    assert cache.get_stats()["restores"] == 1
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_offload_drops_when_no_lower_tier(tmp_path):
+    entry_bytes = 2 * 2 * (2 * 2 * 4 * 4)
+    cache = SessionKVCache(max_device_bytes=entry_bytes, max_host_bytes=entry_bytes)
+    for session_key in ["a", "b", "c"]:
+        cache.put(session_key, [1, 2], make_kv(2))
+
+    assert list(cache.entries.keys()) == ["b", "c"]
+    cache.invalidate("b")
+    assert cache.get_stats()["tiers"]["host"]["bytes"] == 0
+
+
+def test_process_chat_restores_offloaded_session(tiny_model, char_tokenizer, tmp_path):
+    async def run(session_kv_cache):
+        outputs = []
+        prompts = {"s1": "User: hello\nBot:", "s2": "User: good morning\nBot:"}
+        for session_key, prompt in prompts.items():
+            outputs.append(await last_output(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS),
+                                                          prompt, session_kv_cache=session_kv_cache,
+                                                          session_key=session_key)))
+        # s1 のKVキャッシュは s2 の生成後にファイルへ退避されている
+        second_prompt = prompts["s1"] + outputs[0] + "\nUser: again\nBot:"
+        outputs.append(await last_output(process_chat(tiny_model, char_tokenizer, "cpu", dict(GREEDY_PARAMS),
+                                                      second_prompt, session_kv_cache=session_kv_cache,
+                                                      session_key="s1")))
+        return outputs
+
+    expected = asyncio.run(run(None))
+
+    session_kv_cache = SessionKVCache(max_device_bytes=1, max_host_bytes=1, offload_dir=str(tmp_path))
+    actual = asyncio.run(run(session_kv_cache))
+
+    assert actual == expected
+    stats = session_kv_cache.get_stats()
+    assert stats["hits"] == 1
+    assert stats["restores"] == 1
@@ -0,0 +1,139 @@
+import asyncio
+
+import pytest
+import torch
+from transformers import GPTNeoXConfig, GPTNeoXForCausalLM
+
+from chatstream import ChatStream
+from chatstream.chat_core import process_chat
+from chatstream.kv_block_manager import KVBlockManager
+from chatstream.speculative_decoding import SpeculativeDecoder, PromptLookupDecoder, find_ngram_continuation
+
+from conftest import last_output
+
+GREEDY_PARAMS = {"temperature": 0.0, "max_new_tokens": 20, "context_len": 256, "stop_ids": []}
+
+
+def make_draft_model():
+    # tiny_model とは重みの異なる、さらに小さなドラフトモデル
+    torch.manual_seed(1)
+    config = GPTNeoXConfig(vocab_size=96, hidden_size=16, num_hidden_layers=1, num_attention_heads=2,
+                           intermediate_size=32, max_position_embeddings=512)
+    model = GPTNeoXForCausalLM(config)
+    model.eval()
+    return model
+
+
+def run_chat(model, tokenizer, params, prompt, speculative_decoder=None, prompt_lookup_decoder=None,
+             kv_block_manager=None):
+    return asyncio.run(last_output(process_chat(model, tokenizer, "cpu", dict(params), prompt,
+                                                speculative_decoder=speculative_decoder,
+                                                prompt_lookup_decoder=prompt_lookup_decoder,
+                                                kv_block_manager=kv_block_manager)))
+
+
+def test_greedy_output_is_unchanged(tiny_model, char_tokenizer):
+    prompt = "User: hello\nBot:"
+    expected = run_chat(tiny_model, char_tokenizer, GREEDY_PARAMS, prompt)
+
+    decoder = SpeculativeDecoder(make_draft_model())
+    assert run_chat(tiny_model, char_tokenizer, GREEDY_PARAMS, prompt, decoder) == expected
+
+    stats = decoder.get_stats()
+    assert stats["generated"] == GREEDY_PARAMS["max_new_tokens"]
+    assert stats["recent_requests"][-1]["generated"] == GREEDY_PARAMS["max_new_tokens"]
+
+
+def test_same_model_as_draft_accepts_all(tiny_model, char_tokenizer):
+    prompt = "User: hello\nBot:"
+    expected = run_chat(tiny_model, char_tokenizer, GREEDY_PARAMS, prompt)
+
+    decoder = SpeculativeDecoder(tiny_model, num_speculative_tokens=3)
+    assert run_chat(tiny_model, char_tokenizer, GREEDY_PARAMS, prompt, decoder) == expected
+
+    # すべての提案が受理されるので、メインモデルの検証回数は生成トークン数より少なくなる
+    stats = decoder.get_stats()
+    assert stats["acceptance_rate"] == 1.0
+    assert stats["verifications"] < GREEDY_PARAMS["max_new_tokens"] // 2
+
+
+def test_sampling_with_penalty_runs_to_max_new_tokens(tiny_model, char_tokenizer):
+    torch.manual_seed(0)
+    params = {"temperature": 0.8, "top_k_value": 20, "top_p_value": 0.9, "use_repetition_penalty": True,
+              "repetition_penalty": 1.2, "max_new_tokens": 16, "context_len": 256, "stop_ids": []}
+
+    decoder = SpeculativeDecoder(make_draft_model())
+    run_chat(tiny_model, char_tokenizer, params, "User: hi\nBot:", decoder)
+    assert decoder.get_stats()["generated"] == 16
+
+
+def test_verify_preserves_target_distribution():
+    torch.manual_seed(0)
+    decoder = SpeculativeDecoder(make_draft_model())
+    target_probs = torch.tensor([[0.6, 0.3, 0.1], [0.2, 0.2, 0.6]])
+    draft_probs = torch.tensor([0.1, 0.2, 0.7])
+
+    counts = torch.zeros(3)
+    num_trials = 20000
+    for _ in range(num_trials):
+        proposed_id = int(torch.multinomial(draft_probs, num_samples=1))
+        first_token_id = decoder._verify([proposed_id], [draft_probs], target_probs)[0]
+        counts[first_token_id] += 1
+
+    # ドラフトモデルの分布に関わらず、最初のトークンはメインモデルの分布に従う
+    assert torch.allclose(counts / num_trials, target_probs[0], atol=0.02)
+
+
+def test_adapt_follows_acceptance_rate():
+    decoder = SpeculativeDecoder(make_draft_model(), min_speculative_tokens=1, max_speculative_tokens=8)
+    assert decoder._adapt(1.0, None)[0] == 8
+    assert decoder._adapt(0.0, None)[0] == 1
+    assert decoder._adapt(0.75, None)[0] == 3
+
+
+def test_find_ngram_continuation():
+    token_ids = [1, 2, 3, 4, 5, 9, 2, 3, 6, 7, 2, 3]
+
+    # 末尾の [2, 3] と一致する直近の箇所の続き
+    assert find_ngram_continuation(token_ids, 3, max_ngram_size=2) == [6, 7, 2]
+    # 長い n-gram が優先される
+    assert find_ngram_continuation(token_ids + [4], 2, max_ngram_size=3) == [5, 9]
+    assert find_ngram_continuation([1, 2, 3], 2) == []
+
+
+def test_prompt_lookup_output_is_unchanged(tiny_model, char_tokenizer):
+    prompt = "User: abcabcabcabc\nBot: abcabc"
+    expected = run_chat(tiny_model, char_tokenizer, GREEDY_PARAMS, prompt)
+
+    decoder = PromptLookupDecoder()
+
+    # 生成パラメータで有効にしない場合は使わない
+    assert run_chat(tiny_model, char_tokenizer, GREEDY_PARAMS, prompt, prompt_lookup_decoder=decoder) == expected
+    assert decoder.get_stats()["verifications"] == 0
+
+    params = dict(GREEDY_PARAMS, use_prompt_lookup=True)
+    assert run_chat(tiny_model, char_tokenizer, params, prompt, prompt_lookup_decoder=decoder) == expected
+
+    stats = decoder.get_stats()
+    assert stats["generated"] == GREEDY_PARAMS["max_new_tokens"]
+    assert stats["proposed"] > 0
+
+
+def test_prompt_lookup_is_ignored_with_paged_kv_cache(tiny_model, char_tokenizer):
+    prompt = "User: abcabcabcabc\nBot: abcabc"
+    expected = run_chat(tiny_model, char_tokenizer, GREEDY_PARAMS, prompt)
+
+    decoder = PromptLookupDecoder()
+    manager = KVBlockManager.from_model(tiny_model, 512 * 4 * 64, block_size=4)
+    params = dict(GREEDY_PARAMS, use_prompt_lookup=True)
+
+    # リクエストで有効にしても、ブロックのプールを使わずに生成することはない
+    assert run_chat(tiny_model, char_tokenizer, params, prompt, prompt_lookup_decoder=decoder,
+                    kv_block_manager=manager) == expected
+    assert decoder.get_stats()["verifications"] == 0
+
+
+def test_speculative_decoding_with_kv_caches_is_refused(tiny_model, char_tokenizer):
+    with pytest.raises(ValueError, match="use_prompt_lookup cannot be combined"):
+        ChatStream(model=tiny_model, tokenizer=char_tokenizer, device="cpu", use_prompt_lookup=True,
+                   use_session_kv_cache=True)
@@ -0,0 +1,60 @@
+from chatstream.stop_condition_matcher import StopConditionMatcher
+
+
+def feed(matcher, deltas):
+    outputs = []
+    for delta in deltas:
+        safe_text, stopped = matcher.put(delta)
+        outputs.append(safe_text)
+        if stopped:
+            return "".join(outputs), True
+    return "".join(outputs) + matcher.flush(), False
+
+
+def test_stop_string_split_across_deltas():
+    matcher = StopConditionMatcher(["<|endoftext|>", "\n<"])
+
+    text, stopped = feed(matcher, ["Alan Turing was", " a mathematician.", "\n", "<hu", "man>: thanks"])
+
+    assert stopped
+    assert text == "Alan Turing was a mathematician."
+
+
+def test_partial_match_is_held_back_until_resolved():
+    matcher = StopConditionMatcher(["\n<"])
+
+    assert matcher.put("first line\n") == ("first line", False)
+    # "\n" の次が "<" でなかったので、保留していた "\n" も出力される
+    assert matcher.put("second") == ("\nsecond", False)
+
+
+def test_held_text_is_flushed_when_generation_ends():
+    matcher = StopConditionMatcher(["<|endoftext|>"])
+
+    assert matcher.put("answer <|end") == ("answer ", False)
+    assert matcher.flush() == "<|end"
+
+
+def test_overlapping_patterns_cut_at_earliest_start():
+    matcher = StopConditionMatcher(["abcd", "bc"])
+
+    assert matcher.put("xxab") == ("xx", False)
+    # "abc" まで読んだ時点で "bc" が一致するので、その直前の "a" までが出力される
+    assert matcher.put("cd") == ("a", True)
+
+
+def test_failure_links_find_pattern_inside_failed_prefix():
+    matcher = StopConditionMatcher(["aab"])
+
+    text, stopped = feed(matcher, ["a", "a", "a", "b", "zzz"])
+
+    assert stopped
+    assert text == "a"
+
+
+def test_stop_token_ids_and_empty_stop_strs():
+    matcher = StopConditionMatcher(["", None], stop_token_ids=[0, 2])
+
+    assert matcher.is_stop_token(2)
+    assert not matcher.is_stop_token(1)
+    assert matcher.put("no stop strings") == ("no stop strings", False)